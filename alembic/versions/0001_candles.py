@@ -0,0 +1,37 @@
+# Creates the candles table that app/candles.py keeps up to date as trades commit.
+"""add candles
+
+Revision ID: 0001_candles
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001_candles"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "candles",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("instrument_id", sa.Integer(), sa.ForeignKey("instruments.id"), nullable=False),
+        sa.Column("interval", sa.Integer(), nullable=False),
+        sa.Column("ts", sa.DateTime(), nullable=False),
+        sa.Column("open", sa.Numeric(20, 8), nullable=False),
+        sa.Column("high", sa.Numeric(20, 8), nullable=False),
+        sa.Column("low", sa.Numeric(20, 8), nullable=False),
+        sa.Column("close", sa.Numeric(20, 8), nullable=False),
+        sa.Column("volume", sa.Numeric(20, 8), nullable=False),
+        sa.UniqueConstraint("instrument_id", "interval", "ts", name="uq_candles_instrument_interval_ts"),
+    )
+    op.create_index("ix_candles_id", "candles", ["id"])
+
+
+def downgrade():
+    op.drop_index("ix_candles_id", table_name="candles")
+    op.drop_table("candles")
@@ -0,0 +1,42 @@
+# Builds the active-book, orders-by-status and trades-by-time indexes concurrently.
+"""indexes for book, order history and trade history queries
+
+Revision ID: 0002_hot_path_indexes
+Revises: 0001_candles
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002_hot_path_indexes"
+down_revision = "0001_candles"
+branch_labels = None
+depends_on = None
+
+ACTIVE = sa.text("status IN ('NEW', 'PARTIAL')")
+
+
+def upgrade():
+    # CONCURRENTLY keeps orders and trades writable while the indexes build;
+    # it cannot run inside a transaction.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_orders_active_book", "orders", ["instrument_id", "side", "price"],
+            postgresql_where=ACTIVE, postgresql_concurrently=True, if_not_exists=True,
+        )
+        op.create_index(
+            "ix_orders_user_status", "orders", ["user_id", "status"],
+            postgresql_concurrently=True, if_not_exists=True,
+        )
+        op.create_index(
+            "ix_trades_instrument_timestamp", "trades", ["instrument_id", "timestamp"],
+            postgresql_concurrently=True, if_not_exists=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_trades_instrument_timestamp", table_name="trades", postgresql_concurrently=True)
+        op.drop_index("ix_orders_user_status", table_name="orders", postgresql_concurrently=True)
+        op.drop_index("ix_orders_active_book", table_name="orders", postgresql_concurrently=True)
@@ -0,0 +1,27 @@
+# Builds the (user_id, created_at, id) index that order history pages walk.
+"""keyset index for paginated order history
+
+Revision ID: 0003_order_history_index
+Revises: 0002_hot_path_indexes
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+
+revision = "0003_order_history_index"
+down_revision = "0002_hot_path_indexes"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_orders_user_created", "orders", ["user_id", "created_at", "id"],
+            postgresql_concurrently=True, if_not_exists=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_orders_user_created", table_name="orders", postgresql_concurrently=True)
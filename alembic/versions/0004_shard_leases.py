@@ -0,0 +1,30 @@
+# Creates shard_leases: which matching worker owns each shard, and until when.
+"""shard ownership leases for sharded matching
+
+Revision ID: 0004_shard_leases
+Revises: 0003_order_history_index
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0004_shard_leases"
+down_revision = "0003_order_history_index"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "shard_leases",
+        sa.Column("shard_id", sa.Integer(), primary_key=True, autoincrement=False),
+        sa.Column("owner", sa.String(), nullable=False),
+        sa.Column("address", sa.String(), nullable=False),
+        sa.Column("epoch", sa.Integer(), nullable=False),
+        sa.Column("expires_at", sa.DateTime(timezone=True), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("shard_leases")
@@ -0,0 +1,27 @@
+# Creates journal_state: the last write-behind batch committed per journal stream.
+"""watermark of the matching journal
+
+Revision ID: 0005_journal_state
+Revises: 0004_shard_leases
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0005_journal_state"
+down_revision = "0004_shard_leases"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "journal_state",
+        sa.Column("name", sa.String(), primary_key=True),
+        sa.Column("batch", sa.Integer(), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("journal_state")
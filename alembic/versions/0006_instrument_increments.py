@@ -0,0 +1,25 @@
+# Adds tick_size and lot_size to instruments, both defaulting to 1.
+"""tick and lot size per instrument
+
+Revision ID: 0006_instrument_increments
+Revises: 0005_journal_state
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0006_instrument_increments"
+down_revision = "0005_journal_state"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("instruments", sa.Column("tick_size", sa.Numeric(20, 8), nullable=False, server_default="1"))
+    op.add_column("instruments", sa.Column("lot_size", sa.Numeric(20, 8), nullable=False, server_default="1"))
+
+
+def downgrade():
+    op.drop_column("instruments", "lot_size")
+    op.drop_column("instruments", "tick_size")
@@ -0,0 +1,139 @@
+# Creates orders_archive and rebuilds trades as a table partitioned by month.
+"""orders_archive and monthly partitioning of trades
+
+Rewrites trades into a partitioned table, which holds a lock on it for the
+duration of the copy: run during a maintenance window.
+
+Revision ID: 0007_order_archive
+Revises: 0006_instrument_increments
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = "0007_order_archive"
+down_revision = "0006_instrument_increments"
+branch_labels = None
+depends_on = None
+
+
+def months(column, table):
+    rows = op.get_bind().execute(sa.text(
+        f"SELECT DISTINCT date_trunc('month', {column}) AS m FROM {table} WHERE {column} IS NOT NULL ORDER BY m"
+    ))
+    return [r.m for r in rows]
+
+
+def create_partitions(table, column, source):
+    # Same names and bounds as app.archive.ensure_partition.
+    op.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+    for m in months(column, source):
+        year, month = divmod(m.year * 12 + m.month, 12)
+        op.execute(
+            f"CREATE TABLE {table}_{m:%Y%m} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{m:%Y-%m-%d}') TO ('{year:04d}-{month + 1:02d}-01')"
+        )
+
+
+def upgrade():
+    # Orders closed before this revision are aged from their creation time.
+    op.add_column("orders", sa.Column("closed_at", sa.DateTime(), nullable=True))
+    op.execute("UPDATE orders SET closed_at = created_at WHERE status IN ('FILLED', 'CANCELED')")
+
+    op.create_table(
+        "orders_archive",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("external_id", sa.String(), nullable=False),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("instrument_id", sa.Integer(), sa.ForeignKey("instruments.id"), nullable=False),
+        sa.Column("type", postgresql.ENUM(name="ordertype", create_type=False), nullable=False),
+        sa.Column("side", postgresql.ENUM(name="side", create_type=False), nullable=False),
+        sa.Column("price", sa.Numeric(20, 8), nullable=True),
+        sa.Column("quantity", sa.Numeric(20, 8), nullable=False),
+        sa.Column("filled", sa.Numeric(20, 8)),
+        sa.Column("status", postgresql.ENUM(name="orderstatus", create_type=False), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("closed_at", sa.DateTime(), nullable=True),
+        sa.Column("archived_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id", "created_at"),
+        postgresql_partition_by="RANGE (created_at)",
+    )
+    op.execute("CREATE TABLE orders_archive_default PARTITION OF orders_archive DEFAULT")
+    op.create_index("ix_orders_archive_external_id", "orders_archive", ["external_id"])
+    op.create_index("ix_orders_archive_user_created", "orders_archive", ["user_id", "created_at", "id"])
+
+    # Trades keep their ids (and sequence) but lose the foreign keys to
+    # orders, whose rows may now live in orders_archive.
+    op.rename_table("trades", "trades_unpartitioned")
+    op.execute("ALTER INDEX trades_pkey RENAME TO trades_unpartitioned_pkey")
+    op.execute("ALTER SEQUENCE trades_id_seq OWNED BY NONE")
+    op.execute("DROP INDEX IF EXISTS ix_trades_id")
+    op.execute("DROP INDEX IF EXISTS ix_trades_instrument_timestamp")
+    op.create_table(
+        "trades",
+        sa.Column("id", sa.Integer(), server_default=sa.text("nextval('trades_id_seq')"), nullable=False),
+        sa.Column("buy_order_id", sa.Integer(), nullable=False),
+        sa.Column("sell_order_id", sa.Integer(), nullable=False),
+        sa.Column("instrument_id", sa.Integer(), sa.ForeignKey("instruments.id"), nullable=False),
+        sa.Column("price", sa.Numeric(20, 8), nullable=False),
+        sa.Column("quantity", sa.Numeric(20, 8), nullable=False),
+        sa.Column("timestamp", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id", "timestamp"),
+        postgresql_partition_by="RANGE (timestamp)",
+    )
+    op.execute("ALTER SEQUENCE trades_id_seq OWNED BY trades.id")
+    create_partitions("trades", "timestamp", "trades_unpartitioned")
+    op.create_index("ix_trades_id", "trades", ["id"])
+    op.create_index("ix_trades_instrument_timestamp", "trades", ["instrument_id", "timestamp"])
+    # Rows without a timestamp end up in trades_default.
+    op.execute(
+        "INSERT INTO trades (id, buy_order_id, sell_order_id, instrument_id, price, quantity, timestamp) "
+        "SELECT id, buy_order_id, sell_order_id, instrument_id, price, quantity, "
+        "coalesce(timestamp, '1970-01-01') FROM trades_unpartitioned"
+    )
+    op.drop_table("trades_unpartitioned")
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_orders_terminal_closed", "orders", ["closed_at"],
+            postgresql_where=sa.text("status IN ('FILLED', 'CANCELED')"),
+            postgresql_concurrently=True, if_not_exists=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_orders_terminal_closed", table_name="orders", postgresql_concurrently=True)
+
+    op.rename_table("trades", "trades_partitioned")
+    op.execute("ALTER INDEX trades_pkey RENAME TO trades_partitioned_pkey")
+    op.execute("ALTER SEQUENCE trades_id_seq OWNED BY NONE")
+    op.execute("DROP INDEX ix_trades_id")
+    op.execute("DROP INDEX ix_trades_instrument_timestamp")
+    op.create_table(
+        "trades",
+        sa.Column("id", sa.Integer(), server_default=sa.text("nextval('trades_id_seq')"), primary_key=True),
+        sa.Column("buy_order_id", sa.Integer(), sa.ForeignKey("orders.id"), nullable=False),
+        sa.Column("sell_order_id", sa.Integer(), sa.ForeignKey("orders.id"), nullable=False),
+        sa.Column("instrument_id", sa.Integer(), sa.ForeignKey("instruments.id"), nullable=False),
+        sa.Column("price", sa.Numeric(20, 8), nullable=False),
+        sa.Column("quantity", sa.Numeric(20, 8), nullable=False),
+        sa.Column("timestamp", sa.DateTime()),
+    )
+    op.execute("ALTER SEQUENCE trades_id_seq OWNED BY trades.id")
+
+    # Archived orders go back first so the foreign keys above hold.
+    op.execute(
+        "INSERT INTO orders (id, external_id, user_id, instrument_id, type, side, price, quantity, filled, status, "
+        "created_at, closed_at) "
+        "SELECT id, external_id, user_id, instrument_id, type, side, price, quantity, filled, status, created_at, closed_at "
+        "FROM orders_archive"
+    )
+    op.drop_table("orders_archive")
+    op.drop_column("orders", "closed_at")
+    op.execute("INSERT INTO trades SELECT * FROM trades_partitioned")
+    op.drop_table("trades_partitioned")
+    op.create_index("ix_trades_id", "trades", ["id"])
+    op.create_index("ix_trades_instrument_timestamp", "trades", ["instrument_id", "timestamp"])
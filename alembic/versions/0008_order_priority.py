@@ -0,0 +1,23 @@
+# Adds orders.priority_at: when an amend last sent an order to the back of its queue.
+"""queue priority of amended orders
+
+Revision ID: 0008_order_priority
+Revises: 0007_order_archive
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0008_order_priority"
+down_revision = "0007_order_archive"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("orders", sa.Column("priority_at", sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("orders", "priority_at")
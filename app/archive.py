@@ -0,0 +1,206 @@
+"""Move terminal orders out of the hot `orders` table; keep monthly partitions ahead.
+
+Orders that became FILLED or CANCELED (closed_at) more than
+ORDER_ARCHIVE_AFTER seconds ago are moved into `orders_archive` in batches
+of ORDER_ARCHIVE_BATCH.
+Each batch is one DELETE ... RETURNING feeding an INSERT, so an order is
+always in exactly one of the two tables. Candidates are locked with SKIP
+LOCKED, so overlapping runs are safe, but one process is enough: the loop
+is off in the API (ORDER_ARCHIVE_INTERVAL=0) and runs as its own process.
+
+`orders_archive` and `trades` are range-partitioned by month. Every pass
+creates the partitions for the current month and the next
+PARTITION_MONTHS_AHEAD, plus archive partitions for the months of the
+orders about to move. Rows that fall outside every partition land in the
+table's default partition and are moved out when their month's partition
+is created.
+
+    python -m app.archive                     # one pass, then exit
+    python -m app.archive --loop --interval 60
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+from typing import Optional
+
+from sqlalchemy import delete, func, insert, literal, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import metrics
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import Order, OrderArchive, OrderStatus
+
+logger = logging.getLogger(__name__)
+
+TERMINAL = (OrderStatus.FILLED, OrderStatus.CANCELED)
+
+# Partitioned table -> partition key column.
+PARTITIONED = {"trades": "timestamp", "orders_archive": "created_at"}
+
+COLUMNS = ("id", "external_id", "user_id", "instrument_id", "type", "side", "price", "quantity", "filled",
+           "status", "created_at", "closed_at")
+
+
+def month_start(ts: datetime.datetime) -> datetime.datetime:
+    return datetime.datetime(ts.year, ts.month, 1)
+
+
+def add_months(month: datetime.datetime, n: int) -> datetime.datetime:
+    year, index = divmod(month.year * 12 + month.month - 1 + n, 12)
+    return datetime.datetime(year, index + 1, 1)
+
+
+async def ensure_partition(db: AsyncSession, table: str, month: datetime.datetime) -> bool:
+    """Create the partition of `table` for `month` unless it exists. Returns True if created."""
+    name = f"{table}_{month:%Y%m}"
+    if (await db.execute(text("SELECT to_regclass(:name)"), {"name": name})).scalar() is not None:
+        return False
+    # Other processes may be creating the same partition.
+    await db.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": name})
+    if (await db.execute(text("SELECT to_regclass(:name)"), {"name": name})).scalar() is not None:
+        return False
+    column = PARTITIONED[table]
+    lo, hi = month, add_months(month, 1)
+    # CREATE ... PARTITION OF fails while the default partition holds rows of
+    # that month, so build the table, move those rows into it, then attach.
+    await db.execute(text(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    moved = await db.execute(text(
+        f"WITH moved AS (DELETE FROM {table}_default WHERE {column} >= :lo AND {column} < :hi RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved"
+    ), {"lo": lo, "hi": hi})
+    await db.execute(text(
+        f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ('{lo:%Y-%m-%d}') TO ('{hi:%Y-%m-%d}')"
+    ))
+    logger.info("created partition %s (%d rows from %s_default)", name, moved.rowcount, table)
+    return True
+
+
+async def ensure_partitions(db: AsyncSession, now: datetime.datetime, months_ahead: int) -> None:
+    for table in PARTITIONED:
+        for n in range(months_ahead + 1):
+            await ensure_partition(db, table, add_months(month_start(now), n))
+
+
+async def archive_batch(db: AsyncSession, cutoff: datetime.datetime, limit: int, now: datetime.datetime) -> int:
+    picked = (
+        select(Order.id)
+        .where(Order.status.in_(TERMINAL), Order.closed_at < cutoff)
+        .order_by(Order.closed_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    moved = (
+        delete(Order)
+        .where(Order.id.in_(picked.scalar_subquery()))
+        .returning(*(getattr(Order, c) for c in COLUMNS))
+        .cte("moved")
+    )
+    result = await db.execute(
+        insert(OrderArchive).from_select(
+            COLUMNS + ("archived_at",),
+            select(*(moved.c[c] for c in COLUMNS), literal(now, OrderArchive.archived_at.type)),
+        )
+    )
+    return result.rowcount
+
+
+class Archiver:
+    def __init__(self, interval: float, after: float, batch: int, months_ahead: int):
+        self.interval = interval
+        self.after = after
+        self.batch = batch
+        self.months_ahead = months_ahead
+        self.task: Optional[asyncio.Task] = None
+        self.moved = 0
+        self.passes = 0
+        self.last_pass: Optional[float] = None  # seconds the last pass took
+
+    def start(self) -> None:
+        if self.interval > 0:
+            self.task = asyncio.create_task(self._run(), name="order-archiver")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("order archive pass failed")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> int:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        now = datetime.datetime.utcnow()
+        cutoff = now - datetime.timedelta(seconds=self.after)
+        async with AsyncSessionLocal() as db:
+            await ensure_partitions(db, now, self.months_ahead)
+            oldest = (await db.execute(
+                select(func.min(Order.created_at)).where(Order.status.in_(TERMINAL), Order.closed_at < cutoff)
+            )).scalar()
+            if oldest is not None:
+                month = month_start(oldest)
+                while month <= cutoff:
+                    await ensure_partition(db, "orders_archive", month)
+                    month = add_months(month, 1)
+            await db.commit()
+
+        moved = 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                n = await archive_batch(db, cutoff, self.batch, now)
+                await db.commit()
+            moved += n
+            self.moved += n
+            if n < self.batch:
+                break
+        self.passes += 1
+        self.last_pass = loop.time() - started
+        if moved:
+            logger.info("archived %d orders closed before %s", moved, cutoff)
+        return moved
+
+    async def stop(self) -> None:
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    def stats(self) -> dict:
+        return {"moved": self.moved, "passes": self.passes, "last_pass_s": self.last_pass,
+                "running": self.task is not None}
+
+
+archiver = Archiver(
+    settings.ORDER_ARCHIVE_INTERVAL,
+    settings.ORDER_ARCHIVE_AFTER,
+    settings.ORDER_ARCHIVE_BATCH,
+    settings.PARTITION_MONTHS_AHEAD,
+)
+
+metrics.Gauge(
+    "exchange_orders_archived_total", "Orders moved to orders_archive by this process",
+    lambda: (((), archiver.moved),), type="counter",
+)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--loop", action="store_true", help="keep running a pass every --interval seconds")
+    parser.add_argument("--interval", type=float, default=settings.ORDER_ARCHIVE_INTERVAL or 60.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.loop:
+        archiver.interval = args.interval
+        await archiver._run()
+    moved = await archiver.run_once()
+    print(f"archived {moved} orders")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
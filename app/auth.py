@@ -1,19 +1,100 @@
 from fastapi import Depends, HTTPException, Header
+from app.config import settings
 from app.database import get_db
+from app import metrics
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.models import User
 from sqlalchemy import select
+from collections import OrderedDict
+from typing import Optional
 import secrets
+import time
 
-async def get_current_user(token: str = Header(..., alias="Authorization"), db: AsyncSession = Depends(get_db)):
+
+class AuthUser:
+    """The handful of User fields request handlers need, detached from any session."""
+    __slots__ = ("id", "external_id", "name", "role", "is_admin", "token")
+
+    def __init__(self, id, external_id, name, role, is_admin, token):
+        self.id = id
+        self.external_id = external_id
+        self.name = name
+        self.role = role
+        self.is_admin = is_admin
+        self.token = token
+
+    @classmethod
+    def from_model(cls, u: User) -> "AuthUser":
+        return cls(u.id, u.external_id, u.name, u.role, bool(u.is_admin), u.token)
+
+
+class TokenCache:
+    """Bounded LRU of token -> AuthUser with a TTL on every entry."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> Optional[AuthUser]:
+        entry = self.entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        user, expires = entry
+        if expires < time.monotonic():
+            del self.entries[token]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(token)
+        self.hits += 1
+        return user
+
+    def put(self, user: AuthUser) -> None:
+        if self.maxsize <= 0:
+            return
+        self.entries[user.token] = (user, time.monotonic() + self.ttl)
+        self.entries.move_to_end(user.token)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, token: Optional[str]) -> None:
+        if token is not None:
+            self.entries.pop(token, None)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+token_cache = TokenCache(settings.AUTH_CACHE_SIZE, settings.AUTH_CACHE_TTL)
+
+metrics.Gauge(
+    "exchange_auth_cache_lookups_total", "Token cache lookups",
+    lambda: ((("hit",), token_cache.hits), (("miss",), token_cache.misses)),
+    ("result",), type="counter",
+)
+
+
+async def get_current_user(token: str = Header(..., alias="Authorization"), db: AsyncSession = Depends(get_db)) -> AuthUser:
     scheme, _, value = token.partition(" ")
     if scheme not in ("TOKEN", "Bearer") or not value:
         raise HTTPException(401, "Invalid auth header")
     raw = value
-    res = await db.execute(select(User).where(User.token == raw))
-    user = res.scalar_one_or_none()
-    if not user:
-        raise HTTPException(401, "Invalid token")
+    started = time.perf_counter()
+    user = token_cache.get(raw)
+    if user is None:
+        res = await db.execute(select(User).where(User.token == raw))
+        u = res.scalar_one_or_none()
+        if not u:
+            raise HTTPException(401, "Invalid token")
+        user = AuthUser.from_model(u)
+        token_cache.put(user)
+    metrics.ORDER_STAGE.observe(time.perf_counter() - started, "auth")
     return user
 
 def create_token() -> str:
@@ -0,0 +1,176 @@
+import argparse
+import asyncio
+import datetime
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, insert, select, tuple_, update, bindparam
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Candle, Instrument, Trade
+
+INTERVALS = (1, 5, 60, 1440)  # minutes: 1m, 5m, 1h, 1d
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+Key = Tuple[int, int, datetime.datetime]
+
+
+def bucket_start(ts: datetime.datetime, interval_min: int) -> datetime.datetime:
+    seconds = int((ts - EPOCH).total_seconds())
+    return EPOCH + datetime.timedelta(seconds=seconds - seconds % (interval_min * 60))
+
+
+class Bar:
+    __slots__ = ("open", "high", "low", "close", "volume")
+
+    def __init__(self, price: Decimal, qty: Decimal):
+        self.open = self.high = self.low = self.close = price
+        self.volume = qty
+
+    def add(self, price: Decimal, qty: Decimal) -> None:
+        if price > self.high:
+            self.high = price
+        if price < self.low:
+            self.low = price
+        self.close = price
+        self.volume += qty
+
+
+def aggregate(trades: Iterable[Tuple[int, Decimal, Decimal, datetime.datetime]], bars: Optional[Dict[Key, Bar]] = None) -> Dict[Key, Bar]:
+    """Fold (instrument_id, price, quantity, timestamp) rows, in time order, into bars."""
+    bars = {} if bars is None else bars
+    for instrument_id, price, qty, ts in trades:
+        for interval in INTERVALS:
+            key = (instrument_id, interval, bucket_start(ts, interval))
+            bar = bars.get(key)
+            if bar is None:
+                bars[key] = Bar(price, qty)
+            else:
+                bar.add(price, qty)
+    return bars
+
+
+async def merge(db: AsyncSession, bars: Dict[Key, Bar]) -> None:
+    """Merge bars built from newer trades into the candles table."""
+    if not bars:
+        return
+    existing = {
+        (row.instrument_id, row.interval, row.ts): row
+        for row in await db.execute(
+            select(Candle.id, Candle.instrument_id, Candle.interval, Candle.ts, Candle.high, Candle.low, Candle.volume)
+            .where(tuple_(Candle.instrument_id, Candle.interval, Candle.ts).in_(list(bars)))
+        )
+    }
+    table = Candle.__table__
+    updates = []
+    inserts = []
+    for key, bar in bars.items():
+        row = existing.get(key)
+        if row is None:
+            inserts.append({
+                "instrument_id": key[0], "interval": key[1], "ts": key[2],
+                "open": bar.open, "high": bar.high, "low": bar.low, "close": bar.close, "volume": bar.volume,
+            })
+        else:
+            updates.append({
+                "c_id": row.id,
+                "high": max(bar.high, Decimal(row.high)),
+                "low": min(bar.low, Decimal(row.low)),
+                "close": bar.close,
+                "volume": Decimal(row.volume) + bar.volume,
+            })
+    if updates:
+        await db.execute(
+            update(table).where(table.c.id == bindparam("c_id")).values(
+                high=bindparam("high"), low=bindparam("low"), close=bindparam("close"), volume=bindparam("volume"),
+            ),
+            updates,
+        )
+    if inserts:
+        await db.execute(insert(table), inserts)
+
+
+async def get_candles(
+    db: AsyncSession, instrument_id: int,
+    interval_min: int,
+    start_time: datetime.datetime,
+    end_time: datetime.datetime,
+) -> List[Candle]:
+    if interval_min not in INTERVALS:
+        raise ValueError(f"interval must be one of {INTERVALS}")
+    res = await db.execute(
+        select(Candle)
+        .where(
+            Candle.instrument_id == instrument_id,
+            Candle.interval == interval_min,
+            Candle.ts >= bucket_start(start_time, interval_min),
+            Candle.ts <= end_time,
+        )
+        .order_by(Candle.ts.asc())
+    )
+    return res.scalars().all()
+
+
+async def rebuild(db: AsyncSession, instrument_id: int, chunk: int) -> int:
+    """Replace one instrument's candles with ones built from its trades; does not commit."""
+    await db.execute(delete(Candle).where(Candle.instrument_id == instrument_id))
+    # Keyset pagination over (timestamp, id) keeps memory to one chunk of
+    # trades and its bars however long the instrument's history is.
+    total = 0
+    last = None
+    while True:
+        q = select(Trade.id, Trade.price, Trade.quantity, Trade.timestamp).where(Trade.instrument_id == instrument_id)
+        if last is not None:
+            q = q.where(tuple_(Trade.timestamp, Trade.id) > last)
+        rows = (await db.execute(q.order_by(Trade.timestamp, Trade.id).limit(chunk))).all()
+        if not rows:
+            return total
+        await merge(db, aggregate(
+            (instrument_id, Decimal(r.price), Decimal(r.quantity), r.timestamp) for r in rows
+        ))
+        total += len(rows)
+        last = (rows[-1].timestamp, rows[-1].id)
+
+
+async def backfill(db: AsyncSession, instrument_id: Optional[int] = None, chunk: int = 10000) -> int:
+    """Rebuild candles from the trades table, one instrument per transaction.
+
+    Readers see an instrument's old candles until its rebuild commits, never
+    an empty or half-built series. Run it while matching is stopped: live
+    merges would otherwise be counted twice for the range being rebuilt.
+    """
+    if instrument_id is not None:
+        instrument_ids = [instrument_id]
+    else:
+        # Delisted instruments keep their row, and their trades.
+        instrument_ids = (await db.execute(select(Instrument.id).order_by(Instrument.id))).scalars().all()
+    total = 0
+    for i in instrument_ids:
+        total += await rebuild(db, i, chunk)
+        await db.commit()
+    return total
+
+
+async def main():
+    from app.database import AsyncSessionLocal
+
+    parser = argparse.ArgumentParser(description="Rebuild OHLCV candles from the trades table")
+    parser.add_argument("--ticker", help="only rebuild this instrument")
+    parser.add_argument("--chunk", type=int, default=10000)
+    args = parser.parse_args()
+
+    async with AsyncSessionLocal() as db:
+        instrument_id = None
+        if args.ticker:
+            instrument_id = (await db.execute(
+                select(Instrument.id).where(Instrument.symbol == args.ticker)
+            )).scalar_one_or_none()
+            if instrument_id is None:
+                raise SystemExit(f"unknown ticker {args.ticker}")
+        total = await backfill(db, instrument_id, args.chunk)
+    print(f"rebuilt candles from {total} trades")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,220 @@
+"""Record HTTP traffic to rotating NDJSON files for replay (bench/replay.py).
+
+One JSON object per request:
+
+    {"ts": 1718000000.123, "method": "POST", "path": "/api/v1/order",
+     "route": "/api/v1/order", "query": "", "body": "{...}",
+     "subject": "<user external id>", "admin": false,
+     "status": 200, "latency_ms": 1.92, "response": "{...}"}
+
+``subject`` is the external id of the authenticated user. The API key
+itself is never written; the replayer registers one user per subject.
+``response`` is kept for writes only (it carries the order ids that later
+cancels refer to). API keys in it (registration, admin user deletion) are
+replaced by ``"<redacted>"``; a response too long to parse is dropped if it
+may contain one.
+
+The middleware only builds the record and puts it on a bounded queue; a
+background task writes batches from a worker thread. When the writer
+falls behind, records are dropped and counted instead of slowing requests.
+"""
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import List, Optional
+
+from app import metrics
+from app.auth import token_cache
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+SECRET_FIELDS = ("api_key",)
+
+
+def scrub(value):
+    if isinstance(value, dict):
+        return {k: "<redacted>" if k in SECRET_FIELDS else scrub(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [scrub(v) for v in value]
+    return value
+
+
+def redact(body: bytes) -> str:
+    """Response body with every SECRET_FIELDS value replaced."""
+    if not any(f.encode() in body for f in SECRET_FIELDS):
+        return body.decode("utf-8", "replace")
+    try:
+        return json.dumps(scrub(json.loads(body)), separators=(",", ":"))
+    except ValueError:
+        # Truncated or not JSON: nothing can be kept safely.
+        return ""
+
+
+class CaptureWriter:
+    def __init__(self, directory: str, max_bytes: int, max_files: int, compress: bool, queue_size: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.compress = compress
+        self.queue_size = queue_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.file = None
+        self.files = 0
+        self.written = 0
+        self.records = 0
+        self.dropped = 0
+
+    def start(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self.queue = asyncio.Queue(self.queue_size)
+        self.task = asyncio.create_task(self._run(), name="capture-writer")
+
+    def put(self, record: dict) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            records = [await self.queue.get()]
+            while not self.queue.empty() and len(records) < 1000:
+                records.append(self.queue.get_nowait())
+            stop = None in records
+            if stop:
+                records = [r for r in records if r is not None]
+            try:
+                await loop.run_in_executor(None, self._write, records)
+                self.records += len(records)
+            except Exception:
+                logger.exception("capture writer failed, dropped %d records", len(records))
+                self.dropped += len(records)
+            if stop:
+                await loop.run_in_executor(None, self._close)
+                return
+
+    def _write(self, records: List[dict]) -> None:
+        data = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records).encode()
+        if self.file is None or self.written >= self.max_bytes:
+            self._rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.written += len(data)
+
+    def _rotate(self) -> None:
+        self._close()
+        # Names sort in write order, which is what retention and the replayer rely on.
+        self.files += 1
+        name = time.strftime("capture-%Y%m%dT%H%M%S", time.gmtime()) + f"-{os.getpid()}-{self.files:05d}.ndjson"
+        path = os.path.join(self.directory, name + (".gz" if self.compress else ""))
+        self.file = gzip.open(path, "wb") if self.compress else open(path, "wb")
+        self.written = 0
+        files = sorted(f for f in os.listdir(self.directory) if f.startswith("capture-"))
+        for old in files[:max(0, len(files) - self.max_files)]:
+            os.remove(os.path.join(self.directory, old))
+
+    def _close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    async def stop(self) -> None:
+        if self.task is None:
+            return
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+
+    def stats(self) -> dict:
+        return {"records": self.records, "dropped": self.dropped,
+                "queued": self.queue.qsize() if self.queue is not None else 0}
+
+
+capture_writer = CaptureWriter(
+    settings.CAPTURE_DIR,
+    settings.CAPTURE_MAX_BYTES,
+    settings.CAPTURE_MAX_FILES,
+    settings.CAPTURE_COMPRESS,
+    settings.CAPTURE_QUEUE,
+)
+
+metrics.Gauge(
+    "exchange_capture_records_total", "Captured requests",
+    lambda: ((("written",), capture_writer.records), (("dropped",), capture_writer.dropped)),
+    ("result",), type="counter",
+)
+
+
+def subject(scope) -> tuple:
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            token = value.decode("latin-1").partition(" ")[2]
+            # Read the cache directly: the request has just authenticated
+            # through it, and get() would count a hit.
+            entry = token_cache.entries.get(token)
+            if entry is not None:
+                return entry[0].external_id, entry[0].is_admin
+            return "token:" + hashlib.sha256(token.encode()).hexdigest()[:16], False
+    return None, False
+
+
+class CaptureMiddleware:
+    def __init__(self, app, writer: CaptureWriter = capture_writer, max_body: int = settings.CAPTURE_MAX_BODY):
+        self.app = app
+        self.writer = writer
+        self.max_body = max_body
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        ts = time.time()
+        body: List[bytes] = []
+        response: List[bytes] = []
+        status = [500]
+        keep_response = scope["method"] in WRITE_METHODS
+        max_body = self.max_body
+
+        async def receive_body():
+            message = await receive()
+            if message["type"] == "http.request" and sum(map(len, body)) < max_body:
+                body.append(message.get("body", b""))
+            return message
+
+        async def send_response(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            elif keep_response and message["type"] == "http.response.body" and sum(map(len, response)) < max_body:
+                response.append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_body, send_response)
+        finally:
+            latency = time.perf_counter() - started
+            route = scope.get("route")
+            who, admin = subject(scope)
+            record = {
+                "ts": ts,
+                "method": scope["method"],
+                "path": scope["path"],
+                "route": route.path if route is not None else None,
+                "query": scope["query_string"].decode("latin-1"),
+                "body": b"".join(body)[:max_body].decode("utf-8", "replace"),
+                "subject": who,
+                "admin": admin,
+                "status": status[0],
+                "latency_ms": round(latency * 1000, 3),
+            }
+            if keep_response:
+                record["response"] = redact(b"".join(response)[:max_body])
+            self.writer.put(record)
@@ -7,6 +7,41 @@ class Settings(BaseSettings):
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60
     ECHO_SQLALCHEMY: bool = Field(default=False)
+    DATABASE_REPLICA_URL: str = Field(default="")  # empty sends public reads to the primary
+    DB_POOL_SIZE: int = Field(default=5)  # per engine and process
+    DB_MAX_OVERFLOW: int = Field(default=10)
+    DB_POOL_TIMEOUT: float = Field(default=30.0)  # seconds to wait for a free connection
+    DB_POOL_RECYCLE: int = Field(default=-1)  # seconds; -1 keeps connections forever
+    DB_POOL_PRE_PING: bool = Field(default=False)  # one round trip per checkout; survives server restarts
+    DB_STATEMENT_CACHE_SIZE: int = Field(default=100)  # asyncpg, per connection
+    DB_PREPARED_STATEMENT_CACHE_SIZE: int = Field(default=100)  # SQLAlchemy asyncpg dialect, per connection
+    SEQUENCER_MAX_QUEUE: int = Field(default=0)  # per instrument, 0 = unbounded
+    PERSIST_BATCH_MS: float = Field(default=2.0)
+    PERSIST_BATCH_MAX_EVENTS: int = Field(default=1000)
+    AUTH_CACHE_SIZE: int = Field(default=100_000)  # 0 disables the token cache
+    AUTH_CACHE_TTL: float = Field(default=60.0)  # seconds; bounds staleness across workers
+    WS_SEND_QUEUE: int = Field(default=1000)  # messages buffered per subscriber before it is dropped
+    ORDER_BATCH_MAX: int = Field(default=100)  # orders per POST /order/batch
+    SHARD_COUNT: int = Field(default=0)  # 0 = match in the API process; N = route to N matching shards
+    SHARD_LEASE_TTL: float = Field(default=10.0)  # seconds a shard owner may go silent before failover
+    SHARD_RPC_TIMEOUT: float = Field(default=30.0)
+    JOURNAL_DIR: str = Field(default="")  # empty disables the matching journal
+    JOURNAL_SNAPSHOT_BATCHES: int = Field(default=10000)  # write-behind batches between snapshots
+    RESPONSE_CACHE_BYTES: int = Field(default=16 * 2**20)  # public GET responses; 0 disables
+    METRICS_ENABLED: bool = Field(default=True)  # histograms and GET /metrics
+    # Seconds between archiver passes inside the API process; 0 = off. Every
+    # worker would run its own loop, so leave it off and run one
+    # `python -m app.archive --loop` (the compose `archiver` service) instead.
+    ORDER_ARCHIVE_INTERVAL: float = Field(default=0.0)
+    ORDER_ARCHIVE_AFTER: float = Field(default=86400.0)  # seconds after an order filled or was cancelled before it is archived
+    ORDER_ARCHIVE_BATCH: int = Field(default=5000)  # orders moved per transaction
+    PARTITION_MONTHS_AHEAD: int = Field(default=2)  # monthly partitions created beyond the current one
+    CAPTURE_DIR: str = Field(default="")  # empty disables request capture
+    CAPTURE_MAX_BYTES: int = Field(default=64 * 2**20)  # per file before rotating (uncompressed)
+    CAPTURE_MAX_FILES: int = Field(default=50)  # oldest files are deleted beyond this
+    CAPTURE_COMPRESS: bool = Field(default=False)  # gzip the files
+    CAPTURE_QUEUE: int = Field(default=10000)  # records buffered before new ones are dropped
+    CAPTURE_MAX_BODY: int = Field(default=64 * 2**10)  # request/response bytes kept per record
 
     class Config:
         env_file = ".env"
@@ -4,17 +4,24 @@ from app.models import (
     Instrument, Balance, Order, Trade,
     OrderType, OrderStatus, Side, InstrumentType
 )
+from app import candles
+from app.instruments import registry
 from decimal import Decimal
 import datetime
 from typing import List, Optional, Dict
 
 
 # Instruments
-async def create_instrument(db: AsyncSession, symbol: str, name: str, instrument_type: InstrumentType) -> Instrument:
-    inst = Instrument(symbol=symbol, name=name, type=instrument_type)
+async def create_instrument(
+    db: AsyncSession, symbol: str, name: str, instrument_type: InstrumentType, tick_size: int = 1, lot_size: int = 1,
+) -> Instrument:
+    inst = Instrument(symbol=symbol, name=name, type=instrument_type, tick_size=tick_size, lot_size=lot_size)
     db.add(inst)
+    await db.flush()
+    await registry.notify(db, inst.id)
     await db.commit()
     await db.refresh(inst)
+    await registry.refresh(db, inst.id)
     return inst
 
 async def list_instruments(db: AsyncSession, listed_only: bool = True) -> List[Instrument]:
@@ -34,30 +41,15 @@ async def delist_instrument(db: AsyncSession, instrument_id: int) -> None:
         .where(Instrument.id == instrument_id)
         .values(is_listed=False)
     )
+    await registry.notify(db, instrument_id)
     await db.commit()
+    await registry.refresh(db, instrument_id)
 
 # Balances
 async def get_balances(db: AsyncSession, user_id: int) -> List[Balance]:
     res = await db.execute(select(Balance).where(Balance.user_id == user_id))
     return res.scalars().all()
 
-async def adjust_balance(db: AsyncSession, user_id: int, instrument_id: int, delta: Decimal) -> Balance:
-    res = await db.execute(
-        select(Balance).where(
-            Balance.user_id == user_id,
-            Balance.instrument_id == instrument_id
-        )
-    )
-    bal = res.scalar_one_or_none()
-    if not bal:
-        bal = Balance(user_id=user_id, instrument_id=instrument_id, amount=delta)
-        db.add(bal)
-    else:
-        bal.amount += delta
-    await db.commit()
-    await db.refresh(bal)
-    return bal
-
 # Orders
 async def place_order(
     db: AsyncSession,
@@ -162,23 +154,15 @@ async def get_candles(
     start_time: datetime.datetime,
     end_time: datetime.datetime
 ) -> List[dict]:
-    trades = await get_trades(db, instrument_id, start_time, end_time, limit=10000)
-    buckets = {}
-    for t in trades:
-        ts = t.timestamp.replace(second=0, microsecond=0)
-        minutes = (ts.minute // interval_min) * interval_min
-        bucket_ts = ts.replace(minute=minutes)
-        buckets.setdefault(bucket_ts, []).append(t)
-    candles = []
-    for ts, lst in sorted(buckets.items()):
-        prices = [float(t.price) for t in lst]
-        qtys   = [float(t.quantity) for t in lst]
-        candles.append({
-            "ts": ts,
-            "open": prices[0],
-            "high": max(prices),
-            "low": min(prices),
-            "close": prices[-1],
-            "volume": sum(qtys)
-        })
-    return candles
+    rows = await candles.get_candles(db, instrument_id, interval_min, start_time, end_time)
+    return [
+        {
+            "ts": c.ts,
+            "open": float(c.open),
+            "high": float(c.high),
+            "low": float(c.low),
+            "close": float(c.close),
+            "volume": float(c.volume),
+        }
+        for c in rows
+    ]
@@ -1,10 +1,46 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from app.config import settings
+from app import metrics
+import time
 
-engine = create_async_engine(settings.DATABASE_URL, future=True, echo=settings.ECHO_SQLALCHEMY)
+
+def engine_options(url: str) -> dict:
+    options = dict(
+        future=True,
+        echo=settings.ECHO_SQLALCHEMY,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+    )
+    if url.startswith("postgresql+asyncpg"):
+        # asyncpg's own statement cache, and SQLAlchemy's per-connection cache
+        # of prepared statements on top of it. Both must be 0 behind pgbouncer
+        # in transaction mode.
+        options["connect_args"] = {
+            "statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
+            "prepared_statement_cache_size": settings.DB_PREPARED_STATEMENT_CACHE_SIZE,
+        }
+    return options
+
+
+engine = create_async_engine(settings.DATABASE_URL, **engine_options(settings.DATABASE_URL))
 AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# Public reads that tolerate replication lag go to the replica when one is
+# configured, and to the primary otherwise.
+if settings.DATABASE_REPLICA_URL:
+    read_engine = create_async_engine(settings.DATABASE_REPLICA_URL, **engine_options(settings.DATABASE_REPLICA_URL))
+else:
+    read_engine = engine
+ReadSessionLocal = sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
+
 async def get_db():
-    async with AsyncSessionLocal() as session:
-        yield session
+    started = time.perf_counter()
+    try:
+        async with AsyncSessionLocal() as session:
+            yield session
+    finally:
+        metrics.DB_SESSION.observe(time.perf_counter() - started)
@@ -0,0 +1,300 @@
+import asyncio
+import datetime
+import logging
+import time
+import uuid
+from typing import Dict, List, Optional, Set, Union
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import metrics
+from app.database import AsyncSessionLocal
+from app.ledger import InsufficientBalance, ledger
+from app.marketdata import hub
+from app.matching import RestingOrder, matching_engine, order_status
+from app.models import OrderStatus, OrderType, Side
+from app.persistence import BalanceDelta, CancelOrders, NewOrder, NewTrade, OrderAmend, OrderUpdate, write_behind
+from app.sequencer import sequencer
+
+logger = logging.getLogger(__name__)
+
+
+class OrderNotActive(Exception):
+    pass
+
+
+class InvalidAmend(Exception):
+    pass
+
+
+def persisted() -> asyncio.Future:
+    # Resolves once everything submitted so far is committed.
+    return write_behind.submit([])
+
+
+def execute_against_book(incoming: RestingOrder, order_type: OrderType, amended: bool = False) -> list:
+    book = matching_engine.book(incoming.instrument_id)
+    fills = book.match(incoming)
+
+    now = datetime.datetime.utcnow()
+    hub.publish(book, fills, now)
+    status = order_status(incoming, order_type)
+    if amended:
+        head = OrderAmend(
+            order=incoming,
+            price=incoming.price,
+            quantity=incoming.quantity,
+            priority_at=incoming.priority_at,
+            status=status,
+            filled=incoming.filled,
+        )
+    else:
+        head = NewOrder(order=incoming, type=order_type, status=status, filled=incoming.filled)
+    mutations = [head]
+    for fill in fills:
+        maker = fill.maker
+        buy, sell = (incoming, maker) if incoming.side == Side.BUY else (maker, incoming)
+        mutations.append(OrderUpdate(
+            order=maker,
+            status=OrderStatus.FILLED if maker.remaining <= 0 else OrderStatus.PARTIAL,
+            filled=maker.filled,
+        ))
+        mutations.append(NewTrade(
+            buy=buy,
+            sell=sell,
+            instrument_id=incoming.instrument_id,
+            price=fill.price,
+            quantity=fill.quantity,
+            timestamp=now,
+        ))
+        mutations.append(BalanceDelta(buy.user_id, incoming.instrument_id, fill.quantity))
+        mutations.append(BalanceDelta(sell.user_id, incoming.instrument_id, -fill.quantity))
+        ledger.settle(buy.user_id, sell.user_id, incoming.instrument_id, fill.quantity)
+
+    if incoming.side == Side.SELL and incoming.remaining > 0 and order_type == OrderType.MARKET:
+        ledger.release(incoming.user_id, incoming.instrument_id, incoming.remaining)
+    return mutations
+
+
+def new_order(
+    user_id: int,
+    instrument_id: int,
+    side: Side,
+    quantity: int,
+    price: Optional[int] = None,
+) -> RestingOrder:
+    return RestingOrder(
+        id=None,
+        external_id=str(uuid.uuid4()),
+        user_id=user_id,
+        instrument_id=instrument_id,
+        side=side,
+        price=price,
+        quantity=quantity,
+        filled=0,
+        created_at=datetime.datetime.utcnow(),
+    )
+
+
+async def accept(order: RestingOrder, order_type: OrderType) -> list:
+    # Must run inside the order's instrument lane.
+    started = time.perf_counter()
+    if order.side == Side.SELL:
+        await ledger.ensure(order.user_id, order.instrument_id, persisted)
+        ledger.hold(order.user_id, order.instrument_id, order.quantity)
+        matched = time.perf_counter()
+        metrics.ORDER_STAGE.observe(matched - started, "balance")
+        started = matched
+    mutations = execute_against_book(order, order_type)
+    metrics.ORDER_STAGE.observe(time.perf_counter() - started, "match")
+    return mutations
+
+
+async def place_order(
+    user_id: int,
+    instrument_id: int,
+    order_type: OrderType,
+    side: Side,
+    quantity: int,
+    price: Optional[int] = None,
+) -> RestingOrder:
+    order = new_order(user_id, instrument_id, side, quantity, price)
+
+    async def match():
+        return write_behind.submit(await accept(order, order_type))
+
+    durable = await sequencer.submit(instrument_id, match)
+    started = time.perf_counter()
+    await durable
+    metrics.ORDER_STAGE.observe(time.perf_counter() - started, "persist")
+    return order
+
+
+async def place_orders(orders: List[RestingOrder], order_types: List[OrderType]) -> List[Union[RestingOrder, Exception]]:
+    """Match a batch of orders; one lane job and one write-behind submit per instrument.
+
+    Orders for the same instrument are matched in the given order. Each entry
+    of the result is either the accepted order or the exception that rejected it.
+    """
+    results: List[Union[RestingOrder, Exception]] = [None] * len(orders)
+    groups: Dict[int, List[int]] = {}
+    for i, order in enumerate(orders):
+        groups.setdefault(order.instrument_id, []).append(i)
+
+    async def run(instrument_id: int, indexes: List[int]):
+        async def match():
+            mutations = []
+            for i in indexes:
+                try:
+                    mutations += await accept(orders[i], order_types[i])
+                    results[i] = orders[i]
+                except InsufficientBalance as e:
+                    results[i] = e
+            return write_behind.submit(mutations)
+
+        try:
+            durable = await sequencer.submit(instrument_id, match)
+            await durable
+        except Exception as e:
+            for i in indexes:
+                if not isinstance(results[i], InsufficientBalance):
+                    results[i] = e
+
+    await asyncio.gather(*(run(k, v) for k, v in groups.items()))
+    return results
+
+
+def withdraw(instrument_id: int, external_id: str) -> RestingOrder:
+    # Must run inside the order's instrument lane. The book is authoritative:
+    # an order that is no longer resting there has been filled by a job
+    # sequenced ahead of this one.
+    order = matching_engine.remove(instrument_id, external_id)
+    if order is None:
+        raise OrderNotActive(external_id)
+    if order.side == Side.SELL:
+        ledger.release(order.user_id, instrument_id, order.remaining)
+    hub.publish(matching_engine.book(instrument_id))
+    return order
+
+
+async def amend(instrument_id: int, external_id: str, quantity: Optional[int], price: Optional[int]) -> list:
+    # Must run inside the order's instrument lane. quantity is the new total,
+    # filled part included.
+    book = matching_engine.book(instrument_id)
+    order = book.orders.get(external_id)
+    if order is None:
+        raise OrderNotActive(external_id)
+    quantity = order.quantity if quantity is None else quantity
+    price = order.price if price is None else price
+    if quantity <= order.filled:
+        raise InvalidAmend("Quantity must be greater than the filled quantity")
+
+    if price == order.price and quantity <= order.quantity:
+        # Same price, smaller size: amended in place, keeping time priority.
+        released = order.quantity - quantity
+        book.reduce(order, released)
+        if order.side == Side.SELL:
+            ledger.release(order.user_id, instrument_id, released)
+        hub.publish(book)
+        return [OrderAmend(
+            order=order,
+            price=order.price,
+            quantity=order.quantity,
+            priority_at=order.priority_at,
+            status=OrderStatus.PARTIAL if order.filled else OrderStatus.NEW,
+            filled=order.filled,
+        )]
+
+    # A new price or a larger size re-queues: the order leaves the book and
+    # comes back through matching as if it had just arrived.
+    if order.side == Side.SELL:
+        extra = quantity - order.quantity
+        if extra > 0:
+            await ledger.ensure(order.user_id, instrument_id, persisted)
+            ledger.hold(order.user_id, instrument_id, extra)
+        elif extra < 0:
+            ledger.release(order.user_id, instrument_id, -extra)
+    book.remove(external_id)
+    order.price = price
+    order.quantity = quantity
+    order.priority_at = datetime.datetime.utcnow()
+    return execute_against_book(order, OrderType.LIMIT, amended=True)
+
+
+async def amend_order(instrument_id: int, external_id: str, quantity: Optional[int], price: Optional[int]) -> None:
+    async def run():
+        return write_behind.submit(await amend(instrument_id, external_id, quantity, price))
+
+    durable = await sequencer.submit(instrument_id, run)
+    started = time.perf_counter()
+    await durable
+    metrics.ORDER_STAGE.observe(time.perf_counter() - started, "persist")
+
+
+async def cancel_order(instrument_id: int, external_id: str) -> RestingOrder:
+    async def cancel():
+        order = withdraw(instrument_id, external_id)
+        return order, write_behind.submit([CancelOrders([order])])
+
+    order, durable = await sequencer.submit(instrument_id, cancel)
+    await durable
+    return order
+
+
+async def cancel_user_orders(user_id: int, instrument_id: int) -> List[RestingOrder]:
+    async def cancel():
+        book = matching_engine.book(instrument_id)
+        orders = [o for o in book.orders.values() if o.user_id == user_id]
+        if not orders:
+            return orders, persisted()
+        for order in orders:
+            book.remove(order.external_id)
+            if order.side == Side.SELL:
+                ledger.release(user_id, instrument_id, order.remaining)
+        hub.publish(book)
+        return orders, write_behind.submit([CancelOrders(orders)])
+
+    orders, durable = await sequencer.submit(instrument_id, cancel)
+    await durable
+    return orders
+
+
+async def adjust_balance(user_id: int, instrument_id: int, delta: int) -> None:
+    async def adjust():
+        e = await ledger.ensure(user_id, instrument_id, persisted)
+        if delta < 0 and e.available < -delta:
+            raise InsufficientBalance((user_id, instrument_id))
+        ledger.credit(user_id, instrument_id, delta)
+        return write_behind.submit([BalanceDelta(user_id, instrument_id, delta)])
+
+    durable = await sequencer.submit(instrument_id, adjust)
+    await durable
+
+
+async def load_books(db: AsyncSession, instrument_id: Optional[int] = None) -> None:
+    await matching_engine.load(db, instrument_id)
+    books = [matching_engine.book(instrument_id)] if instrument_id is not None else matching_engine.books.values()
+    for book in books:
+        ledger.rebuild_locks(book.instrument_id, book.orders.values())
+
+
+async def reload_books(instrument_ids: Set[int]) -> None:
+    for instrument_id in instrument_ids:
+        async def reload(instrument_id=instrument_id):
+            async with AsyncSessionLocal() as db:
+                await load_books(db, instrument_id)
+            ledger.forget(instrument_id)
+            hub.resync(instrument_id)
+        try:
+            await sequencer.submit(instrument_id, reload)
+        except Exception:
+            logger.exception("failed to reload book for instrument %s", instrument_id)
+
+
+def on_persist_failure(instrument_ids: Set[int]) -> None:
+    # A failed batch leaves the books ahead of the database: rebuild them from
+    # what was actually committed, in sequence with any further matching.
+    asyncio.get_running_loop().create_task(reload_books(instrument_ids))
+
+
+write_behind.failure_hooks.append(on_persist_failure)
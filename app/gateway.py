@@ -0,0 +1,319 @@
+import asyncio
+import itertools
+import json
+import struct
+from typing import AsyncIterator, Dict, List, Optional, Union
+
+from sqlalchemy import func, select
+
+from app import exchange
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.exchange import InsufficientBalance, InvalidAmend, OrderNotActive
+from app.marketdata import hub, l2_snapshot
+from app.models import OrderType, ShardLease, Side
+
+FRAME = struct.Struct("!I")
+
+
+class ShardUnavailable(Exception):
+    pass
+
+
+class SlowConsumer(Exception):
+    pass
+
+
+class NotOwner(Exception):
+    pass
+
+
+ERRORS = {
+    "insufficient_balance": InsufficientBalance,
+    "not_active": OrderNotActive,
+    "invalid_amend": InvalidAmend,
+    "not_owner": NotOwner,
+    "slow_consumer": SlowConsumer,
+}
+
+
+def error_code(e: Exception) -> str:
+    for code, cls in ERRORS.items():
+        if isinstance(e, cls):
+            return code
+    return "internal"
+
+
+def shard_of(instrument_id: int, count: Optional[int] = None) -> int:
+    return instrument_id % (count or settings.SHARD_COUNT)
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[dict]:
+    try:
+        (size,) = FRAME.unpack(await reader.readexactly(FRAME.size))
+        return json.loads(await reader.readexactly(size))
+    except asyncio.IncompleteReadError:
+        return None
+
+
+def write_frame(writer: asyncio.StreamWriter, payload: dict) -> None:
+    body = json.dumps(payload, separators=(",", ":"), default=str).encode()
+    writer.write(FRAME.pack(len(body)) + body)
+
+
+async def open_connection(address: str):
+    """`address` is unix:/path/to.sock or tcp:host:port."""
+    scheme, _, rest = address.partition(":")
+    if scheme == "unix":
+        return await asyncio.open_unix_connection(rest)
+    host, _, port = rest.rpartition(":")
+    return await asyncio.open_connection(host, int(port))
+
+
+class LocalGateway:
+    """Runs exchange operations in this process.
+
+    Every method takes and returns plain values so the same calls can be
+    served to API workers by a shard process.
+    """
+
+    async def place_order(self, user_id: int, instrument_id: int, order_type, side, quantity, price=None) -> str:
+        order = await exchange.place_order(
+            user_id, instrument_id, OrderType(order_type), Side(side), quantity, price,
+        )
+        return order.external_id
+
+    async def place_orders(self, user_id: int, items: List[dict]) -> List[Union[str, Exception]]:
+        orders = [
+            exchange.new_order(user_id, i["instrument_id"], Side(i["side"]), i["quantity"], i["price"])
+            for i in items
+        ]
+        results = await exchange.place_orders(orders, [OrderType(i["order_type"]) for i in items])
+        return [r if isinstance(r, Exception) else r.external_id for r in results]
+
+    async def amend_order(self, instrument_id: int, external_id: str, quantity=None, price=None) -> None:
+        await exchange.amend_order(instrument_id, external_id, quantity, price)
+
+    async def cancel_order(self, instrument_id: int, external_id: str) -> None:
+        await exchange.cancel_order(instrument_id, external_id)
+
+    async def cancel_user_orders(self, user_id: int, instrument_id: int) -> List[str]:
+        return [o.external_id for o in await exchange.cancel_user_orders(user_id, instrument_id)]
+
+    async def adjust_balance(self, user_id: int, instrument_id: int, delta) -> None:
+        await exchange.adjust_balance(user_id, instrument_id, delta)
+
+    async def l2_snapshot(self, instrument_id: int, limit: int) -> bytes:
+        return l2_snapshot(instrument_id, limit)
+
+    async def stream(self, instrument_id: int, ticker: str) -> AsyncIterator[str]:
+        sub, snapshot = hub.subscribe(instrument_id, ticker)
+        try:
+            yield snapshot
+            while True:
+                batch = await sub.next_batch()
+                if sub.dropped:
+                    raise SlowConsumer(ticker)
+                for message in batch:
+                    yield message
+        finally:
+            hub.unsubscribe(instrument_id, sub)
+
+    async def stop(self) -> None:
+        pass
+
+
+class ShardConnection:
+    """One multiplexed connection to a shard; replies are matched by request id."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.ids = itertools.count()
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.closed = False
+        self.task = asyncio.create_task(self._read())
+
+    async def _read(self):
+        try:
+            while True:
+                frame = await read_frame(self.reader)
+                if frame is None:
+                    break
+                future = self.pending.pop(frame["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(frame)
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ShardUnavailable("connection to shard lost"))
+            self.pending.clear()
+
+    async def request(self, op: str, args: dict) -> dict:
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            write_frame(self.writer, {"id": request_id, "op": op, "args": args})
+            await self.writer.drain()
+            return await asyncio.wait_for(future, settings.SHARD_RPC_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            raise ShardUnavailable(op)
+        finally:
+            self.pending.pop(request_id, None)
+
+    def close(self) -> None:
+        self.closed = True
+        self.writer.close()
+        self.task.cancel()
+
+
+class ShardedGateway:
+    """Routes each operation to the process that owns the instrument's shard.
+
+    Owners and their addresses come from the shard_leases table. A request is
+    only retried when it certainly did not run: the shard could not be reached,
+    or it answered that it does not own the instrument (any more).
+    """
+
+    attempts = 5
+    # Safe to resend when the connection died with the request in flight.
+    idempotent = {"l2_snapshot"}
+
+    def __init__(self, count: int):
+        self.count = count
+        self.connections: Dict[int, ShardConnection] = {}
+        self.locks: Dict[int, asyncio.Lock] = {}
+
+    async def address(self, shard: int) -> Optional[str]:
+        async with AsyncSessionLocal() as db:
+            return (await db.execute(
+                select(ShardLease.address).where(ShardLease.shard_id == shard, ShardLease.expires_at > func.now())
+            )).scalar_one_or_none()
+
+    async def connection(self, shard: int) -> ShardConnection:
+        conn = self.connections.get(shard)
+        if conn is not None and not conn.closed:
+            return conn
+        async with self.locks.setdefault(shard, asyncio.Lock()):
+            conn = self.connections.get(shard)
+            if conn is None or conn.closed:
+                address = await self.address(shard)
+                if address is None:
+                    raise ShardUnavailable(f"shard {shard} has no owner")
+                try:
+                    conn = self.connections[shard] = ShardConnection(*await open_connection(address))
+                except OSError:
+                    raise ShardUnavailable(f"shard {shard} unreachable at {address}")
+        return conn
+
+    def forget(self, shard: int) -> None:
+        conn = self.connections.pop(shard, None)
+        if conn is not None:
+            conn.close()
+
+    async def call(self, instrument_id: int, op: str, /, **args):
+        shard = shard_of(instrument_id, self.count)
+        for attempt in range(self.attempts):
+            if attempt:
+                # Give a standby time to take over the lease.
+                await asyncio.sleep(min(0.1 * 2 ** attempt, settings.SHARD_LEASE_TTL))
+            try:
+                conn = await self.connection(shard)
+            except ShardUnavailable:
+                continue
+            try:
+                frame = await conn.request(op, args)
+            except ShardUnavailable:
+                if op not in self.idempotent:
+                    raise
+                self.forget(shard)
+                continue
+            error = frame.get("error")
+            if error is None:
+                return frame.get("result")
+            if error == "not_owner":
+                self.forget(shard)
+                continue
+            raise ERRORS.get(error, RuntimeError)(frame.get("detail", error))
+        raise ShardUnavailable(f"shard {shard} unavailable")
+
+    async def place_order(self, user_id: int, instrument_id: int, order_type, side, quantity, price=None) -> str:
+        return await self.call(
+            instrument_id, "place_order", user_id=user_id, instrument_id=instrument_id,
+            order_type=order_type, side=side, quantity=quantity, price=price,
+        )
+
+    async def place_orders(self, user_id: int, items: List[dict]) -> List[Union[str, Exception]]:
+        results: List[Union[str, Exception]] = [None] * len(items)
+        groups: Dict[int, List[int]] = {}
+        for i, item in enumerate(items):
+            groups.setdefault(shard_of(item["instrument_id"], self.count), []).append(i)
+
+        async def run(indexes: List[int]):
+            try:
+                out = await self.call(
+                    items[indexes[0]]["instrument_id"], "place_orders",
+                    user_id=user_id, items=[items[i] for i in indexes],
+                )
+            except Exception as e:
+                out = [e] * len(indexes)
+            for i, r in zip(indexes, out):
+                if isinstance(r, dict):
+                    r = ERRORS.get(r["error"], RuntimeError)(r["error"])
+                results[i] = r
+
+        await asyncio.gather(*(run(v) for v in groups.values()))
+        return results
+
+    async def amend_order(self, instrument_id: int, external_id: str, quantity=None, price=None) -> None:
+        await self.call(
+            instrument_id, "amend_order", instrument_id=instrument_id, external_id=external_id,
+            quantity=quantity, price=price,
+        )
+
+    async def cancel_order(self, instrument_id: int, external_id: str) -> None:
+        await self.call(instrument_id, "cancel_order", instrument_id=instrument_id, external_id=external_id)
+
+    async def cancel_user_orders(self, user_id: int, instrument_id: int) -> List[str]:
+        return await self.call(instrument_id, "cancel_user_orders", user_id=user_id, instrument_id=instrument_id)
+
+    async def adjust_balance(self, user_id: int, instrument_id: int, delta) -> None:
+        await self.call(instrument_id, "adjust_balance", user_id=user_id, instrument_id=instrument_id, delta=delta)
+
+    async def l2_snapshot(self, instrument_id: int, limit: int) -> str:
+        return await self.call(instrument_id, "l2_snapshot", instrument_id=instrument_id, limit=limit)
+
+    async def stream(self, instrument_id: int, ticker: str) -> AsyncIterator[str]:
+        # Subscriptions get a connection of their own so a busy feed cannot
+        # hold up request replies.
+        shard = shard_of(instrument_id, self.count)
+        address = await self.address(shard)
+        if address is None:
+            raise ShardUnavailable(f"shard {shard} has no owner")
+        try:
+            reader, writer = await open_connection(address)
+        except OSError:
+            raise ShardUnavailable(f"shard {shard} unreachable at {address}")
+        try:
+            write_frame(writer, {"id": 0, "op": "stream", "args": {"instrument_id": instrument_id, "ticker": ticker}})
+            await writer.drain()
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    raise ShardUnavailable(f"shard {shard} closed the stream")
+                if "error" in frame:
+                    raise ERRORS.get(frame["error"], ShardUnavailable)(frame["error"])
+                yield frame["message"]
+        finally:
+            writer.close()
+
+    async def stop(self) -> None:
+        for shard in list(self.connections):
+            self.forget(shard)
+
+
+gateway = ShardedGateway(settings.SHARD_COUNT) if settings.SHARD_COUNT else LocalGateway()
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from app.matching import to_units
+from app.models import Instrument
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "instrument_changed"
+COLUMNS = (Instrument.id, Instrument.symbol, Instrument.name, Instrument.is_listed, Instrument.tick_size, Instrument.lot_size)
+
+
+class InstrumentInfo:
+    __slots__ = ("id", "symbol", "name", "is_listed", "tick", "lot")
+
+    def __init__(self, id: int, symbol: str, name: str, is_listed: bool, tick: int, lot: int):
+        self.id = id
+        self.symbol = symbol
+        self.name = name
+        self.is_listed = is_listed
+        # Engine units, see app.matching.SCALE.
+        self.tick = tick
+        self.lot = lot
+
+    @classmethod
+    def from_row(cls, row) -> "InstrumentInfo":
+        return cls(row.id, row.symbol, row.name, bool(row.is_listed), to_units(row.tick_size), to_units(row.lot_size))
+
+
+class InstrumentRegistry:
+    """In-process symbol <-> id <-> listed-state map.
+
+    Loaded once at startup. Writers call notify() in the transaction that
+    changes an instrument; every worker LISTENs on the channel and re-reads
+    that one row, so ticker lookups on request paths never hit the database.
+    """
+
+    def __init__(self):
+        self.by_symbol: Dict[str, InstrumentInfo] = {}
+        self.by_id: Dict[int, InstrumentInfo] = {}
+        self.task: Optional[asyncio.Task] = None
+        self.pending = set()
+        # Called with the changed instrument id, or None after a full reload.
+        self.listeners: List[Callable[[Optional[int]], None]] = []
+        # Other channels delivered over the same LISTEN connection: channel -> callback(payload).
+        self.channels: Dict[str, Callable[[str], None]] = {}
+
+    def get(self, symbol: str) -> Optional[InstrumentInfo]:
+        return self.by_symbol.get(symbol)
+
+    def listed(self, symbol: str) -> Optional[InstrumentInfo]:
+        info = self.by_symbol.get(symbol)
+        return info if info is not None and info.is_listed else None
+
+    def symbol(self, instrument_id: int) -> Optional[str]:
+        info = self.by_id.get(instrument_id)
+        return info.symbol if info is not None else None
+
+    def all_listed(self) -> List[InstrumentInfo]:
+        return [i for i in self.by_id.values() if i.is_listed]
+
+    def put(self, info: InstrumentInfo) -> None:
+        old = self.by_id.get(info.id)
+        if old is not None and old.symbol != info.symbol:
+            self.by_symbol.pop(old.symbol, None)
+        self.by_id[info.id] = info
+        self.by_symbol[info.symbol] = info
+
+    async def load(self, db: AsyncSession) -> None:
+        rows = (await db.execute(select(*COLUMNS).order_by(Instrument.id))).all()
+        by_id = {r.id: InstrumentInfo.from_row(r) for r in rows}
+        self.by_id = by_id
+        self.by_symbol = {i.symbol: i for i in by_id.values()}
+        self._changed(None)
+
+    async def refresh(self, db: AsyncSession, instrument_id: int) -> None:
+        row = (await db.execute(select(*COLUMNS).where(Instrument.id == instrument_id))).one_or_none()
+        if row is not None:
+            self.put(InstrumentInfo.from_row(row))
+        else:
+            old = self.by_id.pop(instrument_id, None)
+            if old is not None:
+                self.by_symbol.pop(old.symbol, None)
+        self._changed(instrument_id)
+
+    def _changed(self, instrument_id: Optional[int]) -> None:
+        for listener in self.listeners:
+            listener(instrument_id)
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]) -> None:
+        """Listen on another channel; call before start()."""
+        self.channels[channel] = callback
+
+    async def notify(self, db: AsyncSession, instrument_id: int) -> None:
+        # Delivered to listeners when (and only if) the caller's transaction commits.
+        if db.bind.dialect.name == "postgresql":
+            await db.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": CHANNEL, "payload": str(instrument_id)})
+
+    def start(self, engine: AsyncEngine, session_factory) -> None:
+        if engine.dialect.name == "postgresql" and self.task is None:
+            self.task = asyncio.create_task(self._listen(engine, session_factory), name="instrument-registry")
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _listen(self, engine: AsyncEngine, session_factory) -> None:
+        loop = asyncio.get_running_loop()
+
+        async def apply(instrument_id: int):
+            async with session_factory() as db:
+                await self.refresh(db, instrument_id)
+
+        def on_notify(conn, pid, channel, payload):
+            task = loop.create_task(apply(int(payload)))
+            self.pending.add(task)
+            task.add_done_callback(self.pending.discard)
+
+        def on_other(conn, pid, channel, payload):
+            self.channels[channel](payload)
+
+        channels = {CHANNEL: on_notify, **{channel: on_other for channel in self.channels}}
+
+        while True:
+            lost = asyncio.Event()
+            try:
+                async with engine.connect() as conn:
+                    raw = (await conn.get_raw_connection()).driver_connection
+                    raw.add_termination_listener(lambda c: loop.call_soon_threadsafe(lost.set))
+                    for channel, callback in channels.items():
+                        await raw.add_listener(channel, callback)
+                    try:
+                        # Anything changed while we were not listening is picked up here.
+                        async with session_factory() as db:
+                            await self.load(db)
+                        await lost.wait()
+                    finally:
+                        if not raw.is_closed():
+                            for channel, callback in channels.items():
+                                await raw.remove_listener(channel, callback)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("instrument registry listener failed, reconnecting")
+            await asyncio.sleep(1.0)
+
+
+registry = InstrumentRegistry()
@@ -0,0 +1,502 @@
+"""Append-only journal of committed matching state, with snapshots.
+
+Every write-behind batch that touches a journal stream bumps the stream's
+watermark in journal_state inside the batch's own transaction, and after
+commit appends the batch's records plus a COMMIT record with one fsync. The
+journal therefore never runs ahead of the database; it can only lag it by
+the last batch if the process dies between commit and fsync.
+
+On startup the latest snapshot is loaded and the journal tail replayed. The
+result is used only if its last complete batch equals the watermark in the
+database; otherwise the books are loaded from Postgres as before and a fresh
+snapshot is written. Snapshots are rebuilt from the files in a worker thread
+every JOURNAL_SNAPSHOT_BATCHES batches.
+
+    python -m app.journal verify    # compare journalled fills with trades
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import mmap
+import os
+import struct
+import uuid
+import zlib
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.gateway import shard_of
+from app.ledger import ledger
+from app.matching import OrderBook, RestingOrder, from_units, matching_engine, to_units
+from app.models import Balance, JournalState, OrderStatus, OrderType, Side, Trade
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# batch, kind, side, type, status, instrument_id, user_id, ts (us), external_id,
+# id_a, id_b, price, qty, filled -- prefixed with a crc32 of these bytes.
+# Amounts are engine units (app.matching.SCALE).
+BODY = struct.Struct("<QBBBBIIq16sqqqqq")
+RECORD = struct.Struct("<I" + BODY.format[1:])
+SNAPSHOT_HEADER = struct.Struct("<8sQQQ")  # magic, batch, orders, balances
+MAGIC = b"EXSNAP01"
+
+ACCEPT, UPDATE, CANCEL, FILL, BALANCE, COMMIT, AMEND = range(1, 8)
+
+SIDES = list(Side)
+TYPES = list(OrderType)
+STATUSES = list(OrderStatus)
+ACTIVE = {STATUSES.index(OrderStatus.NEW), STATUSES.index(OrderStatus.PARTIAL)}
+LIMIT = TYPES.index(OrderType.LIMIT)
+NO_ID = bytes(16)
+
+
+def micros(ts: Optional[datetime.datetime]) -> int:
+    return 0 if ts is None else (ts - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def from_micros(value: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+def encode(batch: int, kind: int, side=0, type_=0, status=0, instrument_id=0, user_id=0, ts=0,
+           external_id=NO_ID, id_a=0, id_b=0, price=0, qty=0, filled=0) -> bytes:
+    body = BODY.pack(batch, kind, side, type_, status, instrument_id, user_id, ts, external_id, id_a, id_b, price, qty, filled)
+    return struct.pack("<I", zlib.crc32(body)) + body
+
+
+def iter_records(buf, start: int = 0) -> Iterator[tuple]:
+    """Decode records until the end of ``buf`` or the first torn/corrupt one."""
+    size = RECORD.size
+    with memoryview(buf) as view:
+        end = start + (len(view) - start) // size * size
+        for offset in range(start, end, size):
+            if struct.unpack_from("<I", view, offset)[0] != zlib.crc32(view[offset + 4:offset + size]):
+                return
+            yield RECORD.unpack_from(view, offset)[1:]
+
+
+def read_mapped(path: str, start: int = 0) -> Iterator[tuple]:
+    if os.path.getsize(path) <= start:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        yield from iter_records(m, start)
+
+
+class State:
+    """Active limit orders and balance totals, in engine units."""
+
+    def __init__(self, batch: int = 0):
+        self.batch = batch
+        # external_id -> [id, user_id, instrument_id, side, price, qty, filled, ts, priority ts]
+        self.orders: Dict[bytes, list] = {}
+        self.balances: Dict[Tuple[int, int], int] = {}
+
+    def apply(self, r: tuple) -> None:
+        _, kind, side, type_, status, instrument_id, user_id, ts, ext, id_a, id_b, price, qty, filled = r
+        if kind == ACCEPT:
+            if type_ == LIMIT and status in ACTIVE:
+                # id_b carries the priority time of an amended order, 0 if none.
+                self.orders[ext] = [id_a, user_id, instrument_id, side, price, qty, filled, ts, id_b or ts]
+        elif kind == UPDATE:
+            o = self.orders.get(ext)
+            if o is not None:
+                if status in ACTIVE:
+                    o[6] = filled
+                else:
+                    del self.orders[ext]
+        elif kind == AMEND:
+            o = self.orders.get(ext)
+            if o is not None:
+                # ts is the new priority time, 0 when the order kept its place.
+                o[4], o[5] = price, qty
+                if ts:
+                    o[8] = ts
+        elif kind == CANCEL:
+            self.orders.pop(ext, None)
+        elif kind == BALANCE:
+            key = (user_id, instrument_id)
+            self.balances[key] = self.balances.get(key, 0) + qty
+
+    def replay(self, records: Iterable[tuple]) -> None:
+        # Records only count once their batch's COMMIT record made it to disk,
+        # and batches must follow each other without gaps.
+        pending: List[tuple] = []
+        for r in records:
+            batch = r[0]
+            if batch <= self.batch:
+                continue
+            if batch != self.batch + 1:
+                break
+            if r[1] == COMMIT:
+                for p in pending:
+                    self.apply(p)
+                pending = []
+                self.batch = batch
+            else:
+                pending.append(r)
+
+
+class JournalStream:
+    def __init__(self, directory: str, name: str):
+        self.name = name
+        self.dir = os.path.join(directory, name)
+        os.makedirs(self.dir, exist_ok=True)
+        self.batch = 0
+        self.file = None
+        self.segment_start = 0
+        self.failed = False
+        self.since_snapshot = 0
+        self.compacting: Optional[asyncio.Future] = None
+
+    @property
+    def snapshot_path(self) -> str:
+        return os.path.join(self.dir, "snapshot.bin")
+
+    def segments(self) -> List[Tuple[int, str]]:
+        out = []
+        for name in os.listdir(self.dir):
+            if name.startswith("journal-") and name.endswith(".bin"):
+                out.append((int(name[8:-4]), os.path.join(self.dir, name)))
+        return sorted(out)
+
+    def open_segment(self, start: int) -> None:
+        if self.file is not None:
+            self.file.close()
+        self.segment_start = start
+        self.file = open(os.path.join(self.dir, f"journal-{start:012d}.bin"), "ab", buffering=0)
+
+    def write(self, data: bytes) -> None:
+        self.file.write(data)
+        os.fsync(self.file.fileno())
+
+    def load(self, segments: Optional[List[Tuple[int, str]]] = None) -> State:
+        state = State()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                magic, batch, n_orders, n_balances = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+            if magic == MAGIC:
+                snapshot = State(batch)
+                count = 0
+                for r in read_mapped(self.snapshot_path, SNAPSHOT_HEADER.size):
+                    snapshot.apply(r)
+                    count += 1
+                if count == n_orders + n_balances:
+                    state = snapshot
+        for _, path in (self.segments() if segments is None else segments):
+            state.replay(read_mapped(path))
+        return state
+
+    def write_snapshot(self, state: State) -> None:
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(MAGIC, state.batch, len(state.orders), len(state.balances)))
+            for ext, (id_, user_id, instrument_id, side, price, qty, filled, ts, prio) in state.orders.items():
+                status = STATUSES.index(OrderStatus.PARTIAL if filled else OrderStatus.NEW)
+                f.write(encode(state.batch, ACCEPT, side, LIMIT, status, instrument_id, user_id, ts, ext, id_, prio, price, qty, filled))
+            for (user_id, instrument_id), total in state.balances.items():
+                f.write(encode(state.batch, BALANCE, instrument_id=instrument_id, user_id=user_id, qty=total))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        fd = os.open(self.dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def compact(self, segments: List[Tuple[int, str]]) -> None:
+        # Runs in a worker thread on closed segments only.
+        self.write_snapshot(self.load(segments))
+        for _, path in segments:
+            os.unlink(path)
+
+    def reset(self, state: State) -> None:
+        self.write_snapshot(state)
+        for _, path in self.segments():
+            os.unlink(path)
+
+
+class Journal:
+    def __init__(self, directory: str, snapshot_every: int):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.streams: Dict[int, JournalStream] = {}
+        self.pending: Dict[int, List[bytes]] = {}
+
+    @staticmethod
+    def key(instrument_id: int) -> int:
+        return shard_of(instrument_id) if settings.SHARD_COUNT else 0
+
+    @staticmethod
+    def stream_name(key: int) -> str:
+        return f"shard-{key}" if settings.SHARD_COUNT else "main"
+
+    def prepare(self, new_orders: Iterable[dict], updates: Iterable[dict], canceled: Iterable[RestingOrder],
+                trades: Iterable, deltas: Dict[Tuple[int, int], int],
+                amends: Iterable[dict] = ()) -> Dict[int, Tuple[int, List[bytes]]]:
+        """Encode one write-behind batch per stream; call after ids are assigned."""
+        out: Dict[int, Tuple[int, List[bytes]]] = {}
+
+        def add(instrument_id: int, record) -> None:
+            key = self.key(instrument_id)
+            stream = self.streams.get(key)
+            if stream is None or stream.failed:
+                return
+            entry = out.get(key)
+            if entry is None:
+                entry = out[key] = (stream.batch + 1, [])
+            entry[1].append(record(entry[0]))
+
+        for row in new_orders:
+            add(row["instrument_id"], lambda b, row=row: encode(
+                b, ACCEPT, SIDES.index(row["side"]), TYPES.index(row["type"]), STATUSES.index(row["status"]),
+                row["instrument_id"], row["user_id"], micros(row["created_at"]), uuid.UUID(row["external_id"]).bytes,
+                row["id"], micros(row["priority_at"]), row["price"] or 0, row["quantity"], row["filled"],
+            ))
+        for a in amends:
+            o = a["order"]
+            add(o.instrument_id, lambda b, o=o, a=a: encode(
+                b, AMEND, instrument_id=o.instrument_id, ts=micros(a["priority_at"]),
+                external_id=uuid.UUID(o.external_id).bytes, id_a=o.id, price=a["price"], qty=a["quantity"],
+            ))
+        for u in updates:
+            o = u["order"]
+            add(o.instrument_id, lambda b, o=o, u=u: encode(
+                b, UPDATE, status=STATUSES.index(u["status"]), instrument_id=o.instrument_id,
+                external_id=uuid.UUID(o.external_id).bytes, id_a=o.id, filled=u["filled"],
+            ))
+        for o in canceled:
+            add(o.instrument_id, lambda b, o=o: encode(
+                b, CANCEL, instrument_id=o.instrument_id, external_id=uuid.UUID(o.external_id).bytes, id_a=o.id,
+            ))
+        for t in trades:
+            add(t.instrument_id, lambda b, t=t: encode(
+                b, FILL, instrument_id=t.instrument_id, ts=micros(t.timestamp),
+                id_a=t.buy.id, id_b=t.sell.id, price=t.price, qty=t.quantity,
+            ))
+        for (user_id, instrument_id), delta in deltas.items():
+            if delta:
+                add(instrument_id, lambda b, u=user_id, i=instrument_id, d=delta: encode(
+                    b, BALANCE, instrument_id=i, user_id=u, qty=d,
+                ))
+        return out
+
+    async def stamp(self, db: AsyncSession, prepared: Dict[int, Tuple[int, List[bytes]]]) -> None:
+        for key, (batch, _) in prepared.items():
+            await db.execute(
+                update(JournalState).where(JournalState.name == self.stream_name(key)).values(batch=batch)
+            )
+
+    async def append(self, prepared: Dict[int, Tuple[int, List[bytes]]]) -> None:
+        loop = asyncio.get_running_loop()
+        for key, (batch, records) in prepared.items():
+            stream = self.streams[key]
+            records.append(encode(batch, COMMIT))
+            try:
+                await loop.run_in_executor(None, stream.write, b"".join(records))
+            except OSError:
+                # The database is ahead of the journal from here on, so the
+                # next startup falls back to Postgres for this stream.
+                logger.exception("journal %s write failed; journaling disabled for it", stream.name)
+                stream.failed = True
+                continue
+            stream.batch = batch
+            stream.since_snapshot += 1
+            if stream.since_snapshot >= self.snapshot_every and stream.compacting is None:
+                self.start_compaction(stream)
+
+    def start_compaction(self, stream: JournalStream) -> None:
+        closed = [s for s in stream.segments() if s[0] <= stream.batch]
+        stream.open_segment(stream.batch + 1)
+        stream.since_snapshot = 0
+        stream.compacting = asyncio.get_running_loop().run_in_executor(None, stream.compact, closed)
+
+        def done(future):
+            stream.compacting = None
+            if future.exception() is not None:
+                logger.error("journal %s compaction failed", stream.name, exc_info=future.exception())
+        stream.compacting.add_done_callback(done)
+
+    async def watermark(self, db: AsyncSession, name: str) -> int:
+        batch = (await db.execute(select(JournalState.batch).where(JournalState.name == name))).scalar_one_or_none()
+        if batch is None:
+            db.add(JournalState(name=name, batch=0))
+            await db.commit()
+            batch = 0
+        return batch
+
+    async def restore(self, db: AsyncSession, key: int = 0, instrument_ids: Optional[List[int]] = None) -> bool:
+        """Rebuild books and balance totals for a stream; True if the journal was used."""
+        name = self.stream_name(key)
+        stream = JournalStream(self.directory, name)
+        loop = asyncio.get_running_loop()
+        db_batch = await self.watermark(db, name)
+        state = await loop.run_in_executor(None, stream.load)
+        used = state.batch == db_batch and (state.batch > 0 or os.path.exists(stream.snapshot_path))
+
+        if used:
+            install(state, instrument_ids)
+            logger.info("journal %s restored at batch %s (%s resting orders)", name, state.batch, len(state.orders))
+        else:
+            logger.info("journal %s at batch %s, database at %s: loading from Postgres", name, state.batch, db_batch)
+            state = await state_from_db(db, db_batch, instrument_ids)
+            install(state, instrument_ids)
+            await loop.run_in_executor(None, stream.reset, state)
+
+        stream.batch = db_batch
+        stream.open_segment(db_batch + 1)
+        old = self.streams.get(key)
+        if old is not None and old.file is not None:
+            old.file.close()
+        self.streams[key] = stream
+        return used
+
+    async def stop(self) -> None:
+        for stream in self.streams.values():
+            if stream.compacting is not None:
+                await stream.compacting
+            if stream.file is not None:
+                stream.file.close()
+
+
+async def state_from_db(db: AsyncSession, batch: int, instrument_ids: Optional[List[int]]) -> State:
+    # Loads through the matching engine's own query so the books come out the
+    # same as they would without a journal.
+    if instrument_ids is None:
+        await matching_engine.load(db)
+        books = list(matching_engine.books.values())
+    else:
+        books = []
+        for instrument_id in instrument_ids:
+            await matching_engine.load(db, instrument_id)
+            books.append(matching_engine.book(instrument_id))
+    state = State(batch)
+    for book in books:
+        for o in book.orders.values():
+            state.orders[uuid.UUID(o.external_id).bytes] = [
+                o.id, o.user_id, o.instrument_id, SIDES.index(o.side),
+                o.price, o.quantity, o.filled, micros(o.created_at), micros(o.priority_at or o.created_at),
+            ]
+    q = select(Balance.user_id, Balance.instrument_id, func.sum(Balance.amount)).group_by(Balance.user_id, Balance.instrument_id)
+    if instrument_ids is not None:
+        q = q.where(Balance.instrument_id.in_(instrument_ids))
+    for user_id, instrument_id, amount in await db.execute(q):
+        state.balances[(user_id, instrument_id)] = to_units(amount or 0)
+    return state
+
+
+def uuid_str(b: bytes) -> str:
+    h = b.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def install(state: State, instrument_ids: Optional[List[int]]) -> None:
+    books: Dict[int, OrderBook] = {i: OrderBook(i) for i in instrument_ids or ()}
+    rows = sorted(state.orders.items(), key=lambda kv: (kv[1][8], kv[1][0]))  # priority, id
+    for ext, (id_, user_id, instrument_id, side, price, qty, filled, ts, prio) in rows:
+        book = books.get(instrument_id)
+        if book is None:
+            book = books[instrument_id] = OrderBook(instrument_id)
+        book.add(RestingOrder(
+            id=id_,
+            external_id=uuid_str(ext),
+            user_id=user_id,
+            instrument_id=instrument_id,
+            side=SIDES[side],
+            price=price,
+            quantity=qty,
+            filled=filled,
+            created_at=from_micros(ts),
+            priority_at=from_micros(prio) if prio != ts else None,
+        ))
+    if instrument_ids is None:
+        matching_engine.books = books
+    else:
+        matching_engine.books.update(books)
+    for (user_id, instrument_id), total in state.balances.items():
+        if instrument_ids is None or instrument_id in books:
+            ledger.entry(user_id, instrument_id).total = total
+    for book in books.values():
+        ledger.rebuild_locks(book.instrument_id, book.orders.values())
+
+
+journal = Journal(settings.JOURNAL_DIR, settings.JOURNAL_SNAPSHOT_BATCHES) if settings.JOURNAL_DIR else None
+
+
+async def verify(directory: str, name: str) -> int:
+    """Compare FILL records in the retained journal segments with the trades table."""
+    from app.database import AsyncSessionLocal
+
+    stream = JournalStream(directory, name)
+    fills: Counter = Counter()
+    instruments = set()
+    lo = hi = None
+    for _, path in stream.segments():
+        committed = []
+        pending = []
+        for r in read_mapped(path):
+            if r[1] == COMMIT:
+                committed += pending
+                pending = []
+            else:
+                pending.append(r)
+        for r in committed:
+            if r[1] == FILL:
+                fills[(r[9], r[10], r[5], r[11], r[12], r[7])] += 1
+                instruments.add(r[5])
+                lo = r[7] if lo is None else min(lo, r[7])
+                hi = r[7] if hi is None else max(hi, r[7])
+    if not fills:
+        print(f"{name}: no fills in the retained journal segments")
+        return 0
+
+    trades: Counter = Counter()
+    async with AsyncSessionLocal() as db:
+        rows = await db.execute(
+            select(Trade.buy_order_id, Trade.sell_order_id, Trade.instrument_id, Trade.price, Trade.quantity, Trade.timestamp)
+            .where(Trade.instrument_id.in_(instruments), Trade.timestamp >= from_micros(lo), Trade.timestamp <= from_micros(hi))
+        )
+        for buy, sell, instrument_id, price, qty, ts in rows:
+            trades[(buy, sell, instrument_id, to_units(price), to_units(qty), micros(ts))] += 1
+
+    missing = fills - trades
+    extra = trades - fills
+    print(f"{name}: {sum(fills.values())} journalled fills between {from_micros(lo)} and {from_micros(hi)}, "
+          f"{sum(trades.values())} trades in that range")
+    for label, diff in (("in journal, not in trades", missing), ("in trades, not in journal", extra)):
+        for key, n in list(diff.items())[:20]:
+            print(f"  {label}: buy={key[0]} sell={key[1]} instrument={key[2]} "
+                  f"price={from_units(key[3])} qty={from_units(key[4])} ts={from_micros(key[5])} x{n}")
+    return 1 if missing or extra else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Matching journal tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    v = sub.add_parser("verify", help="check journalled fills against the trades table")
+    v.add_argument("--dir", default=settings.JOURNAL_DIR)
+    v.add_argument("--stream", help="stream name (default: every stream in --dir)")
+    args = parser.parse_args()
+    if not args.dir:
+        raise SystemExit("set JOURNAL_DIR or pass --dir")
+
+    names = [args.stream] if args.stream else sorted(os.listdir(args.dir))
+
+    async def run():
+        status = 0
+        for name in names:
+            status |= await verify(args.dir, name)
+        return status
+
+    raise SystemExit(asyncio.run(run()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import select
+
+from app.database import AsyncSessionLocal
+from app.matching import RestingOrder, to_units
+from app.models import Balance, Side
+
+Key = Tuple[int, int]
+
+
+class InsufficientBalance(Exception):
+    pass
+
+
+class LedgerEntry:
+    __slots__ = ("total", "locked")
+
+    def __init__(self, total: Optional[int] = None, locked: int = 0):
+        # total mirrors balances.amount and is loaded lazily; locked is what
+        # resting sell orders have reserved and only ever lives in memory.
+        self.total = total
+        self.locked = locked
+
+    @property
+    def loaded(self) -> bool:
+        return self.total is not None
+
+    @property
+    def available(self) -> int:
+        return self.total - self.locked
+
+
+class BalanceLedger:
+    """In-process (user_id, instrument_id) -> available/locked balances.
+
+    Every mutation for an instrument runs inside that instrument's sequencer
+    lane, so entries are updated atomically with matching. Totals are written
+    back to the balances table through the write-behind stage as deltas.
+    """
+
+    def __init__(self):
+        self.entries: Dict[Key, LedgerEntry] = {}
+        self.loads = 0
+
+    def entry(self, user_id: int, instrument_id: int) -> LedgerEntry:
+        key = (user_id, instrument_id)
+        e = self.entries.get(key)
+        if e is None:
+            e = self.entries[key] = LedgerEntry()
+        return e
+
+    async def ensure(self, user_id: int, instrument_id: int, barrier=None) -> LedgerEntry:
+        """Load the persisted total for a key if it is not in memory yet.
+
+        ``barrier`` is awaited before reading so that deltas still queued for
+        the database are included in what gets loaded. Must be called from the
+        instrument's sequencer lane.
+        """
+        e = self.entry(user_id, instrument_id)
+        if e.loaded:
+            return e
+        if barrier is not None:
+            await barrier()
+        async with AsyncSessionLocal() as db:
+            amounts = (await db.execute(
+                select(Balance.amount).where(Balance.user_id == user_id, Balance.instrument_id == instrument_id)
+            )).scalars().all()
+        # Balance rows are not unique per key; treat duplicates as one balance.
+        e.total = sum(to_units(a or 0) for a in amounts)
+        self.loads += 1
+        return e
+
+    def hold(self, user_id: int, instrument_id: int, qty: int) -> None:
+        e = self.entry(user_id, instrument_id)
+        if e.available < qty:
+            raise InsufficientBalance((user_id, instrument_id))
+        e.locked += qty
+
+    def release(self, user_id: int, instrument_id: int, qty: int) -> None:
+        e = self.entries.get((user_id, instrument_id))
+        if e is not None:
+            e.locked -= qty
+
+    def credit(self, user_id: int, instrument_id: int, delta: int) -> None:
+        e = self.entries.get((user_id, instrument_id))
+        if e is not None and e.loaded:
+            e.total += delta
+
+    def settle(self, buyer_id: int, seller_id: int, instrument_id: int, qty: int) -> None:
+        # The seller always holds the traded quantity, whether it was resting
+        # or crossing on arrival.
+        self.credit(buyer_id, instrument_id, qty)
+        self.credit(seller_id, instrument_id, -qty)
+        self.release(seller_id, instrument_id, qty)
+
+    def rebuild_locks(self, instrument_id: int, resting: Iterable[RestingOrder]) -> None:
+        for (_, inst_id), e in self.entries.items():
+            if inst_id == instrument_id:
+                e.locked = 0
+        for o in resting:
+            if o.side == Side.SELL:
+                self.entry(o.user_id, instrument_id).locked += o.remaining
+
+    def forget(self, instrument_id: int) -> None:
+        # Drop cached totals so they are reloaded from the database on next use.
+        for (_, inst_id), e in self.entries.items():
+            if inst_id == instrument_id:
+                e.total = None
+
+
+ledger = BalanceLedger()
@@ -1,8 +1,21 @@
-from fastapi import FastAPI
+import asyncio
+
+from fastapi import FastAPI, Request, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
+from app import metrics
+from app.archive import archiver
+from app.capture import CaptureMiddleware, capture_writer
 from app.config import settings
-from app.database import engine
+from app.database import engine, read_engine, AsyncSessionLocal
 from app.models import Base
+from app.instruments import registry
+from app.gateway import gateway, ShardUnavailable, SlowConsumer
+from app.exchange import load_books
+from app.journal import journal
+from app.sequencer import sequencer
+from app.persistence import TRADES_CHANNEL, write_behind
+from app.response_cache import response_cache
 from app.routers import api_v1_public, api_v1_balance, api_v1_order, api_v1_admin, api_v1_user
 
 app = FastAPI(openapi_url="/openapi.json", docs_url="/docs")
@@ -14,10 +27,57 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+if settings.METRICS_ENABLED:
+    metrics.instrument_engine(engine)
+    if read_engine is not engine:
+        metrics.instrument_engine(read_engine, "replica")
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics_endpoint():
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+if settings.CAPTURE_DIR:
+    app.add_middleware(CaptureMiddleware)
+
 @app.on_event("startup")
 async def startup():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    async with AsyncSessionLocal() as db:
+        await registry.load(db)
+        if not settings.SHARD_COUNT:
+            if journal is not None:
+                await journal.restore(db)
+            else:
+                await load_books(db)
+    write_behind.journal = journal
+    registry.listeners.append(response_cache.on_instrument_changed)
+    if settings.SHARD_COUNT:
+        registry.subscribe(TRADES_CHANNEL, response_cache.on_trades_notify)
+    else:
+        write_behind.trade_hooks.append(response_cache.on_trades)
+    registry.start(engine, AsyncSessionLocal)
+    if settings.CAPTURE_DIR:
+        capture_writer.start()
+    archiver.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await archiver.stop()
+    await registry.stop()
+    await gateway.stop()
+    await sequencer.stop()
+    await write_behind.stop()
+    if journal is not None:
+        await journal.stop()
+    if read_engine is not engine:
+        await read_engine.dispose()
+    await capture_writer.stop()
+
+@app.exception_handler(ShardUnavailable)
+async def shard_unavailable(request: Request, exc: ShardUnavailable):
+    return JSONResponse({"detail": "Matching temporarily unavailable"}, status_code=503)
 
 # Роутеры
 app.include_router(api_v1_public.router)
@@ -25,3 +85,33 @@ app.include_router(api_v1_balance.router)
 app.include_router(api_v1_order.router)
 app.include_router(api_v1_admin.router)
 app.include_router(api_v1_user.router)
+
+
+@app.websocket("/ws/v1/marketdata/{ticker}")
+async def marketdata_stream(websocket: WebSocket, ticker: str):
+    inst = registry.listed(ticker)
+    if not inst:
+        await websocket.close(code=4404)
+        return
+    await websocket.accept()
+
+    async def send():
+        try:
+            async for message in gateway.stream(inst.id, ticker):
+                await websocket.send_text(message)
+        except SlowConsumer:
+            await websocket.close(code=1013, reason="slow consumer")
+        except ShardUnavailable:
+            await websocket.close(code=1012, reason="matching restarting")
+
+    async def receive():
+        while True:
+            if (await websocket.receive())["type"] == "websocket.disconnect":
+                return
+
+    tasks = [asyncio.create_task(send()), asyncio.create_task(receive())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,143 @@
+import asyncio
+import json
+from collections import deque
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from app.config import settings
+from app.matching import Fill, OrderBook, matching_engine, whole
+from app.models import Side
+
+
+def dumps(payload: dict) -> str:
+    return json.dumps(payload, separators=(",", ":"))
+
+
+def levels_payload(book: OrderBook, depth: Optional[int]) -> dict:
+    return {
+        "bid_levels": [{"price": whole(p), "qty": whole(q)} for p, q in book.bids.depth(depth)],
+        "ask_levels": [{"price": whole(p), "qty": whole(q)} for p, q in book.asks.depth(depth)],
+    }
+
+
+def l2_snapshot(instrument_id: int, depth: int) -> bytes:
+    """JSON-encoded L2 view, re-encoded only after the book has changed."""
+    book = matching_engine.book(instrument_id)
+    key = ("l2", depth)
+    cached = book.views.get(key)
+    if cached is not None and cached[0] == book.version:
+        return cached[1]
+    body = dumps(levels_payload(book, depth)).encode()
+    book.views[key] = (book.version, body)
+    return body
+
+
+class Subscriber:
+    __slots__ = ("messages", "maxsize", "dropped", "wakeup")
+
+    def __init__(self, maxsize: int):
+        self.messages: deque = deque()
+        self.maxsize = maxsize
+        self.dropped = False
+        self.wakeup = asyncio.Event()
+
+    def push(self, message: str) -> bool:
+        if len(self.messages) >= self.maxsize:
+            # A consumer this far behind can only be resynced from a snapshot;
+            # cut it loose instead of buffering without bound.
+            self.dropped = True
+            self.messages.clear()
+            self.wakeup.set()
+            return False
+        self.messages.append(message)
+        self.wakeup.set()
+        return True
+
+    async def next_batch(self) -> list:
+        await self.wakeup.wait()
+        self.wakeup.clear()
+        batch = list(self.messages)
+        self.messages.clear()
+        return batch
+
+
+class Channel:
+    def __init__(self, instrument_id: int, ticker: str):
+        self.instrument_id = instrument_id
+        self.ticker = ticker
+        self.seq = 0
+        self.subscribers: Set[Subscriber] = set()
+
+    def broadcast(self, payload: dict) -> None:
+        self.seq += 1
+        payload["seq"] = self.seq
+        # Encoded once, shared by every subscriber.
+        message = dumps(payload)
+        for sub in list(self.subscribers):
+            if not sub.push(message):
+                self.subscribers.discard(sub)
+
+
+class MarketDataHub:
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.channels: Dict[int, Channel] = {}
+        self.dropped = 0
+
+    def subscribe(self, instrument_id: int, ticker: str) -> Tuple[Subscriber, str]:
+        channel = self.channels.get(instrument_id)
+        if channel is None:
+            channel = self.channels[instrument_id] = Channel(instrument_id, ticker)
+        sub = Subscriber(self.queue_size)
+        channel.subscribers.add(sub)
+        return sub, self.snapshot_message(channel)
+
+    def unsubscribe(self, instrument_id: int, sub: Subscriber) -> None:
+        channel = self.channels.get(instrument_id)
+        if channel is not None:
+            channel.subscribers.discard(sub)
+            if not channel.subscribers:
+                del self.channels[instrument_id]
+
+    def snapshot_message(self, channel: Channel) -> str:
+        book = matching_engine.book(channel.instrument_id)
+        payload = {"type": "snapshot", "ticker": channel.ticker, "seq": channel.seq}
+        payload.update(levels_payload(book, None))
+        return dumps(payload)
+
+    def publish(self, book: OrderBook, fills: Iterable[Fill] = (), timestamp=None) -> None:
+        touched = book.take_touched()
+        channel = self.channels.get(book.instrument_id)
+        if channel is None:
+            return
+        before = len(channel.subscribers)
+        for fill in fills:
+            channel.broadcast({
+                "type": "trade",
+                "ticker": channel.ticker,
+                "price": whole(fill.price),
+                "qty": whole(fill.quantity),
+                "timestamp": timestamp.isoformat() if timestamp else None,
+            })
+        if touched:
+            bids, asks = [], []
+            for side, price in sorted(touched):
+                level = {"price": whole(price), "qty": whole(book.level_quantity(side, price))}
+                (bids if side == Side.BUY else asks).append(level)
+            channel.broadcast({"type": "l2_delta", "ticker": channel.ticker, "bid_levels": bids, "ask_levels": asks})
+        self.dropped += before - len(channel.subscribers)
+
+    def resync(self, instrument_id: int) -> None:
+        # After a book reload the deltas sent so far may be wrong: push a
+        # fresh full snapshot in sequence.
+        channel = self.channels.get(instrument_id)
+        if channel is None:
+            return
+        matching_engine.book(instrument_id).take_touched()
+        channel.seq += 1
+        message = self.snapshot_message(channel)
+        for sub in list(channel.subscribers):
+            if not sub.push(message):
+                channel.subscribers.discard(sub)
+
+
+hub = MarketDataHub(settings.WS_SEND_QUEUE)
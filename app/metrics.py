@@ -0,0 +1,198 @@
+"""In-process metrics in the Prometheus text format.
+
+Histograms keep one counter per bucket and label set, so observing a value
+is a bisect and two additions; everything else happens when /metrics is
+scraped. Each process (every uvicorn worker, every shard) has its own
+numbers. With METRICS_ENABLED=false nothing is recorded and neither the
+middleware, the engine hooks nor the endpoint are installed.
+"""
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.config import settings
+
+enabled = settings.METRICS_ENABLED
+
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+Labels = Tuple[str, ...]
+
+REGISTRY: list = []
+
+
+def format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Labels = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self.series: Dict[Labels, list] = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels: str) -> None:
+        if not enabled:
+            return
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        s[0][bisect_left(self.buckets, value)] += 1
+        s[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Read at scrape time from ``collect``, which yields (label values, value)."""
+
+    def __init__(self, name: str, help: str, collect: Callable[[], Iterable[Tuple[Labels, float]]],
+                 labelnames: Labels = (), type: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.labelnames = labelnames
+        self.type = type
+        REGISTRY.append(self)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for labels, value in self.collect():
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+ORDER_STAGE = Histogram(
+    "exchange_order_stage_seconds",
+    "Time spent in each stage of order handling",
+    ("stage",),
+)
+HTTP_REQUEST = Histogram(
+    "exchange_http_request_seconds",
+    "HTTP request latency by route, until the response body is sent",
+    ("method", "route", "status"),
+)
+DB_QUERY = Histogram(
+    "exchange_db_query_seconds",
+    "Database statement execution time",
+    ("statement",),
+)
+DB_SESSION = Histogram(
+    "exchange_db_session_seconds",
+    "Lifetime of request sessions handed out by get_db",
+)
+SEQUENCER_WAIT = Histogram(
+    "exchange_sequencer_wait_seconds",
+    "Time a job waits in its instrument lane before it starts",
+)
+SEQUENCER_JOB = Histogram(
+    "exchange_sequencer_job_seconds",
+    "Time a job runs in its instrument lane",
+)
+WRITE_BEHIND_FLUSH = Histogram(
+    "exchange_write_behind_flush_seconds",
+    "Time to write and commit one write-behind batch",
+)
+WRITE_BEHIND_BATCH = Histogram(
+    "exchange_write_behind_batch_mutations",
+    "Mutations per write-behind batch",
+    buckets=SIZE_BUCKETS,
+)
+
+
+def statement_kind(statement: str) -> str:
+    word = statement.lstrip()[:6].upper()
+    return word if word in ("SELECT", "INSERT", "UPDATE", "DELETE") else "OTHER"
+
+
+POOLS: Dict[str, object] = {}
+
+
+def pool_stats():
+    for name, pool in POOLS.items():
+        yield (name, "size"), pool.size()
+        yield (name, "checked_out"), pool.checkedout()
+        yield (name, "checked_in"), pool.checkedin()
+        yield (name, "overflow"), pool.overflow()
+
+
+Gauge("exchange_db_pool_connections", "Connection pool occupancy", pool_stats, ("engine", "state"))
+
+
+def instrument_engine(engine: AsyncEngine, name: str = "primary") -> None:
+    """Time every statement and expose pool occupancy."""
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["metrics_started"].pop()
+        DB_QUERY.observe(time.perf_counter() - started, statement_kind(statement))
+
+    @event.listens_for(sync_engine, "handle_error")
+    def failed(context):
+        conn = context.connection
+        if conn is not None and conn.info.get("metrics_started"):
+            conn.info["metrics_started"].pop()
+
+    POOLS[name] = sync_engine.pool
+
+
+class MetricsMiddleware:
+    """Per-route latency. Pure ASGI so it adds no per-request tasks or copies."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = ["500"]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = str(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Templated path ("/api/v1/order/{order_id}") to keep label counts bounded.
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            HTTP_REQUEST.observe(time.perf_counter() - started, scope["method"], path, status[0])
@@ -1,9 +1,17 @@
-from sqlalchemy import Column, Integer, String, Numeric, ForeignKey, Enum, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, Numeric, ForeignKey, Enum, DateTime, Boolean, UniqueConstraint, Index, Sequence, text, event, DDL
 from sqlalchemy.orm import relationship, declarative_base
 import enum, datetime
 
 Base = declarative_base()
 
+
+def default_partition(table) -> None:
+    # Catches rows outside every monthly partition (see app.archive).
+    event.listen(
+        table, "after_create",
+        DDL(f"CREATE TABLE {table.name}_default PARTITION OF {table.name} DEFAULT").execute_if(dialect="postgresql"),
+    )
+
 class InstrumentType(str, enum.Enum):
     STOCK = "stock"
     BOND = "bond"
@@ -35,6 +43,9 @@ class Instrument(Base):
     name = Column(String, nullable=False)
     type = Column(Enum(InstrumentType), nullable=False)
     is_listed = Column(Boolean, default=True)
+    # Order prices and quantities must be whole multiples of these.
+    tick_size = Column(Numeric(20, 8), nullable=False, default=1, server_default="1")
+    lot_size = Column(Numeric(20, 8), nullable=False, default=1, server_default="1")
 
 class Balance(Base):
     __tablename__ = "balances"
@@ -73,18 +84,104 @@ class Order(Base):
     filled = Column(Numeric(20, 8), default=0)
     status = Column(Enum(OrderStatus), default=OrderStatus.NEW)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # Set when an amend re-queued the order; books load in (priority_at or created_at, id) order.
+    priority_at = Column(DateTime, nullable=True)
+    closed_at = Column(DateTime, nullable=True)  # when it became FILLED or CANCELED
 
     user = relationship("User", back_populates="orders")
     instrument = relationship("Instrument")
 
+    __table_args__ = (
+        # Resting orders only: terminal rows are the bulk of the table and are
+        # never part of a book.
+        Index(
+            "ix_orders_active_book", "instrument_id", "side", "price",
+            postgresql_where=text("status IN ('NEW', 'PARTIAL')"),
+        ),
+        Index("ix_orders_user_status", "user_id", "status"),
+        Index("ix_orders_user_created", "user_id", "created_at", "id"),
+        # What the archiver picks from.
+        Index(
+            "ix_orders_terminal_closed", "closed_at",
+            postgresql_where=text("status IN ('FILLED', 'CANCELED')"),
+        ),
+    )
+
+class OrderArchive(Base):
+    # Terminal orders moved out of `orders` by app.archive, partitioned by
+    # month of created_at. The partition key has to be part of the primary key.
+    __tablename__ = "orders_archive"
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    external_id = Column(String, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    instrument_id = Column(Integer, ForeignKey("instruments.id"), nullable=False)
+    type = Column(Enum(OrderType), nullable=False)
+    side = Column(Enum(Side), nullable=False)
+    price = Column(Numeric(20, 8), nullable=True)
+    quantity = Column(Numeric(20, 8), nullable=False)
+    filled = Column(Numeric(20, 8), default=0)
+    status = Column(Enum(OrderStatus), nullable=False)
+    created_at = Column(DateTime, primary_key=True)
+    closed_at = Column(DateTime, nullable=True)
+    archived_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_orders_archive_external_id", "external_id"),
+        Index("ix_orders_archive_user_created", "user_id", "created_at", "id"),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+
+default_partition(OrderArchive.__table__)
+
+trades_id_seq = Sequence("trades_id_seq")
+
 class Trade(Base):
+    # Partitioned by month of timestamp, so it is part of the primary key.
     __tablename__ = "trades"
-    id = Column(Integer, primary_key=True, index=True)
-    buy_order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
-    sell_order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
+    # Same server-side default as migration 0007, so raw INSERTs get ids too.
+    id = Column(Integer, trades_id_seq, server_default=trades_id_seq.next_value(), primary_key=True, index=True)
+    # No foreign keys: the orders may have moved to orders_archive.
+    buy_order_id = Column(Integer, nullable=False)
+    sell_order_id = Column(Integer, nullable=False)
     instrument_id = Column(Integer, ForeignKey("instruments.id"), nullable=False)
     price = Column(Numeric(20,8), nullable=False)
     quantity = Column(Numeric(20,8), nullable=False)
-    timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+    timestamp = Column(DateTime, primary_key=True, default=datetime.datetime.utcnow)
 
     instrument = relationship("Instrument")
+
+    __table_args__ = (
+        Index("ix_trades_instrument_timestamp", "instrument_id", "timestamp"),
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
+
+default_partition(Trade.__table__)
+
+class Candle(Base):
+    __tablename__ = "candles"
+    id = Column(Integer, primary_key=True, index=True)
+    instrument_id = Column(Integer, ForeignKey("instruments.id"), nullable=False)
+    interval = Column(Integer, nullable=False)  # minutes
+    ts = Column(DateTime, nullable=False)  # bucket start, UTC
+    open = Column(Numeric(20,8), nullable=False)
+    high = Column(Numeric(20,8), nullable=False)
+    low = Column(Numeric(20,8), nullable=False)
+    close = Column(Numeric(20,8), nullable=False)
+    volume = Column(Numeric(20,8), nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("instrument_id", "interval", "ts", name="uq_candles_instrument_interval_ts"),
+    )
+
+class ShardLease(Base):
+    __tablename__ = "shard_leases"
+    shard_id = Column(Integer, primary_key=True, autoincrement=False)
+    owner = Column(String, nullable=False)
+    address = Column(String, nullable=False)  # where the owner accepts shard RPC
+    epoch = Column(Integer, nullable=False)  # bumped on every change of owner
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+class JournalState(Base):
+    __tablename__ = "journal_state"
+    name = Column(String, primary_key=True)  # journal stream, e.g. "main" or "shard-3"
+    batch = Column(Integer, nullable=False, default=0)  # last write-behind batch committed for it
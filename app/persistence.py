@@ -0,0 +1,403 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+import datetime
+
+from sqlalchemy import bindparam, insert, select, text, tuple_, update
+
+from app import candles, metrics
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.matching import RestingOrder, from_units
+from app.models import Balance, Order, OrderStatus, OrderType, Trade
+
+logger = logging.getLogger(__name__)
+
+TRADES_CHANNEL = "trades_committed"
+ACTIVE = (OrderStatus.NEW, OrderStatus.PARTIAL)
+TERMINAL = (OrderStatus.FILLED, OrderStatus.CANCELED)
+
+
+@dataclass
+class NewOrder:
+    order: RestingOrder
+    type: OrderType
+    status: OrderStatus
+    filled: int
+
+
+@dataclass
+class OrderUpdate:
+    order: RestingOrder
+    status: OrderStatus
+    filled: int
+
+
+@dataclass
+class OrderAmend:
+    # New price/size and, when it lost its queue position, new priority_at.
+    order: RestingOrder
+    price: int
+    quantity: int
+    priority_at: Optional[datetime.datetime]
+    status: OrderStatus
+    filled: int
+
+
+@dataclass
+class CancelOrders:
+    orders: List[RestingOrder]
+
+
+@dataclass
+class NewTrade:
+    buy: RestingOrder
+    sell: RestingOrder
+    instrument_id: int
+    price: int
+    quantity: int
+    timestamp: datetime.datetime
+
+
+@dataclass
+class BalanceDelta:
+    user_id: int
+    instrument_id: int
+    delta: int
+
+
+class WriteBehind:
+    """Collects mutations from many matches and commits them together.
+
+    A batch is written once ``interval`` seconds have passed since its first
+    mutation or as soon as ``max_events`` mutations are pending, whichever
+    comes first. Callers get a future that resolves once their batch has been
+    committed, so an HTTP response is only sent for durable state.
+    """
+
+    def __init__(self, interval: float, max_events: int):
+        self.interval = interval
+        self.max_events = max_events
+        self.failure_hooks: List[Callable[[Set[int]], object]] = []
+        # Called with the instruments that traded, after the commit and before
+        # any submitter is woken up.
+        self.trade_hooks: List[Callable[[Set[int]], None]] = []
+        # NOTIFY TRADES_CHANNEL in each batch with trades, for processes that
+        # do not see this one's commits (shard workers).
+        self.notify_trades = False
+        # Awaited with the batch's session before anything is written; raising
+        # aborts the batch. Shard workers use it to check lease ownership.
+        self.fence: Optional[Callable[[object], Awaitable[None]]] = None
+        self.journal = None  # app.journal.Journal when JOURNAL_DIR is set
+        self.batches = 0
+        self.events = 0
+        self._pending: List[Tuple[list, asyncio.Future]] = []
+        self._pending_events = 0
+        self._ready: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flushing = False
+        self._stopping = False
+
+    def _start(self):
+        self._ready = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="write-behind")
+
+    def submit(self, mutations: list) -> asyncio.Future:
+        if self._task is None:
+            self._start()
+        future = asyncio.get_running_loop().create_future()
+        if not mutations and not self._pending and not self._flushing:
+            # A barrier with nothing ahead of it: everything is committed.
+            future.set_result(None)
+            return future
+        self._pending.append((mutations, future))
+        self._pending_events += len(mutations)
+        self._ready.set()
+        if self._pending_events >= self.max_events:
+            self._full.set()
+        return future
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            if self._pending_events < self.max_events and not self._stopping:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            await self._drain()
+            if self._stopping and not self._pending:
+                return
+
+    async def _drain(self):
+        batch, self._pending = self._pending, []
+        self._pending_events = 0
+        self._ready.clear()
+        self._full.clear()
+        if not batch:
+            return
+        mutations = [m for ms, _ in batch for m in ms]
+        if not mutations:
+            # Only barriers, queued behind a batch that has since been written.
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+            return
+        started = time.perf_counter()
+        self._flushing = True
+        try:
+            await self.flush(mutations)
+        except Exception as e:
+            logger.exception("write-behind batch of %d mutations failed", len(mutations))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            instruments = instruments_of(mutations)
+            # Mutations queued meanwhile for the same instruments build on
+            # state that was never written (orders without ids); the reload
+            # below replaces it, so they fail with the batch.
+            kept = []
+            for ms, future in self._pending:
+                if instruments & instruments_of(ms):
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    kept.append((ms, future))
+            self._pending = kept
+            self._pending_events = sum(len(ms) for ms, _ in kept)
+            for hook in self.failure_hooks:
+                result = hook(instruments)
+                if asyncio.iscoroutine(result):
+                    await result
+            return
+        finally:
+            self._flushing = False
+        metrics.WRITE_BEHIND_FLUSH.observe(time.perf_counter() - started)
+        metrics.WRITE_BEHIND_BATCH.observe(len(mutations))
+        if self.trade_hooks:
+            traded = {m.instrument_id for m in mutations if isinstance(m, NewTrade)}
+            if traded:
+                for hook in self.trade_hooks:
+                    hook(traded)
+        self.batches += 1
+        self.events += len(mutations)
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    async def flush(self, mutations: Iterable) -> None:
+        w = fold(mutations)
+        new_orders, updates, amends, canceled, trades, deltas = (
+            w.new_orders, w.updates, w.amends, w.canceled, w.trades, w.deltas,
+        )
+
+        # Stamped on every order this batch makes FILLED or CANCELED; the
+        # archiver ages orders from it.
+        closed_at = datetime.datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            if self.fence is not None:
+                await self.fence(db)
+            if new_orders:
+                rows = await db.execute(
+                    insert(Order).returning(Order.id, Order.external_id),
+                    [order_row(row, closed_at) for row in new_orders.values()],
+                )
+                ids = {external_id: id_ for id_, external_id in rows}
+                for m in mutations:
+                    if isinstance(m, NewOrder):
+                        m.order.id = ids[m.order.external_id]
+                for external_id, row in new_orders.items():
+                    row["id"] = ids[external_id]
+
+            if updates:
+                await db.execute(
+                    update(Order),
+                    [{
+                        "id": u["order"].id,
+                        "filled": from_units(u["filled"]),
+                        "status": u["status"],
+                        "closed_at": closed_at if u["status"] in TERMINAL else None,
+                    } for u in updates.values()],
+                )
+
+            if amends:
+                await db.execute(update(Order), [{
+                    "id": a["order"].id,
+                    "price": from_units(a["price"]),
+                    "quantity": from_units(a["quantity"]),
+                    "priority_at": a["priority_at"],
+                } for a in amends.values()])
+
+            if canceled:
+                # Conditional, so a cancel can never overwrite a terminal
+                # status. The book only cancels resting orders, so every row
+                # should match; anything else means the two have diverged.
+                done = (await db.execute(
+                    update(Order)
+                    .where(Order.id.in_([o.id for o in canceled.values()]), Order.status.in_(ACTIVE))
+                    .values(status=OrderStatus.CANCELED, closed_at=closed_at)
+                    .returning(Order.id)
+                    .execution_options(synchronize_session=False)
+                )).scalars().all()
+                if len(done) != len(canceled):
+                    logger.warning("%d of %d cancelled orders were no longer active in the database",
+                                   len(canceled) - len(done), len(canceled))
+
+            if trades:
+                await db.execute(insert(Trade), [{
+                    "buy_order_id": t.buy.id,
+                    "sell_order_id": t.sell.id,
+                    "instrument_id": t.instrument_id,
+                    "price": from_units(t.price),
+                    "quantity": from_units(t.quantity),
+                    "timestamp": t.timestamp,
+                } for t in trades])
+                await candles.merge(db, candles.aggregate(
+                    (t.instrument_id, from_units(t.price), from_units(t.quantity), t.timestamp) for t in trades
+                ))
+                if self.notify_trades:
+                    await db.execute(text("SELECT pg_notify(:channel, :payload)"), {
+                        "channel": TRADES_CHANNEL,
+                        "payload": ",".join(str(i) for i in sorted({t.instrument_id for t in trades})),
+                    })
+
+            if deltas:
+                await apply_balance_deltas(db, deltas)
+
+            journalled = None
+            if self.journal is not None:
+                journalled = self.journal.prepare(
+                    new_orders.values(), updates.values(), canceled.values(), trades, deltas, amends.values(),
+                )
+                await self.journal.stamp(db, journalled)
+
+            await db.commit()
+
+        if journalled:
+            await self.journal.append(journalled)
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stopping = True
+        self._ready.set()
+        self._full.set()
+        await self._task
+        self._task = None
+        self._stopping = False
+
+
+@dataclass
+class Writes:
+    """A batch of mutations folded into at most one write per order."""
+    new_orders: Dict[str, dict] = field(default_factory=dict)
+    updates: Dict[str, dict] = field(default_factory=dict)
+    amends: Dict[str, dict] = field(default_factory=dict)
+    canceled: Dict[str, RestingOrder] = field(default_factory=dict)
+    trades: List[NewTrade] = field(default_factory=list)
+    deltas: Dict[Tuple[int, int], int] = field(default_factory=dict)
+
+
+def fold(mutations: Iterable) -> Writes:
+    w = Writes()
+    new_orders, updates, amends, canceled = w.new_orders, w.updates, w.amends, w.canceled
+    for m in mutations:
+        if isinstance(m, NewOrder):
+            o = m.order
+            new_orders[o.external_id] = {
+                "external_id": o.external_id,
+                "user_id": o.user_id,
+                "instrument_id": o.instrument_id,
+                "type": m.type,
+                "side": o.side,
+                "price": o.price,
+                "quantity": o.quantity,
+                "filled": m.filled,
+                "status": m.status,
+                "created_at": o.created_at,
+                "priority_at": o.priority_at,
+            }
+        elif isinstance(m, OrderUpdate):
+            row = new_orders.get(m.order.external_id)
+            if row is not None:
+                # Inserted in this very batch: write the final state directly.
+                row["filled"] = m.filled
+                row["status"] = m.status
+            else:
+                updates[m.order.external_id] = {"order": m.order, "filled": m.filled, "status": m.status}
+        elif isinstance(m, OrderAmend):
+            row = new_orders.get(m.order.external_id)
+            if row is not None:
+                row.update(price=m.price, quantity=m.quantity, priority_at=m.priority_at, filled=m.filled, status=m.status)
+            else:
+                amends[m.order.external_id] = {
+                    "order": m.order, "price": m.price, "quantity": m.quantity, "priority_at": m.priority_at,
+                }
+                updates[m.order.external_id] = {"order": m.order, "filled": m.filled, "status": m.status}
+        elif isinstance(m, CancelOrders):
+            for o in m.orders:
+                if o.external_id in new_orders:
+                    new_orders[o.external_id]["status"] = OrderStatus.CANCELED
+                elif o.external_id in updates:
+                    updates[o.external_id]["status"] = OrderStatus.CANCELED
+                else:
+                    canceled[o.external_id] = o
+        elif isinstance(m, NewTrade):
+            w.trades.append(m)
+        elif isinstance(m, BalanceDelta):
+            key = (m.user_id, m.instrument_id)
+            w.deltas[key] = w.deltas.get(key, 0) + m.delta
+    return w
+
+
+def instruments_of(mutations: Iterable) -> Set[int]:
+    instruments = {m.order.instrument_id for m in mutations if isinstance(m, (NewOrder, OrderUpdate, OrderAmend))}
+    instruments |= {m.instrument_id for m in mutations if isinstance(m, (NewTrade, BalanceDelta))}
+    instruments |= {o.instrument_id for m in mutations if isinstance(m, CancelOrders) for o in m.orders}
+    return instruments
+
+
+def order_row(row: dict, closed_at: datetime.datetime) -> dict:
+    return {
+        **row,
+        "price": from_units(row["price"]) if row["price"] is not None else None,
+        "quantity": from_units(row["quantity"]),
+        "filled": from_units(row["filled"]),
+        "closed_at": closed_at if row["status"] in TERMINAL else None,
+    }
+
+
+async def apply_balance_deltas(db, deltas: Dict[Tuple[int, int], int]) -> None:
+    deltas = {k: v for k, v in deltas.items() if v != 0}
+    if not deltas:
+        return
+    existing = {
+        (row.user_id, row.instrument_id): row.id
+        for row in await db.execute(
+            select(Balance.id, Balance.user_id, Balance.instrument_id)
+            .where(tuple_(Balance.user_id, Balance.instrument_id).in_(list(deltas)))
+        )
+    }
+    # Deltas rather than totals: the ledger only loads the keys it has needed,
+    # so trades credit balances whose current amount it never read.
+    table = Balance.__table__
+    if existing:
+        await db.execute(
+            update(table)
+            .where(table.c.id == bindparam("b_id"))
+            .values(amount=table.c.amount + bindparam("delta")),
+            [{"b_id": existing[k], "delta": from_units(v)} for k, v in deltas.items() if k in existing],
+        )
+    missing = [k for k in deltas if k not in existing]
+    if missing:
+        await db.execute(insert(table), [
+            {"user_id": user_id, "instrument_id": instrument_id, "amount": from_units(deltas[(user_id, instrument_id)])}
+            for user_id, instrument_id in missing
+        ])
+
+
+write_behind = WriteBehind(settings.PERSIST_BATCH_MS / 1000, settings.PERSIST_BATCH_MAX_EVENTS)
@@ -0,0 +1,139 @@
+import hashlib
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Set
+from urllib.parse import urlencode
+
+from fastapi import Request, Response
+
+from app import metrics
+from app.config import settings
+
+# Rough per-entry bookkeeping on top of the body and key bytes.
+ENTRY_OVERHEAD = 300
+
+
+class CachedResponse:
+    __slots__ = ("body", "etag", "tag", "size")
+
+    def __init__(self, body: bytes, etag: str, tag: Hashable, size: int):
+        self.body = body
+        self.etag = etag
+        self.tag = tag
+        self.size = size
+
+
+class ResponseCache:
+    """Serialized public responses, dropped when their data changes.
+
+    Every entry has a tag naming what it was built from (the instrument
+    list, one instrument's trades). Writers call invalidate(tag) once the
+    change is committed; there is no TTL. Memory is bounded by max_bytes with
+    least-recently-used eviction.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self.by_tag: Dict[Hashable, Set[str]] = {}
+        # Bumped on every invalidation; a response built from a read that
+        # raced with one is not stored.
+        self.generations: Dict[Hashable, int] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def generation(self, tag: Hashable) -> int:
+        return self.generations.get(tag, 0)
+
+    def put(self, key: str, tag: Hashable, body: bytes, generation: int) -> CachedResponse:
+        entry = CachedResponse(body, '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"', tag,
+                               len(body) + len(key) + ENTRY_OVERHEAD)
+        if self.generation(tag) != generation or entry.size > self.max_bytes:
+            return entry
+        self._drop(key)
+        self.entries[key] = entry
+        self.by_tag.setdefault(tag, set()).add(key)
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+        return entry
+
+    def _drop(self, key: str) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry.size
+        keys = self.by_tag.get(entry.tag)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_tag[entry.tag]
+
+    def invalidate(self, tag: Hashable) -> None:
+        self.generations[tag] = self.generation(tag) + 1
+        for key in list(self.by_tag.get(tag, ())):
+            self._drop(key)
+
+    def clear(self) -> None:
+        for tag in list(self.generations) + list(self.by_tag):
+            self.generations[tag] = self.generation(tag) + 1
+        self.entries.clear()
+        self.by_tag.clear()
+        self.size = 0
+
+    def on_trades(self, instrument_ids: Set[int]) -> None:
+        for instrument_id in instrument_ids:
+            self.invalidate(("trades", instrument_id))
+
+    def on_trades_notify(self, payload: str) -> None:
+        self.on_trades({int(i) for i in payload.split(",")})
+
+    def on_instrument_changed(self, instrument_id: Optional[int]) -> None:
+        if instrument_id is None:
+            self.clear()
+            return
+        self.invalidate("instruments")
+        self.invalidate(("trades", instrument_id))
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "bytes": self.size, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+
+response_cache = ResponseCache(settings.RESPONSE_CACHE_BYTES)
+
+metrics.Gauge(
+    "exchange_response_cache_lookups_total", "Response cache lookups",
+    lambda: ((("hit",), response_cache.hits), (("miss",), response_cache.misses)),
+    ("result",), type="counter",
+)
+metrics.Gauge(
+    "exchange_response_cache_bytes", "Bytes held by the response cache",
+    lambda: (((), response_cache.size),),
+)
+
+
+async def cached(request: Request, tag: Hashable, build: Callable[[], Awaitable[bytes]]) -> Response:
+    """Serve ``build()``'s JSON from the cache, answering If-None-Match with 304."""
+    if response_cache.max_bytes <= 0:
+        return Response(content=await build(), media_type="application/json")
+    key = request.url.path + "?" + urlencode(sorted(request.query_params.multi_items()))
+    entry = response_cache.get(key)
+    if entry is None:
+        generation = response_cache.generation(tag)
+        entry = response_cache.put(key, tag, await build(), generation)
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if entry.etag in request.headers.get("if-none-match", "").replace("W/", "").split(", "):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
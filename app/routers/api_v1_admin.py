@@ -1,12 +1,18 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from decimal import Decimal
 
 from app.database import get_db
-from app.auth import get_current_user
-from app.models import User, Instrument
-from app import crud, schemas
+from app.auth import get_current_user, token_cache
+from app.response_cache import response_cache
+from app.capture import capture_writer
+from app.archive import archiver
+from app.models import User
+from app.instruments import registry
+from app.matching import SCALE
+from app import crud, exchange, schemas
+from app.gateway import gateway
+from app.sequencer import sequencer
 
 router = APIRouter(prefix="/api/v1/admin", tags=["admin"])
 
@@ -24,6 +30,7 @@ async def delete_user(user_id: str, admin=Depends(admin_required), db: AsyncSess
         raise HTTPException(404, "User not found")
     await db.delete(u)
     await db.commit()
+    token_cache.invalidate(u.token)
     return schemas.User(
         id=user_id,
         name=u.name,
@@ -39,6 +46,7 @@ async def delete_user(user_id: str, admin=Depends(admin_required), db: AsyncSess
         raise HTTPException(404, "User not found")
     await db.delete(u)
     await db.commit()
+    token_cache.invalidate(u.token)
     return schemas.User(
         id=user_id,
         name=u.name,
@@ -51,13 +59,16 @@ async def delete_user(user_id: str, admin=Depends(admin_required), db: AsyncSess
 async def add_instrument(body: schemas.Instrument, admin=Depends(admin_required), db: AsyncSession = Depends(get_db)):
     if not body.ticker.isupper():
         raise HTTPException(422, "Ticker must be uppercase")
-    await crud.create_instrument(db, symbol=body.ticker, name=body.name, instrument_type=crud.InstrumentType.MEMECOIN)
+    await crud.create_instrument(
+        db, symbol=body.ticker, name=body.name, instrument_type=crud.InstrumentType.MEMECOIN,
+        tick_size=body.tick_size, lot_size=body.lot_size,
+    )
     return schemas.Ok()
 
 
 @router.delete("/instrument/{ticker}", response_model=schemas.Ok)
 async def delete_instrument(ticker: str, admin=Depends(admin_required), db: AsyncSession = Depends(get_db)):
-    inst = await crud.get_instrument_by_symbol(db, ticker)
+    inst = registry.get(ticker)
     if not inst:
         raise HTTPException(404, "Instrument not found")
     await crud.delist_instrument(db, inst.id)
@@ -75,10 +86,11 @@ async def deposit(
     ).scalar_one_or_none()
     if not u:
         raise HTTPException(404, "User not found")
-    inst = await crud.get_instrument_by_symbol(db, body.ticker)
+    inst = registry.get(body.ticker)
     if not inst:
         raise HTTPException(404, "Instrument not found")
-    await crud.adjust_balance(db, u.id, inst.id, Decimal(body.amount))
+    await db.close()
+    await gateway.adjust_balance(u.id, inst.id, body.amount * SCALE)
     return schemas.Ok()
 
 
@@ -93,15 +105,37 @@ async def withdraw(
     ).scalar_one_or_none()
     if not u:
         raise HTTPException(404, "User not found")
-    inst = await crud.get_instrument_by_symbol(db, body.ticker)
+    inst = registry.get(body.ticker)
     if not inst:
         raise HTTPException(404, "Instrument not found")
-    await crud.adjust_balance(db, u.id, inst.id, Decimal(-body.amount))
+    await db.close()
+    try:
+        await gateway.adjust_balance(u.id, inst.id, -body.amount * SCALE)
+    except exchange.InsufficientBalance:
+        raise HTTPException(400, "Insufficient balance")
     return schemas.Ok()
 
 
+@router.get("/stats/sequencer")
+async def sequencer_stats(admin=Depends(admin_required)):
+    return {str(k): v for k, v in sequencer.stats().items()}
+
+
+@router.get("/stats/auth")
+async def auth_stats(admin=Depends(admin_required)):
+    return token_cache.stats()
+
 
+@router.get("/stats/response-cache")
+async def response_cache_stats(admin=Depends(admin_required)):
+    return response_cache.stats()
 
 
+@router.get("/stats/capture")
+async def capture_stats(admin=Depends(admin_required)):
+    return capture_writer.stats()
 
 
+@router.get("/stats/archive")
+async def archive_stats(admin=Depends(admin_required)):
+    return archiver.stats()
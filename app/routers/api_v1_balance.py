@@ -5,20 +5,21 @@ from decimal import Decimal
 
 from app.database import get_db
 from app.auth import get_current_user
-from app.models import Balance, Instrument
+from app.models import Balance
 from app import schemas
+from app.instruments import registry
 
 router = APIRouter(prefix="/api/v1", tags=["balance"])
 
 
 @router.get("/balance", tags=["balance"], response_model=schemas.BalanceMap)
 async def get_balances(user=Depends(get_current_user), db: AsyncSession = Depends(get_db)):
-    res = await db.execute(select(Balance).where(Balance.user_id == user.id))
-    balances = res.scalars().all()
+    res = await db.execute(select(Balance.instrument_id, Balance.amount).where(Balance.user_id == user.id))
     out = {}
-    for b in balances:
-        inst: Instrument = b.instrument
-        out[inst.symbol] = int(Decimal(b.amount))
+    for instrument_id, amount in res:
+        symbol = registry.symbol(instrument_id)
+        if symbol is not None:
+            out[symbol] = int(Decimal(amount))
     return schemas.BalanceMap(root=out)
 
 
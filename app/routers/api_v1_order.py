@@ -1,23 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, tuple_, union_all
 from decimal import Decimal
-import uuid
+from typing import AsyncIterator, List, Optional, Tuple, Union
+import base64
 import datetime
-from typing import Optional, List, Union
+import time
 
-from app.database import get_db
+from app.config import settings
+from app.database import get_db, AsyncSessionLocal
 from app.auth import get_current_user
 from app.models import (
-    Instrument, Order, Trade, Balance,
+    Instrument, Order, OrderArchive,
     OrderType, OrderStatus, Side
 )
-from app import schemas
+from app import exchange, metrics, schemas
+from app.gateway import gateway
+from app.instruments import InstrumentInfo, registry
+from app.matching import ACTIVE_STATUSES, SCALE, whole
 
 router = APIRouter(prefix="/api/v1", tags=["order"])
 
 OrderResponse = Union[schemas.LimitOrder, schemas.MarketOrder]
 OrderBody = Union[schemas.LimitOrderBody, schemas.MarketOrderBody]
+ORDER_SCHEMA = {"anyOf": [{"$ref": "#/components/schemas/LimitOrder"}, {"$ref": "#/components/schemas/MarketOrder"}]}
 
 
 def to_api_status(status: OrderStatus) -> schemas.OrderStatus:
@@ -30,85 +37,44 @@ def to_api_status(status: OrderStatus) -> schemas.OrderStatus:
     return mapping[status]
 
 
-async def get_or_create_balance(db: AsyncSession, user_id: int, instrument_id: int) -> Balance:
-    res = await db.execute(select(Balance).where(Balance.user_id == user_id, Balance.instrument_id == instrument_id))
-    bal = res.scalar_one_or_none()
-    if not bal:
-        bal = Balance(user_id=user_id, instrument_id=instrument_id, amount=Decimal(0))
-        db.add(bal)
-        await db.flush()
-    return bal
+FROM_API_STATUS = {
+    schemas.OrderStatus.NEW: OrderStatus.NEW,
+    schemas.OrderStatus.PARTIALLY_EXECUTED: OrderStatus.PARTIAL,
+    schemas.OrderStatus.EXECUTED: OrderStatus.FILLED,
+    schemas.OrderStatus.CANCELLED: OrderStatus.CANCELED,
+}
 
+HISTORY_PAGE = 500
 
-async def execute_against_book(db: AsyncSession, inst: Instrument, incoming: Order) -> None:
-    if incoming.side == Side.BUY:
-        q = select(Order).where(
-            Order.instrument_id == inst.id,
-            Order.side == Side.SELL,
-            Order.status.in_([OrderStatus.NEW, OrderStatus.PARTIAL])
-        ).order_by(Order.price.asc())
-    else:
-        q = select(Order).where(
-            Order.instrument_id == inst.id,
-            Order.side == Side.BUY,
-            Order.status.in_([OrderStatus.NEW, OrderStatus.PARTIAL])
-        ).order_by(Order.price.desc())
-
-    book = (await db.execute(q)).scalars().all()
-
-    remaining = Decimal(incoming.quantity) - Decimal(incoming.filled)
-    for resting in book:
-        if remaining <= 0:
-            break
-        if incoming.type == OrderType.LIMIT and resting.price is not None and incoming.price is not None:
-            if incoming.side == Side.BUY and Decimal(incoming.price) < Decimal(resting.price):
-                break
-            if incoming.side == Side.SELL and Decimal(incoming.price) > Decimal(resting.price):
-                break
-        trade_qty = min(remaining, Decimal(resting.quantity) - Decimal(resting.filled))
-        if trade_qty <= 0:
-            continue
-        trade_price = Decimal(resting.price) if resting.price is not None else Decimal(incoming.price or 0)
 
-        buyer_id = incoming.user_id if incoming.side == Side.BUY else resting.user_id
-        seller_id = resting.user_id if incoming.side == Side.BUY else incoming.user_id
+def order_columns(table) -> tuple:
+    # Plain columns plus the joined symbol: no ORM identity map to grow and no
+    # lazy `instrument` load per row.
+    return (
+        table.id, table.external_id, table.type, table.side, table.price,
+        table.quantity, table.filled, table.status, table.created_at, Instrument.symbol,
+    )
+
 
-        buyer_bal = await get_or_create_balance(db, buyer_id, inst.id)
-        seller_bal = await get_or_create_balance(db, seller_id, inst.id)
+def find_order(table, order_id: str, user_id: int):
+    return (
+        select(*order_columns(table))
+        .join(Instrument, Instrument.id == table.instrument_id)
+        .where(table.external_id == order_id, table.user_id == user_id)
+    )
 
-        buyer_bal.amount = Decimal(buyer_bal.amount) + trade_qty
-        seller_bal.amount = Decimal(seller_bal.amount) - trade_qty
 
-        incoming.filled = Decimal(incoming.filled) + trade_qty
-        resting.filled = Decimal(resting.filled) + trade_qty
-        if Decimal(resting.filled) >= Decimal(resting.quantity):
-            resting.status = OrderStatus.FILLED
-        else:
-            resting.status = OrderStatus.PARTIAL
-
-        db.add(Trade(
-            buy_order_id=incoming.id if incoming.side == Side.BUY else resting.id,
-            sell_order_id=resting.id if incoming.side == Side.BUY else incoming.id,
-            instrument_id=inst.id,
-            price=trade_price,
-            quantity=trade_qty,
-            timestamp=datetime.datetime.utcnow(),
-        ))
-
-        remaining = Decimal(incoming.quantity) - Decimal(incoming.filled)
-
-    if remaining <= 0:
-        incoming.status = OrderStatus.FILLED
-    elif Decimal(incoming.filled) > 0:
-        incoming.status = OrderStatus.PARTIAL
-    else:
-        incoming.status = OrderStatus.NEW
+async def is_archived(db: AsyncSession, order_id: str, user_id: int) -> bool:
+    return (await db.execute(
+        select(OrderArchive.id).where(OrderArchive.external_id == order_id, OrderArchive.user_id == user_id)
+    )).first() is not None
 
 
-def serialize_order(o: Order, user_external_id: str) -> OrderResponse:
+def serialize_order(o, user_external_id: str) -> OrderResponse:
+    """`o` is an order row selected with order_columns()."""
     base_body = {
         "direction": schemas.Direction.BUY if o.side == Side.BUY else schemas.Direction.SELL,
-        "ticker": o.instrument.symbol,
+        "ticker": o.symbol,
         "qty": int(Decimal(o.quantity)),
     }
     if o.type == OrderType.LIMIT:
@@ -132,52 +98,266 @@ def serialize_order(o: Order, user_external_id: str) -> OrderResponse:
         )
 
 
-@router.post("/order", response_model=schemas.CreateOrderResponse)
-async def create_order(body: OrderBody, user=Depends(get_current_user), db: AsyncSession = Depends(get_db)):
-    inst = (await db.execute(select(Instrument).where(Instrument.symbol == body.ticker))).scalar_one_or_none()
-    if not inst or not inst.is_listed:
-        raise HTTPException(404, "Instrument not found or delisted")
+def order_args(body: OrderBody) -> dict:
+    is_limit = isinstance(body, schemas.LimitOrderBody)
+    return {
+        "order_type": OrderType.LIMIT if is_limit else OrderType.MARKET,
+        "side": Side.BUY if body.direction == schemas.Direction.BUY else Side.SELL,
+        "quantity": body.qty * SCALE,
+        "price": body.price * SCALE if is_limit else None,
+    }
 
-    order = Order(
-        external_id=str(uuid.uuid4()),
-        user_id=user.id,
-        instrument_id=inst.id,
-        type=OrderType.LIMIT if isinstance(body, schemas.LimitOrderBody) else OrderType.MARKET,
-        side=Side.BUY if body.direction == schemas.Direction.BUY else Side.SELL,
-        quantity=Decimal(body.qty),
-        price=Decimal(body.price) if isinstance(body, schemas.LimitOrderBody) else None,
-    )
-    db.add(order)
-    await db.flush()
 
-    await execute_against_book(db, inst, order)
-    await db.commit()
-    return schemas.CreateOrderResponse(order_id=order.external_id)
+def increment_error(inst: InstrumentInfo, args: dict) -> Optional[str]:
+    if args["quantity"] is not None and args["quantity"] % inst.lot:
+        return f"Quantity must be a multiple of the lot size {whole(inst.lot)}"
+    if args["price"] is not None and args["price"] % inst.tick:
+        return f"Price must be a multiple of the tick size {whole(inst.tick)}"
+    return None
 
 
-@router.get("/order", response_model=List[OrderResponse])
-async def list_orders(user=Depends(get_current_user), db: AsyncSession = Depends(get_db)):
-    rows = (await db.execute(select(Order).where(Order.user_id == user.id))).scalars().all()
-    return [serialize_order(o, user.external_id) for o in rows]
+@router.post("/order", response_model=schemas.CreateOrderResponse)
+async def create_order(body: OrderBody, user=Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    started = time.perf_counter()
+    inst = registry.listed(body.ticker)
+    if not inst:
+        raise HTTPException(404, "Instrument not found or delisted")
+    args = order_args(body)
+    error = increment_error(inst, args)
+    if error:
+        raise HTTPException(422, error)
+    metrics.ORDER_STAGE.observe(time.perf_counter() - started, "instrument")
+    # Hand the connection (if auth needed one) back to the pool while waiting
+    # on the sequencer and the write-behind stage, which needs connections of
+    # its own.
+    await db.close()
+
+    started = time.perf_counter()
+    try:
+        order_id = await gateway.place_order(user_id=user.id, instrument_id=inst.id, **args)
+    except exchange.InsufficientBalance:
+        raise HTTPException(400, "Insufficient balance")
+    finally:
+        # Sequencer wait, matching and commit; the parts are broken out below it.
+        metrics.ORDER_STAGE.observe(time.perf_counter() - started, "gateway")
+    return schemas.CreateOrderResponse(order_id=order_id)
+
+
+@router.post("/order/batch", response_model=schemas.OrderBatchResponse)
+async def create_orders(body: schemas.OrderBatchBody, user=Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    if len(body.orders) > settings.ORDER_BATCH_MAX:
+        raise HTTPException(422, f"At most {settings.ORDER_BATCH_MAX} orders per batch")
+    await db.close()
+
+    results: List[Optional[schemas.OrderBatchResult]] = [None] * len(body.orders)
+    items, slots = [], []
+    for i, item in enumerate(body.orders):
+        inst = registry.listed(item.ticker)
+        if not inst:
+            results[i] = schemas.OrderBatchResult(success=False, error="Instrument not found or delisted")
+            continue
+        args = order_args(item)
+        error = increment_error(inst, args)
+        if error:
+            results[i] = schemas.OrderBatchResult(success=False, error=error)
+            continue
+        items.append({"instrument_id": inst.id, **args})
+        slots.append(i)
+
+    for i, outcome in zip(slots, await gateway.place_orders(user.id, items)):
+        if isinstance(outcome, exchange.InsufficientBalance):
+            results[i] = schemas.OrderBatchResult(success=False, error="Insufficient balance")
+        elif isinstance(outcome, Exception):
+            results[i] = schemas.OrderBatchResult(success=False, error="Order could not be processed")
+        else:
+            results[i] = schemas.OrderBatchResult(success=True, order_id=outcome)
+    return schemas.OrderBatchResponse(results=results)
+
+
+def encode_cursor(created_at: datetime.datetime, order_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{order_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    try:
+        ts, _, order_id = base64.urlsafe_b64decode(cursor.encode()).decode().partition("|")
+        return datetime.datetime.fromisoformat(ts), int(order_id)
+    except ValueError:
+        raise HTTPException(400, "Invalid cursor")
+
+
+def history_select(table, user_id: int, statuses: List[OrderStatus], after: Optional[Tuple[datetime.datetime, int]], limit: int):
+    q = select(*order_columns(table)).join(Instrument, Instrument.id == table.instrument_id).where(table.user_id == user_id)
+    if statuses:
+        q = q.where(table.status.in_(statuses))
+    if after is not None:
+        q = q.where(tuple_(table.created_at, table.id) < after)
+    # Newest first; walks ix_orders_user_created (ix_orders_archive_user_created) backwards.
+    return q.order_by(table.created_at.desc(), table.id.desc()).limit(limit)
+
+
+def history_query(user_id: int, statuses: List[OrderStatus], after: Optional[Tuple[datetime.datetime, int]], limit: int):
+    hot = history_select(Order, user_id, statuses, after, limit)
+    if statuses and set(statuses) <= set(ACTIVE_STATUSES):
+        # Active orders are never archived.
+        return hot
+    # A page from each table, merged. An order is in exactly one of them.
+    archived = history_select(OrderArchive, user_id, statuses, after, limit)
+    merged = union_all(select(hot.subquery()), select(archived.subquery())).subquery()
+    return select(merged).order_by(merged.c.created_at.desc(), merged.c.id.desc()).limit(limit)
+
+
+async def iter_history(
+    user_id: int, statuses: List[OrderStatus], after: Optional[Tuple[datetime.datetime, int]], limit: Optional[int],
+) -> AsyncIterator:
+    """Yield order rows page by page, each page on a short-lived session."""
+    left = limit
+    while left is None or left > 0:
+        page = HISTORY_PAGE if left is None else min(left, HISTORY_PAGE)
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(history_query(user_id, statuses, after, page))).all()
+        for row in rows:
+            yield row
+        if len(rows) < page:
+            return
+        after = (rows[-1].created_at, rows[-1].id)
+        if left is not None:
+            left -= len(rows)
+
+
+async def ndjson_lines(rows: AsyncIterator, user_external_id: str) -> AsyncIterator[bytes]:
+    async for row in rows:
+        yield serialize_order(row, user_external_id).model_dump_json().encode() + b"\n"
+
+
+async def json_array(rows: AsyncIterator, user_external_id: str) -> AsyncIterator[bytes]:
+    sep = b"["
+    async for row in rows:
+        yield sep + serialize_order(row, user_external_id).model_dump_json().encode()
+        sep = b","
+    yield b"[]" if sep == b"[" else b"]"
+
+
+@router.get(
+    "/order",
+    response_model=List[OrderResponse],
+    response_class=StreamingResponse,
+    # StreamingResponse has no media type of its own, so both are spelled out.
+    responses={200: {
+        "description": "A JSON array, or with `format=ndjson` one order per line.",
+        "headers": {"X-Next-Cursor": {
+            "description": "With `limit`: cursor for the next page, absent on the last one.",
+            "schema": {"type": "string"},
+        }},
+        "content": {
+            "application/json": {"schema": {"type": "array", "items": ORDER_SCHEMA}},
+            "application/x-ndjson": {"schema": ORDER_SCHEMA},
+        },
+    }},
+)
+async def list_orders(
+    status: List[schemas.OrderStatus] = Query([]),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    user=Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """Order history, newest first.
+
+    Without `limit` the whole history is streamed. With `limit` one page is
+    returned and, if there may be more, the cursor for the next one is sent
+    in the `X-Next-Cursor` header.
+    """
+    statuses = [FROM_API_STATUS[s] for s in status]
+    after = decode_cursor(cursor) if cursor else None
+    media_type = "application/x-ndjson" if format == "ndjson" else "application/json"
+
+    if limit is None:
+        encode = ndjson_lines if format == "ndjson" else json_array
+        # The stream opens its own session per page; don't pin this one.
+        await db.close()
+        return StreamingResponse(encode(iter_history(user.id, statuses, after, None), user.external_id), media_type=media_type)
+
+    rows = (await db.execute(history_query(user.id, statuses, after, limit))).all()
+    items = [serialize_order(row, user.external_id).model_dump_json().encode() for row in rows]
+    content = b"".join(item + b"\n" for item in items) if format == "ndjson" else b"[" + b",".join(items) + b"]"
+    headers = {}
+    if len(rows) == limit:
+        headers["X-Next-Cursor"] = encode_cursor(rows[-1].created_at, rows[-1].id)
+    return Response(content=content, media_type=media_type, headers=headers)
 
 
 @router.get("/order/{order_id}", response_model=OrderResponse)
 async def get_order(order_id: str, user=Depends(get_current_user), db: AsyncSession = Depends(get_db)):
-    o = (await db.execute(select(Order).where(Order.external_id == order_id, Order.user_id == user.id))).scalar_one_or_none()
+    o = (await db.execute(find_order(Order, order_id, user.id))).one_or_none()
+    if not o:
+        o = (await db.execute(find_order(OrderArchive, order_id, user.id))).one_or_none()
     if not o:
         raise HTTPException(404, "Order not found")
     return serialize_order(o, user.external_id)
 
 
+@router.delete("/order", response_model=schemas.CancelOrdersResponse)
+async def cancel_orders(ticker: str, user=Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    inst = registry.get(ticker)
+    if not inst:
+        raise HTTPException(404, "Instrument not found")
+    await db.close()
+    return schemas.CancelOrdersResponse(order_ids=await gateway.cancel_user_orders(user.id, inst.id))
+
+
+@router.patch("/order/{order_id}", response_model=schemas.Ok)
+async def amend_order(order_id: str, body: schemas.AmendOrderBody, user=Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    instrument_id = (await db.execute(
+        select(Order.instrument_id).where(Order.external_id == order_id, Order.user_id == user.id)
+    )).scalar_one_or_none()
+    if instrument_id is None:
+        if await is_archived(db, order_id, user.id):
+            raise HTTPException(400, "Cannot amend")
+        raise HTTPException(404, "Order not found")
+    inst = registry.by_id.get(instrument_id)
+    if not inst or not inst.is_listed:
+        raise HTTPException(404, "Instrument not found or delisted")
+    args = {
+        "quantity": body.qty * SCALE if body.qty is not None else None,
+        "price": body.price * SCALE if body.price is not None else None,
+    }
+    error = increment_error(inst, args)
+    if error:
+        raise HTTPException(422, error)
+    await db.close()
+    # A smaller size keeps the order's place in the queue; a new price or a
+    # larger size re-queues it behind everything already resting.
+    try:
+        await gateway.amend_order(instrument_id, order_id, **args)
+    except exchange.OrderNotActive:
+        raise HTTPException(400, "Cannot amend")
+    except exchange.InvalidAmend as e:
+        raise HTTPException(400, str(e))
+    except exchange.InsufficientBalance:
+        raise HTTPException(400, "Insufficient balance")
+    return schemas.Ok()
+
+
 @router.delete("/order/{order_id}", response_model=schemas.Ok)
 async def cancel_order(order_id: str, user=Depends(get_current_user), db: AsyncSession = Depends(get_db)):
-    o = (await db.execute(select(Order).where(Order.external_id == order_id, Order.user_id == user.id))).scalar_one_or_none()
-    if not o:
+    # Only the instrument is needed to find the book; whether the order is
+    # still active is decided there, in sequence with fills, not from a
+    # database status that may lag behind it.
+    instrument_id = (await db.execute(
+        select(Order.instrument_id).where(Order.external_id == order_id, Order.user_id == user.id)
+    )).scalar_one_or_none()
+    if instrument_id is None:
+        # Archived orders are terminal.
+        if await is_archived(db, order_id, user.id):
+            raise HTTPException(400, "Cannot cancel")
         raise HTTPException(404, "Order not found")
-    if o.status not in (OrderStatus.NEW, OrderStatus.PARTIAL):
+    await db.close()
+    try:
+        await gateway.cancel_order(instrument_id, order_id)
+    except exchange.OrderNotActive:
         raise HTTPException(400, "Cannot cancel")
-    o.status = OrderStatus.CANCELED
-    await db.commit()
     return schemas.Ok()
 
 
@@ -1,4 +1,5 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from pydantic import TypeAdapter
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from typing import List
@@ -6,10 +7,17 @@ from decimal import Decimal
 import uuid
 import datetime
 
-from app.database import get_db
+from app.database import get_db, engine, read_engine, ReadSessionLocal
 from app.auth import create_token
-from app.models import User, Instrument, Order, Trade, Side, OrderStatus
+from app.models import User, Trade
+from app.instruments import registry
+from app.matching import whole
 from app import schemas
+from app.gateway import gateway
+from app.response_cache import cached
+
+instruments_json = TypeAdapter(List[schemas.Instrument]).dump_json
+transactions_json = TypeAdapter(List[schemas.Transaction]).dump_json
 
 router = APIRouter(prefix="/api/v1/public", tags=["public"])
 
@@ -37,76 +45,62 @@ async def register(data: schemas.NewUser, db: AsyncSession = Depends(get_db)):
 
 
 @router.get("/instrument", response_model=List[schemas.Instrument])
-async def list_instruments(db: AsyncSession = Depends(get_db)):
-    res = await db.execute(select(Instrument).where(Instrument.is_listed == True))
-    instruments: List[Instrument] = res.scalars().all()
-    return [schemas.Instrument(name=i.name, ticker=i.symbol) for i in instruments]
+async def list_instruments(request: Request):
+    async def build():
+        return instruments_json([
+            schemas.Instrument(name=i.name, ticker=i.symbol, tick_size=whole(i.tick), lot_size=whole(i.lot))
+            for i in registry.all_listed()
+        ])
+
+    return await cached(request, "instruments", build)
 
 
 @router.get("/orderbook/{ticker}", response_model=schemas.L2OrderBook)
 async def get_orderbook(
     ticker: str,
     limit: int = Query(10, le=25),
-    db: AsyncSession = Depends(get_db)
 ):
-    inst = (await db.execute(select(Instrument).where(Instrument.symbol == ticker))).scalar_one_or_none()
-    if not inst or not inst.is_listed:
+    inst = registry.listed(ticker)
+    if not inst:
         raise HTTPException(404, "Instrument not found")
-    asks = (await db.execute(
-        select(Order).where(
-            Order.instrument_id == inst.id,
-            Order.side == Side.SELL,
-            Order.status.in_([OrderStatus.NEW, OrderStatus.PARTIAL])
-        ).order_by(Order.price.asc()).limit(limit)
-    )).scalars().all()
-    bids = (await db.execute(
-        select(Order).where(
-            Order.instrument_id == inst.id,
-            Order.side == Side.BUY,
-            Order.status.in_([OrderStatus.NEW, OrderStatus.PARTIAL])
-        ).order_by(Order.price.desc()).limit(limit)
-    )).scalars().all()
-
-    def levelize(rows: List[Order]):
-        return [
-            schemas.Level(
-                price=int(Decimal(o.price)),
-                qty=int(Decimal(o.quantity) - Decimal(o.filled))
-            )
-            for o in rows
-            if o.price is not None
-        ]
-
-    return schemas.L2OrderBook(
-        bid_levels=levelize(bids),
-        ask_levels=levelize(asks)
-    )
+    return Response(content=await gateway.l2_snapshot(inst.id, limit), media_type="application/json")
 
 
 @router.get("/transactions/{ticker}", response_model=List[schemas.Transaction])
 async def get_transaction_history(
+    request: Request,
     ticker: str,
     limit: int = Query(10, le=100),
-    db: AsyncSession = Depends(get_db)
 ):
-    inst = (await db.execute(select(Instrument).where(Instrument.symbol == ticker))).scalar_one_or_none()
+    inst = registry.get(ticker)
     if not inst:
         raise HTTPException(404, "Instrument not found")
-    trades = (await db.execute(
-        select(Trade)
-        .where(Trade.instrument_id == inst.id)
-        .order_by(Trade.timestamp.desc())
-        .limit(limit)
-    )).scalars().all()
-    return [
-        schemas.Transaction(
-            ticker=ticker,
-            amount=int(Decimal(t.quantity)),
-            price=int(Decimal(t.price)),
-            timestamp=t.timestamp,
-        )
-        for t in trades
-    ]
+
+    async def build():
+        # A single read: the connection goes back to the pool before the
+        # response is serialized instead of when the dependency is torn down.
+        async with ReadSessionLocal() as db:
+            trades = (await db.execute(
+                select(Trade)
+                .where(Trade.instrument_id == inst.id)
+                .order_by(Trade.timestamp.desc())
+                .limit(limit)
+            )).scalars().all()
+        return transactions_json([
+            schemas.Transaction(
+                ticker=ticker,
+                amount=int(Decimal(t.quantity)),
+                price=int(Decimal(t.price)),
+                timestamp=t.timestamp,
+            )
+            for t in trades
+        ])
+
+    # Invalidation follows primary commits; a lagging replica could refill
+    # the cache with pre-trade history that then never expires.
+    if read_engine is not engine:
+        return Response(content=await build(), media_type="application/json")
+    return await cached(request, ("trades", inst.id), build)
 
 
 
@@ -3,7 +3,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
 from app.database import get_db
-from app.auth import get_current_user
+from app.auth import get_current_user, token_cache
 from app.models import User
 from app import schemas
 
@@ -24,6 +24,7 @@ async def delete_user(user_id: str, admin=Depends(admin_required), db: AsyncSess
         raise HTTPException(404, "User not found")
     await db.delete(u)
     await db.commit()
+    token_cache.invalidate(u.token)
     return schemas.User(
         id=user_id,
         name=u.name,
@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field, RootModel
-from typing import Optional, List, Dict, Literal
+from pydantic import BaseModel, Field, RootModel, model_validator
+from typing import Optional, List, Dict, Literal, Union
 from datetime import datetime
 from enum import Enum
 
@@ -52,6 +52,8 @@ class User(BaseModel):
 class Instrument(BaseModel):
     name: str
     ticker: str
+    tick_size: int = Field(1, ge=1)
+    lot_size: int = Field(1, ge=1)
 
 
 class Level(BaseModel):
@@ -79,6 +81,17 @@ class MarketOrderBody(BaseModel):
     qty: int = Field(ge=1)
 
 
+class AmendOrderBody(BaseModel):
+    qty: Optional[int] = Field(None, ge=1)  # new total quantity, filled part included
+    price: Optional[int] = Field(None, gt=0)
+
+    @model_validator(mode="after")
+    def has_change(self):
+        if self.qty is None and self.price is None:
+            raise ValueError("Give qty, price or both")
+        return self
+
+
 class LimitOrder(BaseModel):
     id: str  # uuid4
     status: OrderStatus
@@ -96,6 +109,25 @@ class MarketOrder(BaseModel):
     body: MarketOrderBody
 
 
+class OrderBatchBody(BaseModel):
+    orders: List[Union[LimitOrderBody, MarketOrderBody]] = Field(min_length=1)
+
+
+class OrderBatchResult(BaseModel):
+    success: bool
+    order_id: Optional[str] = None
+    error: Optional[str] = None
+
+
+class OrderBatchResponse(BaseModel):
+    results: List[OrderBatchResult]
+
+
+class CancelOrdersResponse(BaseModel):
+    success: Literal[True] = True
+    order_ids: List[str]
+
+
 # === Transactions / history ===
 
 class Transaction(BaseModel):
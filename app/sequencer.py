@@ -0,0 +1,110 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from app.config import settings
+from app import metrics
+
+Job = Callable[[], Awaitable[Any]]
+
+
+class LaneStats:
+    __slots__ = ("processed", "failed", "wait_total", "wait_max", "service_total", "service_max")
+
+    def __init__(self):
+        self.processed = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.service_total = 0.0
+        self.service_max = 0.0
+
+
+class Lane:
+    def __init__(self, key: int, maxsize: int):
+        self.key = key
+        self.queue: "asyncio.Queue[tuple]" = asyncio.Queue(maxsize)
+        self.stats = LaneStats()
+        self.task = asyncio.create_task(self._run(), name=f"sequencer-{key}")
+
+    async def _run(self):
+        while True:
+            job, future, enqueued = await self.queue.get()
+            started = time.perf_counter()
+            wait = started - enqueued
+            self.stats.wait_total += wait
+            self.stats.wait_max = max(self.stats.wait_max, wait)
+            metrics.SEQUENCER_WAIT.observe(wait)
+            try:
+                if not future.cancelled():
+                    result = await job()
+                    if not future.cancelled():
+                        future.set_result(result)
+            except Exception as e:
+                self.stats.failed += 1
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                service = time.perf_counter() - started
+                self.stats.processed += 1
+                self.stats.service_total += service
+                self.stats.service_max = max(self.stats.service_max, service)
+                metrics.SEQUENCER_JOB.observe(service)
+                self.queue.task_done()
+
+
+class Sequencer:
+    """Runs jobs one at a time per instrument, in submission order.
+
+    Every instrument gets its own queue and worker task, so two orders for the
+    same ticker never interleave while different tickers proceed in parallel.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        self.maxsize = maxsize
+        self.lanes: Dict[int, Lane] = {}
+
+    def _lane(self, key: int) -> Lane:
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = self.lanes[key] = Lane(key, self.maxsize)
+        return lane
+
+    async def submit(self, key: int, job: Job) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        await self._lane(key).queue.put((job, future, time.perf_counter()))
+        # Shield the job from request cancellation: once queued it must run to
+        # completion so the book and the database stay in step.
+        return await asyncio.shield(future)
+
+    def stats(self, key: Optional[int] = None) -> Dict[int, dict]:
+        out = {}
+        for k, lane in self.lanes.items():
+            if key is not None and k != key:
+                continue
+            s = lane.stats
+            out[k] = {
+                "queue_depth": lane.queue.qsize(),
+                "processed": s.processed,
+                "failed": s.failed,
+                "wait_avg_ms": s.wait_total / s.processed * 1000 if s.processed else 0.0,
+                "wait_max_ms": s.wait_max * 1000,
+                "service_avg_ms": s.service_total / s.processed * 1000 if s.processed else 0.0,
+                "service_max_ms": s.service_max * 1000,
+            }
+        return out
+
+    async def stop(self) -> None:
+        for lane in self.lanes.values():
+            await lane.queue.join()
+            lane.task.cancel()
+        self.lanes.clear()
+
+
+sequencer = Sequencer(settings.SEQUENCER_MAX_QUEUE)
+
+metrics.Gauge(
+    "exchange_sequencer_queue_depth", "Jobs waiting per instrument lane",
+    lambda: (((str(k),), lane.queue.qsize()) for k, lane in list(sequencer.lanes.items())),
+    ("instrument_id",),
+)
@@ -0,0 +1,310 @@
+"""Matching shard worker.
+
+With SHARD_COUNT=N, instruments are partitioned by ``instrument_id % N``.
+Each shard is matched by exactly one process, which holds the shard's lease
+in the shard_leases table and serves the API workers over a framed JSON
+protocol (see app.gateway). A process may own several shards. Started with
+more shards than it currently owns, it stands by and takes over any shard
+whose lease expires.
+
+    SHARD_COUNT=4 python -m app.shards --shards 0,1 --listen unix:/tmp/exchange-shard-a.sock
+    SHARD_COUNT=4 python -m app.shards --shards 2,3 --listen tcp:0.0.0.0:7101 --advertise tcp:shard-b:7101
+    SHARD_COUNT=4 python -m app.shards --shards all --listen tcp:0.0.0.0:7102 --advertise tcp:standby:7102
+
+API workers then run with the same SHARD_COUNT, e.g. ``uvicorn app.main:app --workers 8``.
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import signal
+import socket
+import uuid
+from typing import Dict, List, Set
+
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from app.config import settings
+from app.database import AsyncSessionLocal, engine
+from app.exchange import load_books
+from app.gateway import LocalGateway, NotOwner, SlowConsumer, error_code, read_frame, shard_of, write_frame
+from app.instruments import registry
+from app.journal import journal
+from app.models import Base, ShardLease
+from app.persistence import write_behind
+from app.sequencer import sequencer
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class Leases:
+    def __init__(self, shards: List[int], address: str, ttl: float):
+        self.wanted = shards
+        self.address = address
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.owned: Dict[int, int] = {}  # shard -> epoch
+        self.ready: Set[int] = set()  # owned and loaded, safe to serve
+        self.lost = False
+
+    async def acquire(self, db) -> List[int]:
+        acquired = []
+        for shard in self.wanted:
+            if shard in self.owned:
+                continue
+            stmt = insert(ShardLease).values(
+                shard_id=shard, owner=self.owner, address=self.address, epoch=1, expires_at=func.now() + self.ttl,
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[ShardLease.shard_id],
+                set_={
+                    "owner": self.owner,
+                    "address": self.address,
+                    "epoch": ShardLease.epoch + 1,
+                    "expires_at": func.now() + self.ttl,
+                },
+                where=ShardLease.expires_at < func.now(),
+            ).returning(ShardLease.epoch)
+            epoch = (await db.execute(stmt)).scalar_one_or_none()
+            if epoch is not None:
+                self.owned[shard] = epoch
+                acquired.append(shard)
+        return acquired
+
+    async def renew(self, db) -> None:
+        if not self.owned:
+            return
+        renewed = {
+            row.shard_id: row.epoch
+            for row in await db.execute(
+                update(ShardLease)
+                .where(ShardLease.shard_id.in_(list(self.owned)), ShardLease.owner == self.owner)
+                .values(expires_at=func.now() + self.ttl)
+                .returning(ShardLease.shard_id, ShardLease.epoch)
+            )
+        }
+        if renewed != self.owned:
+            self.lost = True
+            raise LeaseLost(sorted(set(self.owned) - set(renewed)))
+
+    async def fence(self, db) -> None:
+        # Runs inside every write-behind transaction. FOR SHARE makes a
+        # takeover wait until this batch has committed, and a batch written
+        # after a takeover fails here instead of racing the new owner.
+        if not self.owned:
+            return
+        current = {
+            row.shard_id: row.epoch
+            for row in await db.execute(
+                select(ShardLease.shard_id, ShardLease.epoch)
+                .where(ShardLease.shard_id.in_(list(self.owned)), ShardLease.owner == self.owner)
+                .with_for_update(read=True)
+            )
+        }
+        if current != self.owned:
+            self.lost = True
+            raise LeaseLost(sorted(set(self.owned) - set(current)))
+
+    async def release(self, db) -> None:
+        if self.owned:
+            await db.execute(
+                update(ShardLease)
+                .where(ShardLease.shard_id.in_(list(self.owned)), ShardLease.owner == self.owner)
+                .values(expires_at=func.now())
+            )
+
+
+class ShardServer:
+    ops = (
+        "place_order", "place_orders", "amend_order", "cancel_order", "cancel_user_orders", "adjust_balance",
+        "l2_snapshot",
+    )
+
+    def __init__(self, leases: Leases):
+        self.leases = leases
+        self.local = LocalGateway()
+        self.handlers: Dict[asyncio.Task, asyncio.StreamWriter] = {}
+
+    def check_owner(self, instrument_id: int) -> None:
+        if self.leases.lost or shard_of(instrument_id) not in self.leases.ready:
+            raise NotOwner(instrument_id)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.handlers[asyncio.current_task()] = writer
+        tasks = set()
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                if frame["op"] == "stream":
+                    await self.stream(frame["args"], reader, writer)
+                    break
+                task = asyncio.create_task(self.call(frame, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (OSError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+            self.handlers.pop(asyncio.current_task(), None)
+
+    async def close(self) -> None:
+        # asyncio servers leave accepted connections open on close().
+        for task in list(self.handlers):
+            task.cancel()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+
+    async def call(self, frame: dict, writer: asyncio.StreamWriter):
+        op, args = frame["op"], frame["args"]
+        try:
+            if op not in self.ops:
+                raise ValueError(f"unknown op {op}")
+            if op == "place_orders":
+                for item in args["items"]:
+                    self.check_owner(item["instrument_id"])
+            else:
+                self.check_owner(args["instrument_id"])
+            result = await getattr(self.local, op)(**args)
+            if op == "place_orders":
+                result = [{"error": error_code(r)} if isinstance(r, Exception) else r for r in result]
+            elif isinstance(result, bytes):
+                result = result.decode()
+            reply = {"id": frame["id"], "result": result}
+        except Exception as e:
+            code = error_code(e)
+            if code == "internal":
+                logger.exception("shard op %s failed", op)
+            reply = {"id": frame["id"], "error": code, "detail": str(e)}
+        try:
+            write_frame(writer, reply)
+            await writer.drain()
+        except OSError:
+            pass
+
+    async def stream(self, args: dict, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        async def pump():
+            try:
+                self.check_owner(args["instrument_id"])
+                async for message in self.local.stream(args["instrument_id"], args["ticker"]):
+                    write_frame(writer, {"message": message})
+                    await writer.drain()
+            except (NotOwner, SlowConsumer) as e:
+                write_frame(writer, {"error": error_code(e)})
+
+        tasks = [asyncio.create_task(pump()), asyncio.create_task(reader.read())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+async def load_shard(shard: int) -> None:
+    instrument_ids = [i for i in registry.by_id if shard_of(i) == shard]
+    async with AsyncSessionLocal() as db:
+        if journal is not None:
+            await journal.restore(db, shard, instrument_ids)
+            return
+        for instrument_id in instrument_ids:
+            await load_books(db, instrument_id)
+
+
+async def start_server(address: str, handler):
+    scheme, _, rest = address.partition(":")
+    if scheme == "unix":
+        if os.path.exists(rest):
+            os.unlink(rest)
+        return await asyncio.start_unix_server(handler, rest)
+    host, _, port = rest.rpartition(":")
+    return await asyncio.start_server(handler, host, int(port))
+
+
+async def serve(shards: List[int], listen: str, advertise: str) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with AsyncSessionLocal() as db:
+        await registry.load(db)
+    registry.start(engine, AsyncSessionLocal)
+
+    leases = Leases(shards, advertise, settings.SHARD_LEASE_TTL)
+    write_behind.fence = leases.fence
+    write_behind.journal = journal
+    # API processes cache trade history and need to hear about our commits.
+    write_behind.notify_trades = settings.RESPONSE_CACHE_BYTES > 0
+    shard_server = ShardServer(leases)
+    server = await start_server(listen, shard_server.handle)
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    logger.info("shard worker %s serving on %s, wants shards %s", leases.owner, listen, shards)
+    try:
+        while not stopping.is_set():
+            async with AsyncSessionLocal() as db:
+                await leases.renew(db)
+                acquired = await leases.acquire(db)
+                await db.commit()
+            for shard in acquired:
+                # The previous owner's last batch committed before our lease
+                # did (fence), so the books load from complete state.
+                await load_shard(shard)
+                leases.ready.add(shard)
+                logger.info("acquired shard %s (epoch %s)", shard, leases.owned[shard])
+            try:
+                await asyncio.wait_for(stopping.wait(), settings.SHARD_LEASE_TTL / 3)
+            except asyncio.TimeoutError:
+                pass
+    except LeaseLost as e:
+        # Another process owns these shards now; anything still queued here
+        # would be rejected by the fence. Stop without draining.
+        logger.error("lost lease on shards %s, exiting", e)
+        server.close()
+        await shard_server.close()
+        raise SystemExit(1)
+
+    server.close()
+    await shard_server.close()
+    await server.wait_closed()
+    await sequencer.stop()
+    await write_behind.stop()
+    if journal is not None:
+        await journal.stop()
+    async with AsyncSessionLocal() as db:
+        await leases.release(db)
+        await db.commit()
+    await registry.stop()
+
+
+def parse_shards(value: str) -> List[int]:
+    if value == "all":
+        return list(range(settings.SHARD_COUNT))
+    shards = [int(s) for s in value.split(",")]
+    for s in shards:
+        if not 0 <= s < settings.SHARD_COUNT:
+            raise argparse.ArgumentTypeError(f"shard {s} out of range for SHARD_COUNT={settings.SHARD_COUNT}")
+    return shards
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run matching for a set of instrument shards")
+    parser.add_argument("--shards", required=True, help="comma separated shard ids, or 'all'")
+    parser.add_argument("--listen", required=True, help="unix:/path.sock or tcp:host:port")
+    parser.add_argument("--advertise", help="address API workers should use (default: --listen)")
+    args = parser.parse_args()
+    if settings.SHARD_COUNT <= 0:
+        raise SystemExit("SHARD_COUNT must be set for shard workers")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(serve(parse_shards(args.shards), args.listen, args.advertise or args.listen))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""Headless replay of order flow through the matching engine.
+
+Feeds an order stream through the same code the sequencer lanes run
+(exchange.accept and exchange.withdraw: balance holds, matching, ledger
+settlement, mutation building, market-data publish) with no database and
+no HTTP. Mutations are counted and dropped. Order ids and timestamps come
+from the stream, so two runs over the same input end in the same books and
+print the same digest, which makes engine changes comparable and incidents
+reproducible offline.
+
+Streams are NDJSON or CSV (picked by extension) with one order per line:
+
+    op      limit | market | cancel
+    ticker  instrument symbol
+    user    any user key
+    side    BUY | SELL           (limit, market)
+    qty     whole units          (limit, market)
+    price   whole units          (limit)
+    ref     order reference; a cancel names the ref of a limit order
+
+    python -m app.simulator generate --orders 1000000 > flow.ndjson
+    python -m app.simulator run flow.ndjson --json
+    python -m app.simulator run flow.ndjson --profile
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import hashlib
+import io
+import json
+import random
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from app import exchange
+from app.ledger import InsufficientBalance, ledger
+from app.marketdata import hub
+from app.matching import SCALE, RestingOrder, matching_engine, whole
+from app.models import OrderType, Side
+
+OPS = ("limit", "market", "cancel")
+EPOCH = datetime.datetime(2024, 1, 1)
+
+# (op, ticker, user, side, qty, price, ref) with qty/price in engine units.
+Record = Tuple[str, str, str, Optional[Side], int, Optional[int], str]
+
+
+def parse_record(raw: dict, n: int) -> Record:
+    op = raw["op"].lower()
+    if op not in OPS:
+        raise ValueError(f"record {n}: unknown op {raw['op']!r}")
+    price = raw.get("price")
+    side = raw.get("side")
+    return (
+        op,
+        raw["ticker"],
+        str(raw.get("user", "")),
+        Side(side.lower()) if side else None,
+        int(raw.get("qty") or 0) * SCALE,
+        int(price) * SCALE if price not in (None, "") else None,
+        str(raw.get("ref") or n),
+    )
+
+
+def read_stream(path: str) -> Iterator[Record]:
+    stream = sys.stdin if path == "-" else open(path, newline="")
+    with stream:
+        if path.endswith(".csv"):
+            for n, raw in enumerate(csv.DictReader(stream)):
+                yield parse_record(raw, n)
+        else:
+            for n, line in enumerate(stream):
+                if line.strip():
+                    yield parse_record(json.loads(line), n)
+
+
+def generate(orders: int, tickers: int, users: int, cancel: float, market: float, seed: int) -> Iterator[dict]:
+    """Synthetic flow around a slowly drifting mid price per ticker."""
+    rng = random.Random(seed)
+    mids = [1000] * tickers
+    resting: List[List[str]] = [[] for _ in range(tickers)]
+    for n in range(orders):
+        t = rng.randrange(tickers)
+        ticker = f"SIM{t}"
+        roll = rng.random()
+        if roll < cancel and resting[t]:
+            refs = resting[t]
+            i = rng.randrange(len(refs))
+            refs[i], refs[-1] = refs[-1], refs[i]
+            yield {"op": "cancel", "ticker": ticker, "ref": refs.pop()}
+            continue
+        side = rng.choice(("BUY", "SELL"))
+        qty = rng.randint(1, 100)
+        user = f"u{rng.randrange(users)}"
+        if roll < cancel + market:
+            yield {"op": "market", "ticker": ticker, "user": user, "side": side, "qty": qty}
+            continue
+        mids[t] = max(10, mids[t] + rng.choice((-1, 0, 0, 1)))
+        # Mostly passive, sometimes crossing by a few ticks.
+        offset = rng.randint(-3, 20)
+        price = mids[t] - offset if side == "BUY" else mids[t] + offset
+        ref = f"o{n}"
+        resting[t].append(ref)
+        yield {"op": "limit", "ticker": ticker, "user": user, "side": side, "qty": qty, "price": max(1, price), "ref": ref}
+
+
+class Simulator:
+    def __init__(self, holdings: int):
+        self.holdings = holdings * SCALE
+        self.instruments: Dict[str, int] = {}
+        self.users: Dict[str, int] = {}
+        self.orders = 0
+        self.rejected = 0
+        self.cancels = 0
+        self.cancel_misses = 0
+        self.fills = 0
+        self.volume = 0
+        self.mutations = 0
+
+    def reset(self) -> None:
+        matching_engine.books.clear()
+        ledger.entries.clear()
+        hub.channels.clear()
+
+    def instrument_id(self, ticker: str) -> int:
+        instrument_id = self.instruments.get(ticker)
+        if instrument_id is None:
+            instrument_id = self.instruments[ticker] = len(self.instruments) + 1
+        return instrument_id
+
+    def user_id(self, user: str) -> int:
+        user_id = self.users.get(user)
+        if user_id is None:
+            user_id = self.users[user] = len(self.users) + 1
+        return user_id
+
+    async def run(self, records: Iterable[Record]) -> float:
+        accept = exchange.accept
+        entry = ledger.entry
+        start = time.perf_counter()
+        for n, (op, ticker, user, side, qty, price, ref) in enumerate(records):
+            instrument_id = self.instrument_id(ticker)
+            if op == "cancel":
+                self.cancels += 1
+                try:
+                    exchange.withdraw(instrument_id, ref)
+                except exchange.OrderNotActive:
+                    self.cancel_misses += 1
+                continue
+            user_id = self.user_id(user)
+            e = entry(user_id, instrument_id)
+            if e.total is None:
+                e.total = self.holdings
+            order = RestingOrder(
+                id=n + 1,
+                external_id=ref,
+                user_id=user_id,
+                instrument_id=instrument_id,
+                side=side,
+                price=price if op == "limit" else None,
+                quantity=qty,
+                filled=0,
+                created_at=EPOCH + datetime.timedelta(microseconds=n),
+            )
+            self.orders += 1
+            try:
+                mutations = await accept(order, OrderType.LIMIT if op == "limit" else OrderType.MARKET)
+            except InsufficientBalance:
+                self.rejected += 1
+                continue
+            self.mutations += len(mutations)
+            # One NewOrder, then OrderUpdate, NewTrade and two BalanceDeltas per fill.
+            fills = (len(mutations) - 1) // 4
+            self.fills += fills
+            if fills:
+                self.volume += order.filled
+        return time.perf_counter() - start
+
+    def books(self) -> Dict[str, dict]:
+        out = {}
+        for ticker, instrument_id in sorted(self.instruments.items()):
+            book = matching_engine.book(instrument_id)
+            bids = book.bids.depth(1)
+            asks = book.asks.depth(1)
+            out[ticker] = {
+                "resting": len(book.orders),
+                "bid_levels": len(book.bids.levels),
+                "ask_levels": len(book.asks.levels),
+                "best_bid": whole(bids[0][0]) if bids else None,
+                "best_ask": whole(asks[0][0]) if asks else None,
+            }
+        return out
+
+    def digest(self) -> str:
+        """Hash of every resting order in priority order, per book."""
+        h = hashlib.sha256()
+        for ticker, instrument_id in sorted(self.instruments.items()):
+            book = matching_engine.book(instrument_id)
+            for side in (book.bids, book.asks):
+                for level in side.iter_levels():
+                    for o in level.orders.values():
+                        h.update(f"{ticker}|{o.side.value}|{o.price}|{o.external_id}|{o.remaining}\n".encode())
+        return h.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen = sub.add_parser("generate", help="write a synthetic NDJSON stream to stdout")
+    gen.add_argument("--orders", type=int, default=100_000)
+    gen.add_argument("--tickers", type=int, default=10)
+    gen.add_argument("--users", type=int, default=1000)
+    gen.add_argument("--cancel", type=float, default=0.2, help="share of cancels")
+    gen.add_argument("--market", type=float, default=0.05, help="share of market orders")
+    gen.add_argument("--seed", type=int, default=1)
+
+    run = sub.add_parser("run", help="replay a stream and report")
+    run.add_argument("path", help="NDJSON or .csv file, - for NDJSON on stdin")
+    run.add_argument("--holdings", type=int, default=10**9, help="starting balance per user and ticker")
+    run.add_argument("--json", action="store_true", help="print the report as JSON")
+    run.add_argument("--profile", action="store_true", help="print the top functions by cumulative time")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        out = io.TextIOWrapper(sys.stdout.buffer, write_through=False)
+        for record in generate(args.orders, args.tickers, args.users, args.cancel, args.market, args.seed):
+            out.write(json.dumps(record, separators=(",", ":")) + "\n")
+        out.flush()
+        return
+
+    # Parsed up front so the timed loop is the engine alone.
+    records = list(read_stream(args.path))
+    sim = Simulator(args.holdings)
+    sim.reset()
+    if args.profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        elapsed = asyncio.run(sim.run(records))
+        profiler.disable()
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(25)
+    else:
+        elapsed = asyncio.run(sim.run(records))
+
+    report = {
+        "records": len(records),
+        "orders": sim.orders,
+        "rejected": sim.rejected,
+        "cancels": sim.cancels,
+        "cancel_misses": sim.cancel_misses,
+        "fills": sim.fills,
+        "volume": whole(sim.volume),
+        "mutations": sim.mutations,
+        "seconds": elapsed,
+        "records_per_s": len(records) / elapsed if elapsed else 0.0,
+        "fills_per_s": sim.fills / elapsed if elapsed else 0.0,
+        "books": sim.books(),
+        "digest": sim.digest(),
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{report['records']} records in {elapsed:.3f}s = {report['records_per_s']:,.0f} records/s, "
+          f"{report['fills']} fills ({report['fills_per_s']:,.0f}/s), volume {report['volume']}")
+    print(f"orders {sim.orders} (rejected {sim.rejected}), cancels {sim.cancels} (not resting {sim.cancel_misses})")
+    for ticker, b in report["books"].items():
+        print(f"  {ticker:<10} resting {b['resting']:>8}  bid {b['best_bid']}  ask {b['best_ask']}  "
+              f"levels {b['bid_levels']}/{b['ask_levels']}")
+    print(f"digest {report['digest']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Memory held by resting orders in the in-memory books.
+
+Fills books across a number of instruments with resting limit orders and
+reports the traced allocation per order and per million orders. Exits with
+status 1 when the per-order cost exceeds --max-bytes, so it can guard the
+budget in CI.
+
+    python -m bench.bench_book_memory --orders 1000000 --max-bytes 450
+"""
+import argparse
+import datetime
+import gc
+import random
+import sys
+import tracemalloc
+import uuid
+
+from app.matching import SCALE, OrderBook, RestingOrder
+from app.models import Side
+
+
+def fill_books(count: int, instruments: int, users: int, rng: random.Random):
+    now = datetime.datetime.utcnow()
+    books = {i: OrderBook(i) for i in range(1, instruments + 1)}
+    user_ids = list(range(1000, 1000 + users))
+    for n in range(count):
+        instrument_id = n % instruments + 1
+        side = Side.BUY if n & 1 else Side.SELL
+        price = rng.randint(900, 999) if side == Side.BUY else rng.randint(1000, 1099)
+        books[instrument_id].add(RestingOrder(
+            id=n + 1,
+            external_id=str(uuid.uuid4()),
+            user_id=rng.choice(user_ids),
+            instrument_id=instrument_id,
+            side=side,
+            price=price * SCALE,
+            quantity=rng.randint(1, 1000) * SCALE,
+            filled=0,
+            created_at=now + datetime.timedelta(microseconds=n),
+        ))
+    return books
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=1_000_000)
+    parser.add_argument("--instruments", type=int, default=100)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--max-bytes", type=int, default=0, help="fail above this many bytes per order (0 = report only)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    gc.collect()
+    tracemalloc.start()
+    books = fill_books(args.orders, args.instruments, args.users, rng)
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    resting = sum(len(b.orders) for b in books.values())
+    per_order = used / resting
+    print(f"{resting} resting orders in {len(books)} books: {used / 2**20:.0f} MiB, "
+          f"{per_order:.0f} B/order, {per_order * 1_000_000 / 2**20:.0f} MiB per million")
+    if args.max_bytes and per_order > args.max_bytes:
+        print(f"over budget: {per_order:.0f} > {args.max_bytes} B/order", file=sys.stderr)
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Fills per second through the matching hot path, without the database.
+
+Drives exchange.execute_against_book (matching, ledger settlement, trade and
+mutation construction, market-data publish) with a stream of crossing
+orders. ``--values decimal`` feeds the engine Decimal prices and quantities
+the way it stored them before the switch to integer units, for comparison.
+
+    python -m bench.bench_fills --book 10000 --orders 50000
+    python -m bench.bench_fills --values decimal
+"""
+import argparse
+import random
+import time
+import uuid
+from decimal import Decimal
+
+from app import exchange
+from app.ledger import ledger
+from app.matching import SCALE, RestingOrder, matching_engine
+from app.models import OrderType, Side
+
+
+def converter(values: str):
+    if values == "decimal":
+        return Decimal
+    return lambda n: n * SCALE
+
+
+def make_order(side: Side, price, qty, value, user_id: int) -> RestingOrder:
+    return RestingOrder(
+        id=None,
+        external_id=str(uuid.uuid4()),
+        user_id=user_id,
+        instrument_id=1,
+        side=side,
+        price=value(price) if price is not None else None,
+        quantity=value(qty),
+        filled=value(0),
+    )
+
+
+def run(book_size: int, orders: int, values: str, seed: int) -> dict:
+    rng = random.Random(seed)
+    value = converter(values)
+    matching_engine.books.clear()
+    ledger.entries.clear()
+    for user_id in range(1, 101):
+        ledger.entry(user_id, 1).total = value(10 ** 9)
+    book = matching_engine.book(1)
+    for _ in range(book_size // 2):
+        book.add(make_order(Side.SELL, rng.randint(1000, 1010), rng.randint(1, 10), value, rng.randint(1, 100)))
+        book.add(make_order(Side.BUY, rng.randint(990, 999), rng.randint(1, 10), value, rng.randint(1, 100)))
+
+    # Each taker sweeps a few makers; passive orders replace the liquidity taken.
+    stream = []
+    for i in range(orders):
+        side = Side.BUY if i % 2 == 0 else Side.SELL
+        if i % 4 < 2:
+            price = 1010 if side == Side.BUY else 990
+        else:
+            price = rng.randint(1000, 1010) if side == Side.SELL else rng.randint(990, 999)
+        stream.append(make_order(side, price, rng.randint(5, 20), value, rng.randint(1, 100)))
+
+    fills = 0
+    start = time.perf_counter()
+    for order in stream:
+        mutations = exchange.execute_against_book(order, OrderType.LIMIT)
+        fills += (len(mutations) - 1) // 4
+    elapsed = time.perf_counter() - start
+    return {"values": values, "orders": orders, "fills": fills, "seconds": elapsed, "fills_per_s": fills / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--book", type=int, default=10000, help="resting orders before the run")
+    parser.add_argument("--orders", type=int, default=50000)
+    parser.add_argument("--values", choices=("fixed", "decimal"), default="fixed")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    best = None
+    for _ in range(args.repeat):
+        r = run(args.book, args.orders, args.values, args.seed)
+        if best is None or r["fills_per_s"] > best["fills_per_s"]:
+            best = r
+    print(f"{best['values']}: {best['fills']} fills from {best['orders']} orders in {best['seconds']:.3f}s "
+          f"= {best['fills_per_s']:,.0f} fills/s (best of {args.repeat})")
+
+
+if __name__ == "__main__":
+    main()
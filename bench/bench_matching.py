@@ -0,0 +1,106 @@
+"""Matching cost per incoming order as the resting book grows.
+
+Compares the in-memory OrderBook against the previous strategy of pulling the
+whole opposite side of the book and walking it in price order for every
+incoming order.
+
+    python -m bench.bench_matching --sizes 1000 10000 100000 --orders 2000
+"""
+import argparse
+import random
+import time
+import uuid
+
+from app.matching import SCALE, OrderBook, RestingOrder
+from app.models import Side
+
+
+def make_order(side: Side, price: int, qty: int, user_id: int = 1) -> RestingOrder:
+    return RestingOrder(
+        id=None,
+        external_id=str(uuid.uuid4()),
+        user_id=user_id,
+        instrument_id=1,
+        side=side,
+        price=price * SCALE,
+        quantity=qty * SCALE,
+        filled=0,
+    )
+
+
+def seed(book_size: int, rng: random.Random):
+    # Asks between 1000 and 1999, bids strictly below so nothing crosses.
+    resting = []
+    for _ in range(book_size // 2):
+        resting.append(make_order(Side.SELL, rng.randint(1000, 1999), rng.randint(1, 10)))
+        resting.append(make_order(Side.BUY, rng.randint(1, 999), rng.randint(1, 10)))
+    return resting
+
+
+def incoming_stream(count: int, rng: random.Random):
+    # Marketable orders that sweep a few orders at the top of the book, plus
+    # passive orders that replenish it so the book size stays roughly stable.
+    for i in range(count):
+        if i % 2 == 0:
+            yield make_order(Side.BUY, 1000 + rng.randint(0, 5), rng.randint(1, 20))
+        else:
+            yield make_order(Side.SELL, rng.randint(1000, 1999), rng.randint(1, 20))
+
+
+def run_book(book_size: int, orders: int, seed_value: int) -> float:
+    rng = random.Random(seed_value)
+    book = OrderBook(1)
+    for o in seed(book_size, rng):
+        book.add(o)
+    stream = list(incoming_stream(orders, rng))
+    start = time.perf_counter()
+    for o in stream:
+        book.match(o)
+    return time.perf_counter() - start
+
+
+def run_scan(book_size: int, orders: int, seed_value: int) -> float:
+    rng = random.Random(seed_value)
+    resting = seed(book_size, rng)
+    stream = list(incoming_stream(orders, rng))
+    start = time.perf_counter()
+    for incoming in stream:
+        # Equivalent of SELECT ... WHERE side = opposite ORDER BY price.
+        opposite = Side.SELL if incoming.side == Side.BUY else Side.BUY
+        book = [o for o in resting if o.side == opposite and o.remaining > 0]
+        book.sort(key=lambda o: o.price, reverse=opposite == Side.BUY)
+        for o in book:
+            if incoming.remaining <= 0:
+                break
+            if incoming.side == Side.BUY and incoming.price < o.price:
+                break
+            if incoming.side == Side.SELL and incoming.price > o.price:
+                break
+            qty = min(incoming.remaining, o.remaining)
+            incoming.filled += qty
+            o.filled += qty
+        if incoming.remaining > 0:
+            resting.append(incoming)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--skip-scan", action="store_true", help="only run the in-memory book")
+    args = parser.parse_args()
+
+    print(f"{'resting':>10} {'book us/order':>14} {'scan us/order':>14}")
+    for size in args.sizes:
+        book_t = run_book(size, args.orders, args.seed)
+        scan = "-"
+        if not args.skip_scan:
+            scan_t = run_scan(size, args.orders, args.seed)
+            scan = f"{scan_t / args.orders * 1e6:.1f}"
+        print(f"{size:>10} {book_t / args.orders * 1e6:>14.1f} {scan:>14}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Connection pool and statement cache settings vs. read throughput.
+
+Runs the public trade history query from many concurrent tasks, one session
+per query the way the endpoint does, once per engine configuration, and
+reports queries/s and latency. DATABASE_URL must point at a scratch Postgres
+database (asyncpg driver); trades are seeded into it.
+
+    python -m bench.bench_pool --concurrency 50 --duration 5
+"""
+import argparse
+import asyncio
+import datetime
+import random
+import time
+import uuid
+from decimal import Decimal
+from typing import List, Optional
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.config import settings
+from app.models import Base, Instrument, InstrumentType, Order, OrderStatus, OrderType, Side, Trade, User
+
+CONFIGS = {
+    "pool=5": dict(pool_size=5),
+    "pool=20": dict(pool_size=20),
+    "pool=20,no-stmt-cache": dict(pool_size=20, statement_cache_size=0, prepared_statement_cache_size=0),
+    "pool=20,pre-ping": dict(pool_size=20, pool_pre_ping=True),
+}
+
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def make_engine(url: str, pool_size: int, pool_pre_ping: bool = False,
+                statement_cache_size: int = 100, prepared_statement_cache_size: int = 100):
+    return create_async_engine(
+        url,
+        pool_size=pool_size,
+        max_overflow=0,
+        pool_pre_ping=pool_pre_ping,
+        connect_args={
+            "statement_cache_size": statement_cache_size,
+            "prepared_statement_cache_size": prepared_statement_cache_size,
+        },
+    )
+
+
+async def seed(url: str, trades: int) -> int:
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with sessionmaker(engine, class_=AsyncSession)() as db:
+        await db.execute(delete(Trade))
+        await db.execute(delete(Order))
+        await db.execute(delete(Instrument).where(Instrument.symbol == "BPOOL"))
+        await db.execute(delete(User).where(User.username == "bench-pool"))
+        user_id = (await db.execute(insert(User).values(
+            external_id=str(uuid.uuid4()), username="bench-pool", name="bench", token=uuid.uuid4().hex,
+        ).returning(User.id))).scalar_one()
+        instrument_id = (await db.execute(insert(Instrument).values(
+            symbol="BPOOL", name="bench pool", type=InstrumentType.STOCK, is_listed=True,
+        ).returning(Instrument.id))).scalar_one()
+        order_id = (await db.execute(insert(Order).values(
+            external_id=str(uuid.uuid4()), user_id=user_id, instrument_id=instrument_id, type=OrderType.LIMIT,
+            side=Side.BUY, price=Decimal(1), quantity=Decimal(trades), filled=Decimal(trades),
+            status=OrderStatus.FILLED,
+        ).returning(Order.id))).scalar_one()
+        now = datetime.datetime.utcnow()
+        await db.execute(insert(Trade), [{
+            "buy_order_id": order_id, "sell_order_id": order_id, "instrument_id": instrument_id,
+            "price": Decimal(random.randint(90, 110)), "quantity": Decimal(1),
+            "timestamp": now - datetime.timedelta(seconds=n),
+        } for n in range(trades)])
+        await db.commit()
+    await engine.dispose()
+    return instrument_id
+
+
+async def run(url: str, name: str, instrument_id: int, concurrency: int, duration: float) -> dict:
+    engine = make_engine(url, **CONFIGS[name])
+    factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    query = select(Trade).where(Trade.instrument_id == instrument_id).order_by(Trade.timestamp.desc()).limit(10)
+    latencies: List[float] = []
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            async with factory() as db:
+                (await db.execute(query)).scalars().all()
+            latencies.append(time.perf_counter() - started)
+
+    # Warm the pool so connection setup is not part of the measurement.
+    async with engine.connect() as conn:
+        await conn.exec_driver_sql("select 1")
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    await engine.dispose()
+    latencies.sort()
+    return {
+        "config": name,
+        "queries_per_s": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=settings.DATABASE_URL)
+    parser.add_argument("--configs", nargs="+", choices=list(CONFIGS), default=list(CONFIGS))
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--trades", type=int, default=10000)
+    args = parser.parse_args()
+
+    async def run_all():
+        instrument_id = await seed(args.url, args.trades)
+        print(f"{'config':<24} {'queries/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+        for name in args.configs:
+            r = await run(args.url, name, instrument_id, args.concurrency, args.duration)
+            print(f"{r['config']:<24} {r['queries_per_s']:>10,.0f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f}")
+
+    asyncio.run(run_all())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Book recovery time: loading from Postgres vs. journal snapshot + tail.
+
+Seeds a scratch database with resting limit orders (DATABASE_URL must point
+at an empty Postgres database), writes a journal snapshot of the same state
+and a tail of update records, then times both ways of rebuilding the books.
+
+    python -m bench.bench_recovery --orders 100000 200000 --tail 20000
+"""
+import argparse
+import asyncio
+import datetime
+import random
+import tempfile
+import time
+import uuid
+from decimal import Decimal
+
+from sqlalchemy import delete, insert
+
+from app import journal as J
+from app.database import AsyncSessionLocal, engine
+from app.matching import SCALE, matching_engine
+from app.models import Base, Instrument, InstrumentType, Order, OrderStatus, OrderType, Side, User
+
+
+async def seed(count: int, instruments: int, rng: random.Random) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(Order))
+        await db.execute(delete(Instrument).where(Instrument.symbol.like("BR%")))
+        await db.execute(delete(User).where(User.username == "bench-recovery"))
+        user_id = (await db.execute(insert(User).values(
+            external_id=str(uuid.uuid4()), username="bench-recovery", name="bench", token=uuid.uuid4().hex,
+        ).returning(User.id))).scalar_one()
+        instrument_ids = (await db.execute(insert(Instrument).returning(Instrument.id), [
+            {"symbol": f"BR{i}", "name": f"bench {i}", "type": InstrumentType.STOCK, "is_listed": True} for i in range(instruments)
+        ])).scalars().all()
+        now = datetime.datetime.utcnow()
+        rows = []
+        for n in range(count):
+            side = rng.choice((Side.BUY, Side.SELL))
+            rows.append({
+                "external_id": str(uuid.uuid4()),
+                "user_id": user_id,
+                "instrument_id": rng.choice(instrument_ids),
+                "type": OrderType.LIMIT,
+                "side": side,
+                "price": Decimal(rng.randint(1, 999) if side == Side.BUY else rng.randint(1000, 1999)),
+                "quantity": Decimal(rng.randint(1, 100)),
+                "filled": Decimal(0),
+                "status": OrderStatus.NEW,
+                "created_at": now + datetime.timedelta(microseconds=n),
+            })
+            if len(rows) == 5000:
+                await db.execute(insert(Order), rows)
+                rows = []
+        if rows:
+            await db.execute(insert(Order), rows)
+        await db.commit()
+
+
+def write_journal(directory: str, state: "J.State", tail: int, rng: random.Random) -> None:
+    stream = J.JournalStream(directory, "main")
+    stream.reset(state)
+    # Partial fills on random resting orders, 100 records per batch.
+    orders = list(state.orders.items())
+    partial = J.STATUSES.index(OrderStatus.PARTIAL)
+    batch = state.batch
+    stream.open_segment(batch + 1)
+    records = []
+    for n in range(tail):
+        ext, o = rng.choice(orders)
+        records.append(J.encode(
+            batch + 1, J.UPDATE, status=partial, instrument_id=o[2], external_id=ext, id_a=o[0],
+            filled=min(o[5], SCALE),
+        ))
+        if len(records) == 100 or n == tail - 1:
+            batch += 1
+            records.append(J.encode(batch, J.COMMIT))
+            stream.write(b"".join(records))
+            records = []
+    stream.file.close()
+
+
+async def run(count: int, instruments: int, tail: int, seed_value: int) -> dict:
+    rng = random.Random(seed_value)
+    await seed(count, instruments, rng)
+
+    start = time.perf_counter()
+    async with AsyncSessionLocal() as db:
+        await matching_engine.load(db)
+    from_db = time.perf_counter() - start
+
+    async with AsyncSessionLocal() as db:
+        state = await J.state_from_db(db, 0, None)
+    with tempfile.TemporaryDirectory() as directory:
+        write_journal(directory, state, tail, rng)
+        start = time.perf_counter()
+        restored = J.JournalStream(directory, "main").load()
+        J.install(restored, None)
+        from_journal = time.perf_counter() - start
+
+    resting = sum(len(b.orders) for b in matching_engine.books.values())
+    return {"orders": count, "resting": resting, "tail": tail, "postgres_s": from_db, "journal_s": from_journal}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--instruments", type=int, default=20)
+    parser.add_argument("--tail", type=int, default=10000, help="journal records after the snapshot")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    async def run_all():
+        print(f"{'orders':>10} {'tail':>8} {'postgres s':>12} {'journal s':>12} {'speedup':>8}")
+        for count in args.orders:
+            r = await run(count, args.instruments, args.tail, args.seed)
+            print(f"{r['orders']:>10} {r['tail']:>8} {r['postgres_s']:>12.3f} {r['journal_s']:>12.3f} "
+                  f"{r['postgres_s'] / r['journal_s']:>7.1f}x")
+
+    asyncio.run(run_all())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""Load and latency benchmark for the exchange API.
+
+Seeds users, instruments and balances through the public and admin
+endpoints, then drives a configurable mix of limit, market, cancel and
+order book requests from concurrent clients. Reports orders/sec, fills/sec
+and p50/p99/p999 latency per operation and writes them as JSON so runs can
+be compared over time.
+
+Against a running server (needs an admin API key):
+
+    python -m bench.loadtest --base-url http://localhost:8000 --admin-token KEY
+
+In-process through the ASGI app (DATABASE_URL must point at a scratch
+Postgres; an admin user is created directly in it):
+
+    python -m bench.loadtest --in-process --duration 30 --mix limit=60,market=10,cancel=20,book=10
+
+Requires httpx (pip install httpx).
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import random
+import subprocess
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+OPS = ("limit", "market", "cancel", "book")
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}, expected one of {OPS}")
+        mix[name] = int(weight)
+    return mix
+
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[idx]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.orders_accepted = 0
+
+    def record(self, op: str, seconds: float, ok: bool) -> None:
+        self.latencies[op].append(seconds)
+        if not ok:
+            self.errors[op] += 1
+
+    def summary(self) -> dict:
+        out = {}
+        for op, values in self.latencies.items():
+            values.sort()
+            out[op] = {
+                "count": len(values),
+                "errors": self.errors[op],
+                "p50_ms": percentile(values, 0.50) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+                "p999_ms": percentile(values, 0.999) * 1000,
+                "max_ms": values[-1] * 1000,
+            }
+        return out
+
+
+class Trader:
+    def __init__(self, client: httpx.AsyncClient, api_key: str, tickers: List[str], rng: random.Random, args):
+        self.client = client
+        self.headers = {"Authorization": f"TOKEN {api_key}"}
+        self.tickers = tickers
+        self.rng = rng
+        self.args = args
+        self.resting: List[str] = []
+
+    def limit_body(self) -> dict:
+        mid, spread = self.args.mid_price, self.args.spread
+        return {
+            "direction": self.rng.choice(("BUY", "SELL")),
+            "ticker": self.rng.choice(self.tickers),
+            "qty": self.rng.randint(1, self.args.max_qty),
+            "price": self.rng.randint(mid - spread, mid + spread),
+        }
+
+    async def step(self, op: str, stats: Stats) -> None:
+        start = time.perf_counter()
+        if op == "limit":
+            r = await self.client.post("/api/v1/order", json=self.limit_body(), headers=self.headers)
+            if r.status_code == 200:
+                stats.orders_accepted += 1
+                self.resting.append(r.json()["order_id"])
+        elif op == "market":
+            body = self.limit_body()
+            del body["price"]
+            r = await self.client.post("/api/v1/order", json=body, headers=self.headers)
+            if r.status_code == 200:
+                stats.orders_accepted += 1
+        elif op == "cancel":
+            if not self.resting:
+                return
+            order_id = self.resting.pop(self.rng.randrange(len(self.resting)))
+            r = await self.client.delete(f"/api/v1/order/{order_id}", headers=self.headers)
+            # 400 means the order was filled before we got to it; not a failure.
+            stats.record(op, time.perf_counter() - start, r.status_code in (200, 400))
+            return
+        else:
+            r = await self.client.get(f"/api/v1/public/orderbook/{self.rng.choice(self.tickers)}")
+        stats.record(op, time.perf_counter() - start, r.status_code == 200)
+
+
+async def seed(client: httpx.AsyncClient, admin_key: str, args) -> Tuple[List[str], List[str]]:
+    admin = {"Authorization": f"TOKEN {admin_key}"}
+    run = uuid.uuid4().hex[:6].upper()
+    tickers = []
+    for i in range(args.instruments):
+        ticker = f"LT{run}{i}"
+        r = await client.post("/api/v1/admin/instrument", json={"name": f"load test {i}", "ticker": ticker}, headers=admin)
+        r.raise_for_status()
+        tickers.append(ticker)
+
+    keys = []
+    for i in range(args.users):
+        r = await client.post("/api/v1/public/register", json={"name": f"loadtest-{run}-{i}"})
+        r.raise_for_status()
+        user = r.json()
+        keys.append(user["api_key"])
+        for ticker in tickers:
+            r = await client.post(
+                "/api/v1/admin/balance/deposit",
+                json={"user_id": user["id"], "ticker": ticker, "amount": args.deposit},
+                headers=admin,
+            )
+            r.raise_for_status()
+    return tickers, keys
+
+
+async def count_trades(since: datetime.datetime, tickers: List[str]) -> Optional[int]:
+    try:
+        from sqlalchemy import func, select
+        from app.database import AsyncSessionLocal
+        from app.models import Instrument, Trade
+    except Exception:
+        return None
+    async with AsyncSessionLocal() as db:
+        return (await db.execute(
+            select(func.count(Trade.id))
+            .join(Instrument, Instrument.id == Trade.instrument_id)
+            .where(Trade.timestamp >= since, Instrument.symbol.in_(tickers))
+        )).scalar_one()
+
+
+async def create_admin() -> str:
+    from app.database import AsyncSessionLocal
+    from app.models import User
+
+    token = uuid.uuid4().hex
+    async with AsyncSessionLocal() as db:
+        db.add(User(
+            external_id=str(uuid.uuid4()),
+            username=f"loadtest-admin-{token[:8]}",
+            name="loadtest admin",
+            token=token,
+            is_admin=True,
+            role=User.Role.ADMIN,
+        ))
+        await db.commit()
+    return token
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+async def run(args) -> dict:
+    lifespan = None
+    if args.in_process:
+        from app.main import app
+        lifespan = app.router.lifespan_context(app)
+        await lifespan.__aenter__()
+        transport = httpx.ASGITransport(app=app)
+        client = httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=args.timeout)
+        admin_key = args.admin_token or await create_admin()
+    else:
+        if not args.admin_token:
+            raise SystemExit("--admin-token is required against a remote server")
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        client = httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits)
+        admin_key = args.admin_token
+
+    try:
+        tickers, keys = await seed(client, admin_key, args)
+        rng = random.Random(args.seed)
+        ops, weights = zip(*args.mix.items())
+        stats = Stats()
+        started_at = datetime.datetime.utcnow()
+        deadline = time.perf_counter() + args.duration
+        remaining = [args.requests]
+
+        async def worker(i: int):
+            trader = Trader(client, keys[i % len(keys)], tickers, random.Random(rng.random()), args)
+            while time.perf_counter() < deadline:
+                if args.requests:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+                await trader.step(trader.rng.choices(ops, weights)[0], stats)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        fills = None if args.no_db else await count_trades(started_at, tickers)
+    finally:
+        await client.aclose()
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+
+    return {
+        "started_at": started_at.isoformat(),
+        "git_revision": git_revision(),
+        "config": {
+            "target": "in-process" if args.in_process else args.base_url,
+            "mix": args.mix,
+            "concurrency": args.concurrency,
+            "users": args.users,
+            "instruments": args.instruments,
+            "duration_s": args.duration,
+            "requests": args.requests,
+            "seed": args.seed,
+        },
+        "elapsed_s": elapsed,
+        "orders_per_s": stats.orders_accepted / elapsed,
+        "fills": fills,
+        "fills_per_s": fills / elapsed if fills is not None else None,
+        "operations": stats.summary(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--base-url", help="URL of a running server")
+    target.add_argument("--in-process", action="store_true", help="drive app.main:app through an ASGI transport")
+    parser.add_argument("--admin-token", help="API key of an admin user")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("limit=60,market=10,cancel=20,book=10"))
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests (0 = duration only)")
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument("--instruments", type=int, default=4)
+    parser.add_argument("--deposit", type=int, default=1_000_000)
+    parser.add_argument("--mid-price", type=int, default=1000)
+    parser.add_argument("--spread", type=int, default=20)
+    parser.add_argument("--max-qty", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--no-db", action="store_true", help="do not count fills in the database")
+    parser.add_argument("--out", help="write the JSON result to this file")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""Replay captured traffic (see app/capture.py) against a test instance.
+
+Requests go out on the recorded schedule, scaled by --speed (2 = twice as
+fast, 0 = as fast as --concurrency allows). Every captured subject gets a
+freshly registered user; admin requests use --admin-token. User ids in
+bodies and paths, and order ids returned by recorded order placements,
+are mapped to their counterparts on the target, so a cancel waits for the
+order it refers to. Like a real client, each subject sends its next request
+only after the previous one has been answered, even when that falls behind
+the recorded schedule. Registration calls are not replayed.
+
+Reports latency per route and how many responses came back with a
+different status than the one recorded.
+
+    python -m bench.replay /var/capture --base-url http://localhost:8000 --admin-token KEY --speed 2
+    python -m bench.replay capture-*.ndjson.gz --in-process --speed 0
+
+Requires httpx (pip install httpx).
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List
+
+import httpx
+
+from bench.loadtest import create_admin, percentile
+
+SKIP_ROUTES = ("/api/v1/public/register", "/metrics")
+
+
+def read_records(paths: List[str]) -> List[dict]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.startswith("capture-")]
+        else:
+            files.append(path)
+    records = []
+    for path in files:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt") as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+    records.sort(key=lambda r: r["ts"])
+    return [r for r in records if (r.get("route") or r["path"]) not in SKIP_ROUTES]
+
+
+def created_order_ids(record: dict) -> List[str]:
+    """Order ids the recorded response handed out, in request order."""
+    if record["method"] != "POST" or record["status"] != 200 or not record.get("response"):
+        return []
+    try:
+        payload = json.loads(record["response"])
+    except ValueError:
+        return []
+    if record["route"] == "/api/v1/order":
+        return [payload.get("order_id")]
+    if record["route"] == "/api/v1/order/batch":
+        return [r.get("order_id") for r in payload.get("results", [])]
+    return []
+
+
+class Replay:
+    def __init__(self, client: httpx.AsyncClient, admin_key: str, records: List[dict]):
+        self.client = client
+        self.admin = {"Authorization": f"TOKEN {admin_key}"}
+        self.records = records
+        self.users: Dict[str, dict] = {}  # captured subject / user id -> {"id", "api_key"}
+        self.orders: Dict[str, asyncio.Future] = {}  # captured order id -> new order id
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.mismatches: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.sent = 0
+
+    async def setup(self) -> None:
+        run = uuid.uuid4().hex[:6]
+        wanted = []
+        loop = asyncio.get_running_loop()
+        for r in self.records:
+            if r.get("subject") and not r.get("admin"):
+                wanted.append(r["subject"])
+            if r.get("admin") and r["body"].startswith("{"):
+                user_id = json.loads(r["body"]).get("user_id")
+                if user_id:
+                    wanted.append(user_id)
+            for order_id in created_order_ids(r):
+                if order_id:
+                    self.orders[order_id] = loop.create_future()
+        for i, key in enumerate(dict.fromkeys(wanted)):
+            resp = await self.client.post("/api/v1/public/register", json={"name": f"replay-{run}-{i}"})
+            resp.raise_for_status()
+            self.users[key] = resp.json()
+
+    async def path(self, path: str) -> str:
+        parts = path.split("/")
+        for i, part in enumerate(parts):
+            if part in self.users:
+                parts[i] = self.users[part]["id"]
+            elif part in self.orders:
+                parts[i] = await self.orders[part]
+        return "/".join(parts)
+
+    def body(self, record: dict) -> bytes:
+        text = record["body"]
+        if text.startswith("{"):
+            payload = json.loads(text)
+            if payload.get("user_id") in self.users:
+                payload["user_id"] = self.users[payload["user_id"]]["id"]
+                text = json.dumps(payload)
+        return text.encode()
+
+    def headers(self, record: dict) -> dict:
+        headers = {"Content-Type": "application/json"} if record["body"] else {}
+        if record.get("admin"):
+            headers.update(self.admin)
+        elif record.get("subject") in self.users:
+            headers["Authorization"] = f"TOKEN {self.users[record['subject']]['api_key']}"
+        return headers
+
+    async def send(self, record: dict, semaphore: asyncio.Semaphore, previous) -> None:
+        # Waited for before taking a slot, so requests queued behind another
+        # cannot starve the one they depend on.
+        if previous is not None:
+            await asyncio.wait([previous])
+        path = await self.path(record["path"])
+        async with semaphore:
+            if record["query"]:
+                path += "?" + record["query"]
+            start = time.perf_counter()
+            resp = await self.client.request(record["method"], path, content=self.body(record), headers=self.headers(record))
+            elapsed = time.perf_counter() - start
+        route = f"{record['method']} {record.get('route') or record['path']}"
+        self.latencies[route].append(elapsed)
+        self.sent += 1
+        if resp.status_code != record["status"]:
+            self.mismatches[route][f"{record['status']}->{resp.status_code}"] += 1
+        originals = created_order_ids(record)
+        if originals:
+            if resp.status_code == 200:
+                payload = resp.json()
+                new = [payload["order_id"]] if "order_id" in payload else [r.get("order_id") for r in payload["results"]]
+            else:
+                new = []
+            for i, original in enumerate(originals):
+                if original in self.orders and not self.orders[original].done():
+                    # An order the target rejected keeps the captured id; requests
+                    # for it then fail the way they would for any unknown order.
+                    self.orders[original].set_result(new[i] if i < len(new) and new[i] else original)
+
+    async def run(self, speed: float, concurrency: int) -> float:
+        semaphore = asyncio.Semaphore(concurrency)
+        tasks = []
+        last: Dict[str, asyncio.Task] = {}
+        first = self.records[0]["ts"] if self.records else 0.0
+        start = time.perf_counter()
+        for record in self.records:
+            if speed > 0:
+                delay = (record["ts"] - first) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            subject = record.get("subject")
+            task = asyncio.create_task(self.send(record, semaphore, last.get(subject)))
+            if subject:
+                last[subject] = task
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - start
+
+    def summary(self) -> dict:
+        out = {}
+        for route, values in sorted(self.latencies.items()):
+            values.sort()
+            out[route] = {
+                "count": len(values),
+                "p50_ms": percentile(values, 0.50) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+                "max_ms": values[-1] * 1000,
+                "status_changes": dict(self.mismatches.get(route, {})),
+            }
+        return out
+
+
+async def run(args) -> dict:
+    records = read_records(args.paths)
+    lifespan = None
+    if args.in_process:
+        from app.main import app
+        lifespan = app.router.lifespan_context(app)
+        await lifespan.__aenter__()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://replay", timeout=args.timeout)
+        admin_key = args.admin_token or await create_admin()
+    else:
+        if not args.admin_token:
+            raise SystemExit("--admin-token is required against a remote server")
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        client = httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits)
+        admin_key = args.admin_token
+
+    try:
+        replay = Replay(client, admin_key, records)
+        await replay.setup()
+        elapsed = await replay.run(args.speed, args.concurrency)
+    finally:
+        await client.aclose()
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+
+    recorded = records[-1]["ts"] - records[0]["ts"] if records else 0.0
+    return {
+        "records": len(records),
+        "users": len(replay.users),
+        "recorded_s": recorded,
+        "elapsed_s": elapsed,
+        "requests_per_s": replay.sent / elapsed if elapsed else 0.0,
+        "status_changes": sum(sum(c.values()) for c in replay.mismatches.values()),
+        "routes": replay.summary(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="capture files or directories")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--base-url", help="URL of a running test server")
+    target.add_argument("--in-process", action="store_true", help="drive app.main:app through an ASGI transport")
+    parser.add_argument("--admin-token", help="API key of an admin user")
+    parser.add_argument("--speed", type=float, default=1.0, help="time scale; 0 sends as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--out", help="write the JSON result to this file")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
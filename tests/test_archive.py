@@ -0,0 +1,197 @@
+"""Archiving and partition maintenance against a real Postgres.
+
+Each test seeds its own rows inside a transaction and rolls it back, so
+this can be pointed at any local Postgres that has the schema (create_all
+or alembic upgrade head). Skipped unless DATABASE_URL points at Postgres.
+"""
+import asyncio
+import datetime
+import json
+import os
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from app.archive import archive_batch, ensure_partition
+from app.auth import AuthUser
+from app.models import OrderStatus
+from app.routers.api_v1_order import history_query, list_orders
+
+DATABASE_URL = os.environ.get("DATABASE_URL", "")
+
+pytestmark = pytest.mark.skipif(
+    not DATABASE_URL.startswith("postgresql"), reason="needs DATABASE_URL pointing at Postgres",
+)
+
+# Far enough back that no real partition or row is in the way.
+MONTH = datetime.datetime(2001, 3, 1)
+
+
+def in_transaction(check):
+    async def run():
+        engine = create_async_engine(DATABASE_URL)
+        async with engine.connect() as conn:
+            trans = await conn.begin()
+            try:
+                instrument_id = (await conn.execute(text(
+                    "INSERT INTO instruments (symbol, name, type, is_listed) "
+                    "VALUES ('ARCHTEST', 'archive test', 'MEMECOIN', true) RETURNING id"
+                ))).scalar_one()
+                user_id = (await conn.execute(text(
+                    "INSERT INTO users (external_id, username, name, token, is_admin, role) "
+                    "VALUES ('archive-test', 'archive-test', 'archive', 'archive-test-token', false, 'USER') RETURNING id"
+                ))).scalar_one()
+                await check(conn, user_id, instrument_id)
+            finally:
+                await trans.rollback()
+        await engine.dispose()
+
+    asyncio.run(run())
+
+
+async def add_order(conn, user_id: int, instrument_id: int, n: int, status: str, created_at, closed_at=None) -> int:
+    return (await conn.execute(text(
+        "INSERT INTO orders (external_id, user_id, instrument_id, type, side, price, quantity, filled, status, "
+        "created_at, closed_at) VALUES (:ext, :user_id, :instrument_id, 'LIMIT', 'BUY', 10, 1, 0, "
+        "CAST(:status AS orderstatus), :created_at, :closed_at) RETURNING id"
+    ), {"ext": f"archive-test-{n}", "user_id": user_id, "instrument_id": instrument_id, "status": status,
+        "created_at": created_at, "closed_at": closed_at})).scalar_one()
+
+
+async def move_to_archive(conn, ids) -> None:
+    await conn.execute(text(
+        "WITH moved AS (DELETE FROM orders WHERE id = ANY(:ids) RETURNING *) "
+        "INSERT INTO orders_archive (id, external_id, user_id, instrument_id, type, side, price, quantity, "
+        "filled, status, created_at, closed_at, archived_at) "
+        "SELECT id, external_id, user_id, instrument_id, type, side, price, quantity, filled, status, "
+        "created_at, closed_at, now() FROM moved"
+    ), {"ids": list(ids)})
+
+
+async def add_history(conn, user_id: int, instrument_id: int) -> list:
+    # Seven orders a minute apart; 2 and 5 still active, 0, 3 and 6 archived.
+    ids = []
+    for n in range(7):
+        created = MONTH + datetime.timedelta(minutes=n)
+        status = "NEW" if n in (2, 5) else "FILLED"
+        closed = None if status == "NEW" else created
+        ids.append(await add_order(conn, user_id, instrument_id, n, status, created, closed))
+    await move_to_archive(conn, [ids[0], ids[3], ids[6]])
+    return ids
+
+
+async def locations(conn, ids):
+    # order id -> tables it is in
+    found = {i: [] for i in ids}
+    for table in ("orders", "orders_archive"):
+        for (i,) in await conn.execute(text(f"SELECT id FROM {table} WHERE id = ANY(:ids)"), {"ids": list(ids)}):
+            found[i].append(table)
+    return found
+
+
+def test_archive_batch_moves_each_order_exactly_once():
+    async def check(conn, user_id, instrument_id):
+        now = datetime.datetime(2001, 6, 1)
+        cutoff = now - datetime.timedelta(days=1)
+        old = MONTH
+        ids = {
+            "filled": await add_order(conn, user_id, instrument_id, 1, "FILLED", old, old),
+            "canceled": await add_order(conn, user_id, instrument_id, 2, "CANCELED", old, old),
+            # Created long ago but closed after the cutoff: stays.
+            "recent": await add_order(conn, user_id, instrument_id, 3, "FILLED", old, now),
+            "active": await add_order(conn, user_id, instrument_id, 4, "NEW", old),
+            "partial": await add_order(conn, user_id, instrument_id, 5, "PARTIAL", old),
+        }
+        assert await archive_batch(conn, cutoff, 1, now) == 1
+        assert await archive_batch(conn, cutoff, 10, now) == 1
+        assert await archive_batch(conn, cutoff, 10, now) == 0
+
+        found = await locations(conn, ids.values())
+        assert all(len(tables) == 1 for tables in found.values())
+        assert {name for name, i in ids.items() if found[i] == ["orders_archive"]} == {"filled", "canceled"}
+        row = (await conn.execute(text(
+            "SELECT status, created_at, closed_at, archived_at FROM orders_archive WHERE id = :id"
+        ), {"id": ids["canceled"]})).one()
+        assert tuple(row) == ("CANCELED", old, old, now)
+
+    in_transaction(check)
+
+
+def test_ensure_partition_moves_rows_out_of_default():
+    async def check(conn, user_id, instrument_id):
+        for day in (1, 31):
+            await conn.execute(text(
+                "INSERT INTO trades (buy_order_id, sell_order_id, instrument_id, price, quantity, timestamp) "
+                "VALUES (0, 0, :instrument_id, 10, 1, :ts)"
+            ), {"instrument_id": instrument_id, "ts": MONTH.replace(day=day)})
+        # Next month: must stay in the default partition.
+        await conn.execute(text(
+            "INSERT INTO trades (buy_order_id, sell_order_id, instrument_id, price, quantity, timestamp) "
+            "VALUES (0, 0, :instrument_id, 10, 1, :ts)"
+        ), {"instrument_id": instrument_id, "ts": datetime.datetime(2001, 4, 1)})
+
+        async def partitions():
+            return sorted((await conn.execute(text(
+                "SELECT tableoid::regclass::text, count(*) FROM trades WHERE instrument_id = :id GROUP BY 1"
+            ), {"id": instrument_id})).all())
+
+        assert await partitions() == [("trades_default", 3)]
+        assert await ensure_partition(conn, "trades", MONTH) is True
+        assert await partitions() == [("trades_200103", 2), ("trades_default", 1)]
+        assert await ensure_partition(conn, "trades", MONTH) is False
+        # Ids keep coming from the shared sequence in the new partition.
+        new_id = (await conn.execute(text(
+            "INSERT INTO trades (buy_order_id, sell_order_id, instrument_id, price, quantity, timestamp) "
+            "VALUES (0, 0, :instrument_id, 10, 1, :ts) RETURNING id"
+        ), {"instrument_id": instrument_id, "ts": MONTH.replace(day=15)})).scalar_one()
+        assert new_id is not None
+        assert await partitions() == [("trades_200103", 3), ("trades_default", 1)]
+
+    in_transaction(check)
+
+
+def test_history_query_merges_hot_and_archive():
+    async def check(conn, user_id, instrument_id):
+        expected = await add_history(conn, user_id, instrument_id)
+        newest_first = expected[::-1]
+
+        pages, after = [], None
+        while True:
+            rows = (await conn.execute(history_query(user_id, [], after, 2))).all()
+            pages.append([r.id for r in rows])
+            if len(rows) < 2:
+                break
+            after = (rows[-1].created_at, rows[-1].id)
+        assert [i for page in pages for i in page] == newest_first
+        assert all(len(page) <= 2 for page in pages)
+
+        filled = (await conn.execute(history_query(user_id, [OrderStatus.FILLED], None, 10))).all()
+        assert [r.id for r in filled] == [i for i in newest_first if i not in (expected[2], expected[5])]
+        active = (await conn.execute(history_query(user_id, [OrderStatus.NEW], None, 10))).all()
+        assert [r.id for r in active] == [expected[5], expected[2]]
+
+    in_transaction(check)
+
+
+def test_list_orders_cursor_walks_hot_and_archive():
+    async def check(conn, user_id, instrument_id):
+        await add_history(conn, user_id, instrument_id)
+        newest_first = [f"archive-test-{n}" for n in reversed(range(7))]
+        user = AuthUser(user_id, "archive-test", "archive", "USER", False, "archive-test-token")
+        db = AsyncSession(bind=conn, join_transaction_mode="create_savepoint")
+
+        for format, media_type in (("json", "application/json"), ("ndjson", "application/x-ndjson")):
+            seen, cursor = [], None
+            while True:
+                r = await list_orders(status=[], limit=3, cursor=cursor, format=format, user=user, db=db)
+                assert r.media_type == media_type
+                page = json.loads(r.body) if format == "json" else [json.loads(line) for line in r.body.splitlines()]
+                seen += [o["id"] for o in page]
+                cursor = r.headers.get("x-next-cursor")
+                if cursor is None:
+                    break
+            assert seen == newest_first
+        await db.close()
+
+    in_transaction(check)
@@ -0,0 +1,91 @@
+import asyncio
+import datetime
+import os
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from app.candles import aggregate, backfill, bucket_start
+
+DATABASE_URL = os.environ.get("DATABASE_URL", "")
+
+T0 = datetime.datetime(2001, 3, 1, 12, 0)
+
+
+def test_bucket_start():
+    ts = datetime.datetime(2001, 3, 1, 12, 7, 42)
+    assert bucket_start(ts, 1) == datetime.datetime(2001, 3, 1, 12, 7)
+    assert bucket_start(ts, 5) == datetime.datetime(2001, 3, 1, 12, 5)
+    assert bucket_start(ts, 60) == datetime.datetime(2001, 3, 1, 12, 0)
+    assert bucket_start(ts, 1440) == datetime.datetime(2001, 3, 1)
+
+
+def test_aggregate_folds_trades_in_time_order():
+    bars = aggregate([
+        (1, Decimal(10), Decimal(1), T0),
+        (1, Decimal(12), Decimal(2), T0 + datetime.timedelta(seconds=10)),
+        (1, Decimal(9), Decimal(1), T0 + datetime.timedelta(seconds=20)),
+        (1, Decimal(11), Decimal(3), T0 + datetime.timedelta(minutes=1)),
+    ])
+    first = bars[(1, 1, T0)]
+    assert (first.open, first.high, first.low, first.close, first.volume) == (10, 12, 9, 9, 4)
+    hour = bars[(1, 60, T0)]
+    assert (hour.open, hour.high, hour.low, hour.close, hour.volume) == (10, 12, 9, 11, 7)
+    assert len(bars) == 5
+
+
+@pytest.mark.skipif(not DATABASE_URL.startswith("postgresql"), reason="needs DATABASE_URL pointing at Postgres")
+def test_backfill_replaces_one_instruments_candles():
+    # Seeds its own rows inside a transaction that is rolled back at the end.
+    async def check(db):
+        rebuilt, other = [
+            (await db.execute(text(
+                "INSERT INTO instruments (symbol, name, type, is_listed) "
+                "VALUES (:symbol, 'candle test', 'MEMECOIN', true) RETURNING id"
+            ), {"symbol": symbol})).scalar_one()
+            for symbol in ("CANDLETEST", "CANDLEOTHER")
+        ]
+        for seconds, price in ((0, 10), (10, 12), (20, 9), (60, 11), (70, 13)):
+            await db.execute(text(
+                "INSERT INTO trades (buy_order_id, sell_order_id, instrument_id, price, quantity, timestamp) "
+                "VALUES (0, 0, :instrument_id, :price, 1, :ts)"
+            ), {"instrument_id": rebuilt, "price": price, "ts": T0 + datetime.timedelta(seconds=seconds)})
+        # Wrong candles for the rebuilt instrument, and one that must survive.
+        for instrument_id, ts in ((rebuilt, T0), (rebuilt, T0 - datetime.timedelta(days=1)), (other, T0)):
+            await db.execute(text(
+                "INSERT INTO candles (instrument_id, interval, ts, open, high, low, close, volume) "
+                "VALUES (:instrument_id, 1, :ts, 1, 1, 1, 1, 100)"
+            ), {"instrument_id": instrument_id, "ts": ts})
+
+        assert await backfill(db, rebuilt, chunk=2) == 5
+
+        async def candles(instrument_id):
+            return (await db.execute(text(
+                "SELECT interval, ts, open, high, low, close, volume FROM candles "
+                "WHERE instrument_id = :id ORDER BY interval, ts"
+            ), {"id": instrument_id})).all()
+
+        assert [tuple(r) for r in await candles(rebuilt)] == [
+            (1, T0, 10, 12, 9, 9, 3),
+            (1, T0 + datetime.timedelta(minutes=1), 11, 13, 11, 13, 2),
+            (5, T0, 10, 13, 9, 13, 5),
+            (60, T0, 10, 13, 9, 13, 5),
+            (1440, T0.replace(hour=0), 10, 13, 9, 13, 5),
+        ]
+        assert [tuple(r) for r in await candles(other)] == [(1, T0, 1, 1, 1, 1, 100)]
+
+    async def run():
+        engine = create_async_engine(DATABASE_URL)
+        async with engine.connect() as conn:
+            trans = await conn.begin()
+            db = AsyncSession(bind=conn, join_transaction_mode="create_savepoint")
+            try:
+                await check(db)
+            finally:
+                await db.close()
+                await trans.rollback()
+        await engine.dispose()
+
+    asyncio.run(run())
@@ -0,0 +1,74 @@
+import asyncio
+import json
+
+import httpx
+from fastapi import FastAPI
+
+from app import schemas
+from app.capture import CaptureMiddleware, redact
+
+KEY = "key-6f1c2b"
+
+
+class ListWriter:
+    def __init__(self):
+        self.records = []
+
+    def put(self, record: dict) -> None:
+        self.records.append(record)
+
+
+def user(user_id: str) -> schemas.User:
+    return schemas.User(id=user_id, name="bob", role=schemas.UserRole.USER, api_key=KEY)
+
+
+def captured(method: str, path: str, **kwargs) -> dict:
+    # Same paths and response models as the real routes, without a database.
+    app = FastAPI()
+
+    @app.delete("/api/v1/admin/user/{user_id}", response_model=schemas.User)
+    async def delete_user(user_id: str):
+        return user(user_id)
+
+    @app.post("/api/v1/public/register", response_model=schemas.User)
+    async def register():
+        return user("new")
+
+    @app.post("/api/v1/order")
+    async def order():
+        return {"success": True, "order_id": "order-1"}
+
+    writer = ListWriter()
+    app.add_middleware(CaptureMiddleware, writer=writer)
+
+    async def go():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as c:
+            await c.request(method, path, **kwargs)
+
+    asyncio.run(go())
+    assert len(writer.records) == 1
+    return writer.records[0]
+
+
+def test_admin_delete_user_response_has_no_api_key():
+    record = captured("DELETE", "/api/v1/admin/user/u-1")
+    assert record["status"] == 200
+    assert KEY not in json.dumps(record)
+    assert json.loads(record["response"]) == {"id": "u-1", "name": "bob", "role": "USER", "api_key": "<redacted>"}
+
+
+def test_register_response_has_no_api_key():
+    record = captured("POST", "/api/v1/public/register", json={"name": "bob"})
+    assert KEY not in json.dumps(record)
+
+
+def test_order_response_is_kept():
+    record = captured("POST", "/api/v1/order", json={"direction": "BUY", "ticker": "X", "qty": 1})
+    assert json.loads(record["response"]) == {"success": True, "order_id": "order-1"}
+
+
+def test_redact_nested_and_truncated():
+    body = json.dumps({"users": [{"api_key": KEY, "id": 1}]}).encode()
+    assert json.loads(redact(body)) == {"users": [{"api_key": "<redacted>", "id": 1}]}
+    assert redact(body[:-5]) == ""
+    assert redact(b"plain") == "plain"
@@ -0,0 +1,245 @@
+import asyncio
+import datetime
+import os
+import uuid
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from app.journal import (
+    ACCEPT, AMEND, BALANCE, CANCEL, COMMIT, RECORD, STATUSES, TYPES, UPDATE, Journal, JournalStream, State, encode,
+    iter_records,
+)
+from app.ledger import ledger
+from app.matching import SCALE, matching_engine, to_units
+from app.models import OrderStatus, OrderType, Side
+
+DATABASE_URL = os.environ.get("DATABASE_URL", "")
+
+INSTRUMENT = 1
+NEW, PARTIAL, FILLED = (STATUSES.index(s) for s in (OrderStatus.NEW, OrderStatus.PARTIAL, OrderStatus.FILLED))
+LIMIT, MARKET = TYPES.index(OrderType.LIMIT), TYPES.index(OrderType.MARKET)
+
+
+def ext(n: int) -> bytes:
+    return uuid.UUID(int=n).bytes
+
+
+def accept(batch: int, n: int, type_=LIMIT, status=NEW, qty=5, filled=0, prio=0) -> bytes:
+    return encode(batch, ACCEPT, 0, type_, status, INSTRUMENT, 1, 1000 + n, ext(n), n, prio, 10 * SCALE, qty * SCALE, filled * SCALE)
+
+
+def decoded(*records: bytes):
+    return list(iter_records(b"".join(records)))
+
+
+def test_state_apply_tracks_active_limit_orders_and_balances():
+    state = State()
+    for r in decoded(
+        accept(1, 1),
+        accept(1, 2, type_=MARKET),
+        accept(1, 3, status=FILLED),
+        accept(1, 4),
+        accept(1, 5),
+        encode(1, UPDATE, status=PARTIAL, external_id=ext(1), filled=2 * SCALE),
+        encode(1, AMEND, external_id=ext(1), price=11 * SCALE, qty=4 * SCALE),
+        encode(1, AMEND, ts=5000, external_id=ext(4), price=9 * SCALE, qty=6 * SCALE),
+        encode(1, UPDATE, status=FILLED, external_id=ext(5), filled=5 * SCALE),
+        encode(1, CANCEL, external_id=ext(4)),
+        encode(1, BALANCE, instrument_id=INSTRUMENT, user_id=1, qty=3 * SCALE),
+        encode(1, BALANCE, instrument_id=INSTRUMENT, user_id=1, qty=-SCALE),
+    ):
+        state.apply(r)
+    # An amend that keeps its place leaves the priority time at created_at.
+    assert state.orders == {ext(1): [1, 1, INSTRUMENT, 0, 11 * SCALE, 4 * SCALE, 2 * SCALE, 1001, 1001]}
+    assert state.balances == {(1, INSTRUMENT): 2 * SCALE}
+
+    state.apply(decoded(accept(1, 6))[0])
+    state.apply(decoded(encode(1, AMEND, ts=5000, external_id=ext(6), price=9 * SCALE, qty=6 * SCALE))[0])
+    assert state.orders[ext(6)][4:] == [9 * SCALE, 6 * SCALE, 0, 1006, 5000]
+
+
+def test_replay_applies_only_committed_consecutive_batches():
+    state = State()
+    state.replay(decoded(
+        accept(1, 1), encode(1, COMMIT),
+        accept(2, 2), encode(2, COMMIT),
+        accept(3, 3),  # no COMMIT: the process died before it was written
+    ))
+    assert state.batch == 2 and set(state.orders) == {ext(1), ext(2)}
+
+    # Already-applied batches are skipped, a gap ends the replay.
+    state.replay(decoded(accept(2, 9), encode(2, COMMIT), accept(4, 4), encode(4, COMMIT)))
+    assert state.batch == 2 and set(state.orders) == {ext(1), ext(2)}
+
+
+def test_iter_records_stops_at_a_bad_crc_or_torn_record():
+    first, second, third = accept(1, 1), accept(1, 2), accept(1, 3)
+    corrupt = second[:20] + bytes([second[20] ^ 1]) + second[21:]
+    assert [r[8] for r in decoded(first, corrupt, third)] == [ext(1)]
+    assert [r[8] for r in decoded(first, second, third[:-1])] == [ext(1), ext(2)]
+
+
+def test_load_stops_at_a_truncated_final_segment(tmp_path):
+    stream = JournalStream(str(tmp_path), "main")
+    stream.open_segment(1)
+    stream.write(accept(1, 1) + encode(1, COMMIT))
+    stream.open_segment(2)
+    stream.write(accept(2, 2) + encode(2, COMMIT) + accept(3, 3) + encode(3, COMMIT)[:RECORD.size // 2])
+    stream.file.close()
+    state = stream.load()
+    assert state.batch == 2
+    assert set(state.orders) == {ext(1), ext(2)}
+
+
+def test_compaction_replaces_closed_segments_with_a_snapshot(tmp_path):
+    async def run():
+        journal = Journal(str(tmp_path), snapshot_every=2)
+        stream = journal.streams[0] = JournalStream(str(tmp_path), "main")
+        stream.open_segment(1)
+        await journal.append({0: (1, [accept(1, 1), accept(1, 2)])})
+        assert stream.compacting is None
+        await journal.append({0: (2, [encode(2, CANCEL, external_id=ext(2))])})
+        await stream.compacting
+        assert [start for start, _ in stream.segments()] == [3]
+        assert os.path.exists(stream.snapshot_path)
+
+        await journal.append({0: (3, [encode(3, UPDATE, status=PARTIAL, external_id=ext(1), filled=SCALE)])})
+        await journal.stop()
+        state = JournalStream(str(tmp_path), "main").load()
+        assert state.batch == 3
+        assert list(state.orders) == [ext(1)] and state.orders[ext(1)][6] == SCALE
+
+    asyncio.run(run())
+
+
+@pytest.mark.skipif(not DATABASE_URL.startswith("postgresql"), reason="needs DATABASE_URL pointing at Postgres")
+def test_restore_matches_the_database(tmp_path):
+    # Seeds its own rows inside a transaction that is rolled back at the end.
+    t0 = datetime.datetime(2001, 3, 1)
+
+    async def run():
+        engine = create_async_engine(DATABASE_URL)
+        async with engine.connect() as conn:
+            trans = await conn.begin()
+            db = AsyncSession(bind=conn, join_transaction_mode="create_savepoint", expire_on_commit=False)
+            try:
+                await check(db)
+            finally:
+                await db.close()
+                await trans.rollback()
+        await engine.dispose()
+
+    async def check(db):
+        instrument_id = (await db.execute(text(
+            "INSERT INTO instruments (symbol, name, type, is_listed) "
+            "VALUES ('JOURNALTEST', 'journal test', 'MEMECOIN', true) RETURNING id"
+        ))).scalar_one()
+        user_id = (await db.execute(text(
+            "INSERT INTO users (external_id, username, name, token, is_admin, role) "
+            "VALUES ('journal-test', 'journal-test', 'journal', 'journal-test-token', false, 'USER') RETURNING id"
+        ))).scalar_one()
+        name = Journal.stream_name(0)
+        await db.execute(text(
+            "INSERT INTO journal_state (name, batch) VALUES (:name, 0) ON CONFLICT (name) DO UPDATE SET batch = 0"
+        ), {"name": name})
+
+        async def add_order(side, price, quantity, filled, status, minutes, priority_minutes=None):
+            created = t0 + datetime.timedelta(minutes=minutes)
+            priority = None if priority_minutes is None else t0 + datetime.timedelta(minutes=priority_minutes)
+            external_id = str(uuid.uuid4())
+            id_ = (await db.execute(text(
+                "INSERT INTO orders (external_id, user_id, instrument_id, type, side, price, quantity, filled, status, "
+                "created_at, priority_at) VALUES (:ext, :user_id, :instrument_id, 'LIMIT', CAST(:side AS side), "
+                ":price, :quantity, :filled, CAST(:status AS orderstatus), :created, :priority) RETURNING id"
+            ), {"ext": external_id, "user_id": user_id, "instrument_id": instrument_id, "side": side, "price": price,
+                "quantity": quantity, "filled": filled, "status": status, "created": created,
+                "priority": priority})).scalar_one()
+            return id_, external_id, created
+
+        async def add_balance(amount):
+            await db.execute(text(
+                "INSERT INTO balances (user_id, instrument_id, amount) VALUES (:user_id, :instrument_id, :amount)"
+            ), {"user_id": user_id, "instrument_id": instrument_id, "amount": amount})
+
+        async def set_status(external_id, status, filled):
+            await db.execute(text(
+                "UPDATE orders SET status = CAST(:status AS orderstatus), filled = :filled WHERE external_id = :ext"
+            ), {"status": status, "filled": filled, "ext": external_id})
+
+        def books():
+            book = matching_engine.book(instrument_id)
+            return [
+                [(o.id, o.external_id, o.user_id, o.price, o.quantity, o.filled, o.created_at, o.priority_at)
+                 for level in side.iter_levels() for o in level.orders.values()]
+                for side in (book.bids, book.asks)
+            ]
+
+        async def from_db():
+            await matching_engine.load(db, instrument_id)
+            return books()
+
+        await add_order("BUY", 10, 5, 0, "NEW", 0)
+        _, amended, _ = await add_order("BUY", 10, 3, 1, "PARTIAL", 1, priority_minutes=3)
+        _, ask, _ = await add_order("SELL", 12, 2, 0, "NEW", 2)
+        await add_order("BUY", 10, 1, 1, "FILLED", 4)
+        await add_order("BUY", 11, 1, 0, "NEW", 5)
+        await add_balance(100)
+        await add_balance("5.5")
+
+        # No snapshot yet: loads from Postgres and writes one.
+        assert await Journal(str(tmp_path), 100).restore(db, 0, [instrument_id]) is False
+        expected = await from_db()
+        assert len(expected[0]) == 3 and len(expected[1]) == 1
+
+        journal = Journal(str(tmp_path), 100)
+        assert await journal.restore(db, 0, [instrument_id]) is True
+        assert books() == expected
+
+        # One write-behind batch, committed to both the database and the journal.
+        book = matching_engine.book(instrument_id)
+        new_id, new_ext, created = await add_order("SELL", 13, 4, 0, "NEW", 6)
+        await set_status(amended, "PARTIAL", 2)
+        await set_status(ask, "CANCELED", 0)
+        await add_balance(7)
+        prepared = journal.prepare(
+            [{"id": new_id, "external_id": new_ext, "user_id": user_id, "instrument_id": instrument_id,
+              "type": OrderType.LIMIT, "side": Side.SELL, "price": 13 * SCALE, "quantity": 4 * SCALE,
+              "filled": 0, "status": OrderStatus.NEW, "created_at": created, "priority_at": None}],
+            [{"order": book.orders[amended], "filled": 2 * SCALE, "status": OrderStatus.PARTIAL}],
+            [book.orders[ask]],
+            [],
+            {(user_id, instrument_id): 7 * SCALE},
+        )
+        await journal.stamp(db, prepared)
+        await journal.append(prepared)
+        await journal.stop()
+        assert (await db.execute(text("SELECT batch FROM journal_state WHERE name = :name"), {"name": name})).scalar_one() == 1
+
+        journal = Journal(str(tmp_path), 100)
+        assert await journal.restore(db, 0, [instrument_id]) is True
+        restored = books()
+        assert restored == await from_db()
+        assert [o[1] for o in restored[1]] == [new_ext]
+        assert ledger.entry(user_id, instrument_id).total == to_units("112.5")
+
+        # The next batch commits, but the process dies mid-write: the journal
+        # ends in a torn record and its watermark is behind the database's.
+        await set_status(amended, "CANCELED", 2)
+        prepared = journal.prepare([], [], [matching_engine.book(instrument_id).orders[amended]], [], {})
+        await journal.stamp(db, prepared)
+        batch, records = prepared[0]
+        journal.streams[0].write(b"".join(records + [encode(batch, COMMIT)])[:-RECORD.size // 2])
+        await journal.stop()
+
+        assert await Journal(str(tmp_path), 100).restore(db, 0, [instrument_id]) is False
+        expected = await from_db()
+        assert amended not in {o[1] for o in expected[0]}
+        # The fallback rewrote the snapshot at the database's watermark.
+        journal = Journal(str(tmp_path), 100)
+        assert await journal.restore(db, 0, [instrument_id]) is True
+        assert books() == expected
+        await journal.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,278 @@
+import asyncio
+import datetime
+import os
+import uuid
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from app.exchange import amend
+from app.matching import SCALE, BookSide, MatchingEngine, OrderBook, RestingOrder, matching_engine, order_status, whole
+from app.models import OrderStatus, OrderType, Side
+from app.persistence import OrderAmend
+
+INSTRUMENT = 1
+DATABASE_URL = os.environ.get("DATABASE_URL", "")
+
+
+def order(external_id: str, side: Side, price, quantity: int, user_id: int = 1, filled: int = 0) -> RestingOrder:
+    return RestingOrder(
+        id=None,
+        external_id=external_id,
+        user_id=user_id,
+        instrument_id=INSTRUMENT,
+        side=side,
+        price=price * SCALE if price is not None else None,
+        quantity=quantity * SCALE,
+        filled=filled * SCALE,
+    )
+
+
+def fills(book: OrderBook, incoming: RestingOrder):
+    return [(f.maker.external_id, whole(f.price), whole(f.quantity)) for f in book.match(incoming)]
+
+
+def levels(side: BookSide):
+    # (price, [order ids in queue order]) from best to worst.
+    return [(whole(level.price), list(level.orders)) for level in side.iter_levels()]
+
+
+def test_book_side_best_level_is_last():
+    bids, asks = BookSide(Side.BUY), BookSide(Side.SELL)
+    for i, price in enumerate((10, 12, 11)):
+        bids.add(order(f"b{i}", Side.BUY, price, 1))
+        asks.add(order(f"a{i}", Side.SELL, price, 1))
+    assert bids.best().price == 12 * SCALE
+    assert asks.best().price == 10 * SCALE
+    assert levels(bids) == [(12, ["b1"]), (11, ["b2"]), (10, ["b0"])]
+    assert levels(asks) == [(10, ["a0"]), (11, ["a2"]), (12, ["a1"])]
+
+
+def test_book_side_remove_drops_empty_levels():
+    asks = BookSide(Side.SELL)
+    a, b, c = order("a", Side.SELL, 10, 1), order("b", Side.SELL, 10, 2), order("c", Side.SELL, 11, 1)
+    for o in (a, b, c):
+        asks.add(o)
+    assert levels(asks) == [(10, ["a", "b"]), (11, ["c"])]
+    asks.remove(a)
+    asks.remove(b)
+    assert asks.best().price == 11 * SCALE
+    assert 10 * SCALE not in asks.levels
+    asks.remove(c)
+    assert asks.best() is None
+
+
+def test_book_side_depth():
+    asks = BookSide(Side.SELL)
+    for i, (price, quantity) in enumerate(((10, 1), (10, 2), (12, 4), (11, 3))):
+        asks.add(order(f"a{i}", Side.SELL, price, quantity))
+    assert asks.depth(10) == [(10 * SCALE, 3 * SCALE), (11 * SCALE, 3 * SCALE), (12 * SCALE, 4 * SCALE)]
+    assert asks.depth(2) == [(10 * SCALE, 3 * SCALE), (11 * SCALE, 3 * SCALE)]
+    assert asks.depth(0) == []
+
+
+def test_match_price_then_time_priority():
+    book = OrderBook(INSTRUMENT)
+    book.add(order("first", Side.SELL, 10, 2))
+    book.add(order("worse", Side.SELL, 11, 5))
+    book.add(order("second", Side.SELL, 10, 2))
+    incoming = order("buy", Side.BUY, 11, 5)
+    assert fills(book, incoming) == [("first", 10, 2), ("second", 10, 2), ("worse", 11, 1)]
+    assert incoming.remaining == 0
+    assert "buy" not in book.orders
+    assert levels(book.asks) == [(11, ["worse"])]
+    assert book.orders["worse"].remaining == 4 * SCALE
+
+
+def test_match_stops_at_limit_and_rests_remainder():
+    book = OrderBook(INSTRUMENT)
+    book.add(order("s", Side.SELL, 10, 3))
+    book.add(order("far", Side.SELL, 12, 3))
+    incoming = order("buy", Side.BUY, 11, 5)
+    assert fills(book, incoming) == [("s", 10, 3)]
+    assert incoming.filled == 3 * SCALE
+    assert book.orders["buy"] is incoming
+    assert levels(book.bids) == [(11, ["buy"])]
+    assert "s" not in book.orders
+
+
+def test_match_sell_against_bids():
+    book = OrderBook(INSTRUMENT)
+    book.add(order("low", Side.BUY, 9, 1))
+    book.add(order("high", Side.BUY, 10, 1))
+    incoming = order("sell", Side.SELL, 9, 3)
+    assert fills(book, incoming) == [("high", 10, 1), ("low", 9, 1)]
+    assert book.bids.best() is None
+    assert levels(book.asks) == [(9, ["sell"])]
+    assert incoming.remaining == SCALE
+
+
+def test_market_order_never_rests():
+    book = OrderBook(INSTRUMENT)
+    book.add(order("s", Side.SELL, 10, 2))
+    incoming = order("mkt", Side.BUY, None, 5)
+    assert fills(book, incoming) == [("s", 10, 2)]
+    assert incoming.remaining == 3 * SCALE
+    assert "mkt" not in book.orders
+    assert book.asks.best() is None and book.bids.best() is None
+
+
+def test_match_counts_partially_filled_makers():
+    book = OrderBook(INSTRUMENT)
+    book.add(order("s", Side.SELL, 10, 5, filled=3))
+    incoming = order("buy", Side.BUY, 10, 5)
+    assert fills(book, incoming) == [("s", 10, 2)]
+    assert book.orders["buy"].remaining == 3 * SCALE
+
+
+def test_level_quantity_follows_matches():
+    book = OrderBook(INSTRUMENT)
+    book.add(order("a", Side.SELL, 10, 2))
+    book.add(order("b", Side.SELL, 10, 3))
+    assert book.level_quantity(Side.SELL, 10 * SCALE) == 5 * SCALE
+    book.match(order("buy", Side.BUY, 10, 3))
+    assert book.level_quantity(Side.SELL, 10 * SCALE) == 2 * SCALE
+    book.remove("b")
+    assert book.level_quantity(Side.SELL, 10 * SCALE) == 0
+
+
+def test_version_bumps_on_every_visible_change():
+    book = OrderBook(INSTRUMENT)
+    book.add(order("s", Side.SELL, 10, 2))
+    assert book.version == 1
+    book.match(order("buy", Side.BUY, 10, 1))
+    assert book.version == 2
+    book.remove("s")
+    assert book.version == 3
+    book.remove("s")
+    assert book.version == 3
+
+
+def test_match_marks_touched_levels():
+    book = OrderBook(INSTRUMENT)
+    book.add(order("s", Side.SELL, 10, 1))
+    assert book.take_touched() == {(Side.SELL, 10 * SCALE)}
+    book.match(order("buy", Side.BUY, 9, 1))
+    assert book.take_touched() == {(Side.BUY, 9 * SCALE)}
+    book.match(order("buy2", Side.BUY, 10, 1))
+    assert book.take_touched() == {(Side.SELL, 10 * SCALE)}
+    assert book.take_touched() == set()
+
+
+def test_reduce_keeps_queue_position():
+    book = OrderBook(INSTRUMENT)
+    first, second = order("first", Side.SELL, 10, 5), order("second", Side.SELL, 10, 5)
+    book.add(first)
+    book.add(second)
+    book.reduce(first, 2 * SCALE)
+    assert first.quantity == 3 * SCALE
+    assert book.level_quantity(Side.SELL, 10 * SCALE) == 8 * SCALE
+    assert fills(book, order("buy", Side.BUY, 10, 4)) == [("first", 10, 3), ("second", 10, 1)]
+
+
+def test_order_status():
+    limit = order("o", Side.BUY, 10, 5)
+    assert order_status(limit, OrderType.LIMIT) == OrderStatus.NEW
+    limit.filled = 2 * SCALE
+    assert order_status(limit, OrderType.LIMIT) == OrderStatus.PARTIAL
+    assert order_status(limit, OrderType.MARKET) == OrderStatus.CANCELED
+    limit.filled = limit.quantity
+    assert order_status(limit, OrderType.LIMIT) == OrderStatus.FILLED
+    assert order_status(limit, OrderType.MARKET) == OrderStatus.FILLED
+
+
+def with_resting_bids(check, *quantities: int):
+    # Puts bids b0, b1, ... at 10 into the shared engine, runs check(book),
+    # then drops the book again.
+    instrument_id = 10 ** 6
+    book = matching_engine.book(instrument_id)
+    for i, quantity in enumerate(quantities):
+        o = order(f"b{i}", Side.BUY, 10, quantity)
+        o.instrument_id = instrument_id
+        book.add(o)
+    try:
+        asyncio.run(check(book))
+    finally:
+        matching_engine.books.pop(instrument_id, None)
+
+
+def test_amend_to_a_smaller_quantity_keeps_queue_position():
+    async def check(book):
+        mutations = await amend(book.instrument_id, "b1", 3 * SCALE, None)
+        assert levels(book.bids) == [(10, ["b0", "b1", "b2"])]
+        assert book.orders["b1"].quantity == 3 * SCALE and book.orders["b1"].priority_at is None
+        assert [type(m) for m in mutations] == [OrderAmend] and mutations[0].priority_at is None
+        assert book.level_quantity(Side.BUY, 10 * SCALE) == 13 * SCALE
+
+    with_resting_bids(check, 5, 5, 5)
+
+
+def test_amend_to_a_larger_quantity_goes_to_the_back():
+    async def check(book):
+        mutations = await amend(book.instrument_id, "b0", 7 * SCALE, None)
+        assert levels(book.bids) == [(10, ["b1", "b2", "b0"])]
+        assert book.orders["b0"].priority_at is not None
+        assert mutations[0].priority_at == book.orders["b0"].priority_at
+
+    with_resting_bids(check, 5, 5, 5)
+
+
+def test_amend_price_goes_to_the_back_even_when_it_returns():
+    async def check(book):
+        await amend(book.instrument_id, "b0", None, 11 * SCALE)
+        assert levels(book.bids) == [(11, ["b0"]), (10, ["b1", "b2"])]
+        await amend(book.instrument_id, "b0", None, 10 * SCALE)
+        assert levels(book.bids) == [(10, ["b1", "b2", "b0"])]
+        # A smaller quantity afterwards still keeps the new place.
+        await amend(book.instrument_id, "b0", 2 * SCALE, None)
+        assert levels(book.bids) == [(10, ["b1", "b2", "b0"])]
+
+    with_resting_bids(check, 5, 5, 5)
+
+
+@pytest.mark.skipif(not DATABASE_URL.startswith("postgresql"), reason="needs DATABASE_URL pointing at Postgres")
+def test_load_queues_orders_by_priority_time():
+    # Seeds its own rows inside a transaction that is rolled back at the end.
+    t0 = datetime.datetime(2001, 3, 1)
+
+    async def check(db):
+        instrument_id = (await db.execute(text(
+            "INSERT INTO instruments (symbol, name, type, is_listed) "
+            "VALUES ('LOADTEST', 'load test', 'MEMECOIN', true) RETURNING id"
+        ))).scalar_one()
+        user_id = (await db.execute(text(
+            "INSERT INTO users (external_id, username, name, token, is_admin, role) "
+            "VALUES ('load-test', 'load-test', 'load', 'load-test-token', false, 'USER') RETURNING id"
+        ))).scalar_one()
+        ids = {}
+        # name: (created minute, amended minute or None)
+        for name, (created, priority) in {
+            "amended-late": (0, 10), "second": (2, None), "amended-early": (5, 1), "last": (7, None),
+        }.items():
+            external_id = str(uuid.uuid4())
+            ids[external_id] = name
+            await db.execute(text(
+                "INSERT INTO orders (external_id, user_id, instrument_id, type, side, price, quantity, filled, "
+                "status, created_at, priority_at) VALUES (:ext, :user_id, :instrument_id, 'LIMIT', 'SELL', 10, 1, "
+                "0, 'NEW', :created, :priority)"
+            ), {"ext": external_id, "user_id": user_id, "instrument_id": instrument_id,
+                "created": t0 + datetime.timedelta(minutes=created),
+                "priority": None if priority is None else t0 + datetime.timedelta(minutes=priority)})
+
+        loaded = MatchingEngine()
+        await loaded.load(db, instrument_id)
+        queue = [ids[e] for _, orders in levels(loaded.book(instrument_id).asks) for e in orders]
+        assert queue == ["amended-early", "second", "last", "amended-late"]
+
+    async def run():
+        engine = create_async_engine(DATABASE_URL)
+        async with engine.connect() as conn:
+            trans = await conn.begin()
+            try:
+                await check(AsyncSession(bind=conn))
+            finally:
+                await trans.rollback()
+        await engine.dispose()
+
+    asyncio.run(run())
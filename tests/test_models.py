@@ -0,0 +1,25 @@
+from sqlalchemy import create_mock_engine
+
+from app.models import Base, OrderArchive
+
+
+def ddl(url: str, **kwargs) -> str:
+    statements = []
+    engine = create_mock_engine(url, lambda sql, *a, **kw: statements.append(str(sql.compile(dialect=engine.dialect))))
+    Base.metadata.create_all(engine, checkfirst=False, **kwargs)
+    return "\n".join(statements)
+
+
+def test_trades_id_uses_the_migration_sequence():
+    # Migration 0007 gives trades.id a nextval('trades_id_seq') default.
+    sql = ddl("postgresql://")
+    assert "CREATE SEQUENCE trades_id_seq" in sql
+    assert "id INTEGER DEFAULT nextval('trades_id_seq') NOT NULL" in sql
+    assert "PRIMARY KEY (id, timestamp)" in sql
+    assert "GENERATED" not in sql
+
+
+def test_default_partitions_only_on_postgres():
+    assert "CREATE TABLE trades_default PARTITION OF trades DEFAULT" in ddl("postgresql://")
+    assert "CREATE TABLE orders_archive_default PARTITION OF orders_archive DEFAULT" in ddl("postgresql://")
+    assert "PARTITION OF" not in ddl("sqlite://", tables=[OrderArchive.__table__])
@@ -0,0 +1,61 @@
+import datetime
+import gc
+import random
+import tracemalloc
+from decimal import Decimal
+
+import pytest
+
+from app.matching import SCALE, OrderBook, RestingOrder
+from app.models import Order, OrderStatus, OrderType, Side
+from bench.bench_book_memory import fill_books
+
+# Budget per resting order, including its share of the book and level
+# indexes; see the note on RestingOrder.
+MAX_BYTES_PER_ORDER = 450
+
+
+def test_resting_order_has_no_instance_dict():
+    o = RestingOrder(id=1, external_id="o", user_id=1, instrument_id=1, side=Side.BUY,
+                     price=10 * SCALE, quantity=5 * SCALE, filled=2 * SCALE)
+    assert not hasattr(o, "__dict__")
+    assert o.remaining == 3 * SCALE
+    with pytest.raises(AttributeError):
+        o.note = "x"
+
+
+def test_from_model_converts_to_units():
+    created = datetime.datetime(2026, 1, 2, 3, 4, 5)
+    o = RestingOrder.from_model(Order(
+        id=7, external_id="ext", user_id=3, instrument_id=2, type=OrderType.LIMIT, side=Side.SELL,
+        price=Decimal("10.5"), quantity=Decimal("3"), filled=None, status=OrderStatus.NEW, created_at=created,
+    ))
+    assert (o.id, o.external_id, o.user_id, o.instrument_id, o.side) == (7, "ext", 3, 2, Side.SELL)
+    assert (o.price, o.quantity, o.filled) == (1_050_000_000, 3 * SCALE, 0)
+    assert o.created_at == created and o.priority_at is None
+
+
+def test_orders_share_their_level_price():
+    book = OrderBook(1)
+    # Equal prices parsed separately are distinct int objects.
+    a = RestingOrder(id=1, external_id="a", user_id=1, instrument_id=1, side=Side.BUY,
+                     price=int("1000000000"), quantity=SCALE, filled=0)
+    b = RestingOrder(id=2, external_id="b", user_id=1, instrument_id=1, side=Side.BUY,
+                     price=int("1000000000"), quantity=SCALE, filled=0)
+    assert a.price is not b.price
+    book.add(a)
+    book.add(b)
+    assert b.price is a.price is book.bids.levels[a.price].price
+
+
+def test_memory_per_resting_order():
+    gc.collect()
+    tracemalloc.start()
+    try:
+        books = fill_books(20_000, 1, 1000, random.Random(1))
+        used, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    resting = sum(len(b.orders) for b in books.values())
+    assert resting == 20_000
+    assert used / resting <= MAX_BYTES_PER_ORDER
@@ -0,0 +1,71 @@
+from decimal import Decimal
+
+import pytest
+
+from app.instruments import InstrumentInfo
+from app.matching import SCALE, from_units, to_units, whole
+from app.models import OrderType, Side
+from app.routers.api_v1_order import increment_error
+
+
+@pytest.mark.parametrize("value, units", [
+    (1, SCALE),
+    ("1.5", 150_000_000),
+    (Decimal("0.00000001"), 1),
+    (Decimal("12.34567890"), 1_234_567_890),
+    (Decimal("0E-8"), 0),
+    # Below the 1e-8 resolution of Numeric(20, 8): truncated, not rounded.
+    (Decimal("0.000000019"), 1),
+    (Decimal("-0.000000019"), -1),
+])
+def test_to_units(value, units):
+    assert to_units(value) == units
+
+
+def test_units_round_trip():
+    for value in (Decimal("0"), Decimal("0.00000001"), Decimal("123456789012.12345678")):
+        assert from_units(to_units(value)) == value
+
+
+@pytest.mark.parametrize("units, expected", [
+    (0, 0),
+    (SCALE, 1),
+    (3 * SCALE - 1, 2),
+    (3 * SCALE + 1, 3),
+    (-1, -1),
+])
+def test_whole_rounds_down(units, expected):
+    assert whole(units) == expected
+
+
+def args(quantity: int, price=None) -> dict:
+    # Shaped like api_v1_order.order_args: whole API values scaled to units.
+    return {
+        "order_type": OrderType.LIMIT if price is not None else OrderType.MARKET,
+        "side": Side.BUY,
+        "quantity": quantity * SCALE,
+        "price": price * SCALE if price is not None else None,
+    }
+
+
+INSTRUMENT = InstrumentInfo(1, "MEME", "Meme", True, tick=5 * SCALE, lot=10 * SCALE)
+
+
+@pytest.mark.parametrize("quantity, price", [(10, 5), (30, 100), (10, None)])
+def test_increment_error_accepts_multiples(quantity, price):
+    assert increment_error(INSTRUMENT, args(quantity, price)) is None
+
+
+@pytest.mark.parametrize("quantity, price, message", [
+    (15, 5, "Quantity must be a multiple of the lot size 10"),
+    (5, None, "Quantity must be a multiple of the lot size 10"),
+    (10, 7, "Price must be a multiple of the tick size 5"),
+    (15, 7, "Quantity must be a multiple of the lot size 10"),
+])
+def test_increment_error_rejects(quantity, price, message):
+    assert increment_error(INSTRUMENT, args(quantity, price)) == message
+
+
+def test_fractional_increments():
+    inst = InstrumentInfo(1, "MEME", "Meme", True, tick=to_units("0.5"), lot=to_units("0.25"))
+    assert increment_error(inst, args(1, 3)) is None
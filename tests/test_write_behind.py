@@ -0,0 +1,139 @@
+import asyncio
+import datetime
+
+import pytest
+
+from app.matching import SCALE, RestingOrder
+from app.models import OrderStatus, OrderType, Side
+from app.persistence import BalanceDelta, CancelOrders, NewOrder, OrderUpdate, WriteBehind, fold
+
+INSTRUMENT = 1
+
+
+def order(external_id: str, instrument_id: int = INSTRUMENT) -> RestingOrder:
+    return RestingOrder(
+        id=None, external_id=external_id, user_id=1, instrument_id=instrument_id, side=Side.BUY,
+        price=10 * SCALE, quantity=5 * SCALE, filled=0, created_at=datetime.datetime(2024, 1, 1),
+    )
+
+
+def delta(instrument_id: int = INSTRUMENT) -> BalanceDelta:
+    return BalanceDelta(user_id=1, instrument_id=instrument_id, delta=SCALE)
+
+
+class FakeFlush:
+    """Stands in for WriteBehind.flush: records batches, can hold them open and
+    fails those that touch an instrument in ``failing``."""
+
+    def __init__(self):
+        self.batches = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+        self.failing = set()
+
+    async def __call__(self, mutations):
+        self.batches.append(list(mutations))
+        await self.gate.wait()
+        if any(m.instrument_id in self.failing for m in mutations):
+            raise RuntimeError("flush failed")
+
+
+def with_fake_flush(check, interval: float = 0.01, max_events: int = 100):
+    async def run():
+        wb = WriteBehind(interval, max_events)
+        wb.flush = flush = FakeFlush()
+        try:
+            await check(wb, flush)
+        finally:
+            flush.gate.set()
+            await wb.stop()
+
+    asyncio.run(run())
+
+
+def test_futures_resolve_only_after_the_flush():
+    async def check(wb, flush):
+        flush.gate.clear()
+        first, second = wb.submit([delta()]), wb.submit([delta()])
+        await asyncio.sleep(0.05)
+        # Both submits went out as one batch, which has not committed yet.
+        assert len(flush.batches) == 1 and len(flush.batches[0]) == 2
+        assert not first.done() and not second.done()
+        flush.gate.set()
+        await asyncio.gather(first, second)
+        assert (wb.batches, wb.events) == (1, 2)
+
+    with_fake_flush(check)
+
+
+def test_max_events_flushes_without_waiting_for_the_interval():
+    async def check(wb, flush):
+        await asyncio.wait_for(wb.submit([delta(), delta()]), 1)
+        assert len(flush.batches) == 1
+
+    with_fake_flush(check, interval=60, max_events=2)
+
+
+def test_barrier_resolves_at_once_when_idle():
+    async def check(wb, flush):
+        assert wb.submit([]).done()
+        flush.gate.clear()
+        pending = wb.submit([delta()])
+        barrier = wb.submit([])
+        # Queued behind a write: resolves with it, not before.
+        assert not barrier.done()
+        flush.gate.set()
+        await asyncio.gather(pending, barrier)
+        assert len(flush.batches) == 1
+
+    with_fake_flush(check)
+
+
+def test_fold_writes_each_order_once():
+    new, old = order("new"), order("old")
+    w = fold([
+        NewOrder(new, OrderType.LIMIT, OrderStatus.NEW, 0),
+        OrderUpdate(new, OrderStatus.PARTIAL, 2 * SCALE),
+        OrderUpdate(old, OrderStatus.PARTIAL, SCALE),
+        OrderUpdate(new, OrderStatus.PARTIAL, 3 * SCALE),
+        OrderUpdate(old, OrderStatus.PARTIAL, 4 * SCALE),
+        CancelOrders([new, old]),
+        delta(),
+        delta(),
+    ])
+    assert list(w.new_orders) == ["new"]
+    assert (w.new_orders["new"]["filled"], w.new_orders["new"]["status"]) == (3 * SCALE, OrderStatus.CANCELED)
+    assert list(w.updates) == ["old"]
+    assert (w.updates["old"]["filled"], w.updates["old"]["status"]) == (4 * SCALE, OrderStatus.CANCELED)
+    assert w.canceled == {} and w.amends == {}
+    assert w.deltas == {(1, INSTRUMENT): 2 * SCALE}
+
+
+def test_failed_batch_fails_its_dependents_and_calls_failure_hooks():
+    async def check(wb, flush):
+        failed = []
+        wb.failure_hooks.append(failed.append)
+
+        async def reload(instruments):
+            failed.append(("reloaded", instruments))
+
+        wb.failure_hooks.append(reload)
+        flush.gate.clear()
+        flush.failing.add(INSTRUMENT)
+        batch = wb.submit([delta(INSTRUMENT)])
+        await asyncio.sleep(0.05)
+        # Queued while that batch is being written.
+        dependent = wb.submit([delta(INSTRUMENT)])
+        other = wb.submit([delta(INSTRUMENT + 1)])
+        barrier = wb.submit([])
+        flush.gate.set()
+        with pytest.raises(RuntimeError):
+            await batch
+        with pytest.raises(RuntimeError):
+            await dependent
+        await asyncio.gather(other, barrier)
+        assert failed == [{INSTRUMENT}, ("reloaded", {INSTRUMENT})]
+        assert [[m.instrument_id for m in ms] for ms in flush.batches] == [[INSTRUMENT], [INSTRUMENT + 1]]
+        assert wb.batches == 1
+
+    with_fake_flush(check)